@@ -0,0 +1,233 @@
+"""Benchmark route reconciliation with ConfigurableHTTPProxy
+
+Runs against a mock of the configurable-http-proxy REST API
+(jupyterhub.tests.mockchp), so it needs neither node nor network access.
+
+For each number of routes, populates a MockHub with that many running servers
+and measures, for each proxy operation:
+
+- wall time
+- number of requests made to the proxy API
+- event-loop blocking: the longest delay and the total delay
+  in waking up a task that should run every few milliseconds
+- peak memory allocated by Python during the operation, with tracemalloc.
+  This includes the mock proxy, which runs in a thread of the same process,
+  and tracing makes everything somewhat slower.
+
+Usage::
+
+    python benchmarks/bench_proxy.py --routes 1000 10000 50000 --latency 0.001
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import timedelta
+
+from sqlalchemy import insert
+from traitlets.config import Config
+
+from jupyterhub import orm
+from jupyterhub.tests.mockchp import MockCHP
+from jupyterhub.tests.mocking import MockHub
+from jupyterhub.utils import utcnow
+
+
+class LoopLagMonitor:
+    """Measure how long the event loop is blocked
+
+    A task sleeps for `interval` in a loop,
+    and records how much later than requested it wakes up.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.max_lag = 0
+        self.total_lag = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            tic = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - tic - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            self.total_lag += lag
+
+    def __enter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    def __exit__(self, *exc_info):
+        self._task.cancel()
+
+
+def populate(app, n):
+    """Add n users with a running default server to the Hub's database"""
+    db = app.db
+    chunk = 5000
+    for start in range(0, n, chunk):
+        names = [f"bench-{i}" for i in range(start, min(start + chunk, n))]
+        db.execute(insert(orm.User), [{"name": name} for name in names])
+        db.execute(
+            insert(orm.Server),
+            [{"ip": "127.0.0.1", "port": 10000 + i % 50000} for i in range(len(names))],
+        )
+    db.commit()
+    user_ids = db.execute(
+        orm.User.__table__.select()
+        .with_only_columns(orm.User.id)
+        .where(orm.User.name.startswith("bench-"))
+        .order_by(orm.User.id)
+    ).scalars()
+    server_ids = db.execute(
+        orm.Server.__table__.select()
+        .with_only_columns(orm.Server.id)
+        .order_by(orm.Server.id)
+    ).scalars()
+    db.execute(
+        insert(orm.Spawner),
+        [
+            {"user_id": user_id, "name": "", "server_id": server_id}
+            for user_id, server_id in zip(user_ids, server_ids)
+        ],
+    )
+    db.commit()
+    for orm_user in db.query(orm.User).filter(orm.User.name.startswith("bench-")):
+        user = app.users.add(orm_user)
+        # instantiate the spawner
+        user.spawners[""]
+
+
+async def measure(chp, name, coro_factory):
+    chp.reset_counts()
+    tracemalloc.start()
+    try:
+        with LoopLagMonitor() as monitor:
+            tic = time.perf_counter()
+            await coro_factory()
+            wall = time.perf_counter() - tic
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return OrderedDict(
+        operation=name,
+        wall_s=round(wall, 4),
+        requests=sum(chp.request_count.values()),
+        errors=chp.error_count,
+        max_blocked_s=round(monitor.max_lag, 4),
+        total_blocked_s=round(monitor.total_lag, 4),
+        peak_mem_mb=round(peak / 2**20, 1),
+    )
+
+
+async def bench(n, latency, error_rate):
+    results = []
+    auth_token = "bench-token"
+    with MockCHP(auth_token, latency=latency, error_rate=error_rate, seed=1) as chp:
+        cfg = Config()
+        cfg.ConfigurableHTTPProxy.api_url = chp.api_url
+        cfg.ConfigurableHTTPProxy.auth_token = auth_token
+        cfg.ConfigurableHTTPProxy.should_start = False
+        app = MockHub(config=cfg)
+        try:
+            await app.initialize([])
+            tic = time.perf_counter()
+            populate(app, n)
+            print(f"Populated {n} servers in {time.perf_counter() - tic:.1f}s")
+            proxy = app.proxy
+            await proxy.add_hub_route(app.hub)
+
+            results.append(
+                await measure(
+                    chp, "add_all_users", lambda: proxy.add_all_users(app.users)
+                )
+            )
+            results.append(await measure(chp, "get_all_routes", proxy.get_all_routes))
+            results.append(
+                await measure(
+                    chp,
+                    "check_routes (full)",
+                    lambda: proxy.check_routes(app.users, app._service_map),
+                )
+            )
+            results.append(
+                await measure(
+                    chp,
+                    "check_routes (incremental)",
+                    lambda: proxy.check_routes(
+                        app.users, app._service_map, incremental=True
+                    ),
+                )
+            )
+            # simulate 1% of routes with activity since the last poll
+            now = utcnow()
+            for i, path in enumerate(list(chp.routes)):
+                if i % 100 == 0:
+                    chp.set_activity(path, now + timedelta(seconds=1))
+            app._last_activity_poll = now.replace(tzinfo=None)
+            results.append(
+                await measure(chp, "update_last_activity", app.update_last_activity)
+            )
+        finally:
+            app.db.close()
+            MockHub.clear_instance()
+    for result in results:
+        result["routes"] = n
+        result.move_to_end("routes", last=False)
+    return results
+
+
+def format_table(results):
+    columns = list(results[0])
+    widths = [
+        max(len(col), *(len(str(result[col])) for result in results)) for col in columns
+    ]
+    lines = ["  ".join(col.ljust(width) for col, width in zip(columns, widths))]
+    for result in results:
+        lines.append(
+            "  ".join(
+                str(result[col]).ljust(width) for col, width in zip(columns, widths)
+            )
+        )
+    return "\n".join(lines)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--routes",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="Number of routes to benchmark",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Latency of proxy API requests (s)"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="Fraction of proxy API requests that fail",
+    )
+    parser.add_argument("--json", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    # only show warnings and errors from the Hub
+    logging.disable(logging.INFO)
+
+    results = []
+    for n in args.routes:
+        results.extend(await bench(n, args.latency, args.error_rate))
+        print(format_table(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
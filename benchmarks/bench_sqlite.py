@@ -0,0 +1,194 @@
+"""Benchmark SQLite commit throughput for activity-style workloads
+
+Compares the default SQLite settings with `JupyterHub.sqlite_performance_mode`
+(see `jupyterhub.orm.SQLITE_PERFORMANCE_PRAGMAS`),
+on a database file in a temporary directory
+(put it on the disk you want to measure with `--dir`).
+
+Workloads, each run for `--seconds` per mode:
+
+- `request`: one small transaction per request, updating last_activity
+  of a user and one of their tokens through the ORM,
+  like authenticated requests to the Hub without the activity buffer
+- `heartbeat`: one transaction per activity report from a single-user server,
+  updating last_activity of the user and their server
+- `flush`: one transaction updating `--batch` users with an executemany UPDATE,
+  like a flush of the activity buffer
+
+For each workload and mode, reports transactions per second,
+and the median and 99th percentile commit latency.
+
+Usage::
+
+    python benchmarks/bench_sqlite.py --users 1000 --seconds 5
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+
+from sqlalchemy import bindparam, insert
+
+from jupyterhub import orm
+from jupyterhub.utils import utcnow
+
+MODES = OrderedDict(
+    [
+        ("default", {}),
+        ("performance", orm.SQLITE_PERFORMANCE_PRAGMAS),
+    ]
+)
+
+
+def populate(db, n):
+    """Add n users, each with a server and a token"""
+    db.execute(insert(orm.User), [{"name": f"user-{i}"} for i in range(n)])
+    user_ids = [row[0] for row in db.query(orm.User.id)]
+    db.execute(
+        insert(orm.Spawner), [{"user_id": user_id, "name": ""} for user_id in user_ids]
+    )
+    db.execute(
+        insert(orm.APIToken),
+        [
+            {"user_id": user_id, "hashed": f"hashed-{user_id}", "prefix": "abcd"}
+            for user_id in user_ids
+        ],
+    )
+    db.commit()
+    return user_ids
+
+
+def request(db, user_ids):
+    orm_user = db.get(orm.User, random.choice(user_ids))
+    now = utcnow(with_tz=False)
+    orm_user.last_activity = now
+    orm_user.api_tokens[0].last_activity = now
+
+
+def heartbeat(db, user_ids):
+    orm_user = db.get(orm.User, random.choice(user_ids))
+    now = utcnow(with_tz=False)
+    orm_user.last_activity = now
+    orm_user.orm_spawners[""].last_activity = now
+
+
+def make_flush(batch):
+    table = orm.User.__table__
+    update = (
+        table.update()
+        .where(table.c.id == bindparam("_id"))
+        .values(last_activity=bindparam("_last_activity"))
+    )
+
+    def flush(db, user_ids):
+        now = utcnow(with_tz=False)
+        db.execute(
+            update,
+            [
+                {"_id": user_id, "_last_activity": now}
+                for user_id in random.sample(user_ids, min(batch, len(user_ids)))
+            ],
+        )
+
+    return flush
+
+
+def bench_mode(directory, mode, pragmas, n_users, seconds, workloads):
+    path = os.path.join(directory, f"{mode}.sqlite")
+    db = orm.new_session_factory(f"sqlite:///{path}", sqlite_pragmas=pragmas)()
+    user_ids = populate(db, n_users)
+    results = []
+    for name, workload in workloads.items():
+        latencies = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            workload(db, user_ids)
+            tic = time.perf_counter()
+            db.commit()
+            latencies.append(time.perf_counter() - tic)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results.append(
+            OrderedDict(
+                workload=name,
+                mode=mode,
+                tx_per_s=round(len(latencies) / elapsed),
+                commit_p50_ms=round(1e3 * statistics.median(latencies), 3),
+                commit_p99_ms=round(
+                    1e3
+                    * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+                    3,
+                ),
+            )
+        )
+    db.close()
+    db.get_bind().dispose()
+    return results
+
+
+def format_table(results):
+    columns = list(results[0])
+    widths = [
+        max(len(col), *(len(str(result[col])) for result in results)) for col in columns
+    ]
+    lines = ["  ".join(col.ljust(width) for col, width in zip(columns, widths))]
+    for result in results:
+        lines.append(
+            "  ".join(
+                str(result[col]).ljust(width) for col, width in zip(columns, widths)
+            )
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--users", type=int, default=1000, help="Number of users in the database"
+    )
+    parser.add_argument(
+        "--seconds", type=float, default=5, help="Duration of each workload (s)"
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=100,
+        help="Number of users updated per transaction in the flush workload",
+    )
+    parser.add_argument(
+        "--dir", help="Directory for the database files (default: a temporary one)"
+    )
+    parser.add_argument("--json", help="Write results as JSON to this file")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    workloads = OrderedDict(
+        [
+            ("request", request),
+            ("heartbeat", heartbeat),
+            ("flush", make_flush(args.batch)),
+        ]
+    )
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for mode, pragmas in MODES.items():
+            results.extend(
+                bench_mode(
+                    directory, mode, pragmas, args.users, args.seconds, workloads
+                )
+            )
+    results.sort(key=lambda result: result["workload"])
+    print(format_table(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,7 +21,11 @@ class Generator:
         table_rows = []
         for name in dir(jupyterhub.metrics):
             obj = getattr(jupyterhub.metrics, name)
-            if obj.__class__.__module__.startswith('prometheus_client.'):
+            if isinstance(obj, jupyterhub.metrics.MemoizeCollector) or (
+                obj.__class__.__module__.startswith('prometheus_client.')
+                # skip e.g. the registry
+                and hasattr(obj, 'describe')
+            ):
                 for metric in obj.describe():
                     table_rows.append([metric.type, metric.name, metric.documentation])
         return table_rows
@@ -0,0 +1,323 @@
+"""In-memory cache of resolved permissions
+
+Resolving the scopes of a user, service, or token
+(:func:`.scopes.get_scopes_for`) loads their roles, their groups' roles,
+shares, etc. and expands them, on every authenticated request.
+The result only changes when roles, group membership, shares, or tokens change,
+so it is cached.
+
+Instead of tracking which principals each change affects,
+any change that could affect permissions bumps a global *generation*,
+invalidating all cached entries at once.
+Such changes are rare compared to requests.
+
+Group membership, needed to intersect ``!group=`` filters with ``!user=``
+and ``!server=`` filters, is indexed by username
+and kept up to date as memberships change.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import threading
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import RelationshipProperty, Session
+
+from . import orm
+from ._memoize import LRUCache
+
+_lock = threading.Lock()
+_generation = 0
+
+# attributes of each class that affect permissions when changed,
+# None for any change (including creation).
+# Objects of other classes (and new objects of these classes) don't affect
+# permissions that have already been resolved.
+_WATCHED = {
+    orm.Role: None,
+    orm.Group: None,
+    orm.Share: None,
+    orm.OAuthClient: None,
+    orm.User: ("name", "roles", "groups"),
+    orm.Service: ("name", "roles"),
+    orm.APIToken: (
+        "scopes",
+        "user",
+        "user_id",
+        "service",
+        "service_id",
+        "oauth_client",
+        "client_id",
+    ),
+    orm.Spawner: ("name", "user", "user_id"),
+}
+
+_CHANGED_KEY = "jupyterhub_authz_changed"
+
+
+def get_generation():
+    """Return the current authorization generation"""
+    return _generation
+
+
+def bump_generation():
+    """Invalidate all resolved permissions
+
+    Call after any change affecting permissions
+    that isn't made through the ORM (e.g. defining custom scopes).
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+
+
+class ScopeCache:
+    """A bounded LRU cache of resolved scopes
+
+    Entries are only valid for the generation they were resolved in.
+    """
+
+    def __init__(self, maxsize=4096):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    @staticmethod
+    def key_for(orm_object):
+        """The cache key for an orm object
+
+        None if the object can't be cached (e.g. not yet in the database).
+        """
+        if orm_object.id is None or not inspect(orm_object).persistent:
+            return None
+        return (type(orm_object).__name__, orm_object.id)
+
+    def get(self, key, generation):
+        """Get the scopes for a key, if resolved in this generation"""
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is None or entry[0] != generation:
+            return None
+        return entry[1]
+
+    def set(self, key, generation, scopes):
+        """Store scopes resolved in a generation
+
+        `generation` must be the generation from *before* the scopes were resolved,
+        so that changes made in the meantime aren't missed.
+        """
+        with self._lock:
+            self._cache.set(key, (generation, frozenset(scopes)))
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+scope_cache = ScopeCache()
+
+
+class GroupMembership:
+    """An index of group names by username
+
+    Entries are loaded from the database on first use,
+    and updated in place when memberships change through the ORM
+    (e.g. :meth:`.User.sync_groups`, the groups API, loading groups from config).
+
+    `version` changes whenever membership may have changed,
+    so results derived from membership can be cached by version.
+    """
+
+    def __init__(self, maxsize=10000):
+        self._groups = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def groups_for_user(self, db, username):
+        """Return the names of the groups a user is in, as a frozenset"""
+        with self._lock:
+            groups = self._groups.get(username)
+            version = self.version
+        if groups is not None:
+            return groups
+        group_query = (
+            db.query(orm.Group.name)
+            .join(orm.User.groups)
+            .filter(orm.User.name == username)
+        )
+        groups = frozenset(row[0] for row in group_query)
+        with self._lock:
+            # don't store a result that may have changed while loading
+            if self.version == version:
+                self._groups.set(username, groups)
+        return groups
+
+    def add(self, username, group_name):
+        """Record a user joining a group"""
+        with self._lock:
+            self.version += 1
+            groups = self._groups.get(username)
+            if groups is not None:
+                self._groups.set(username, groups | {group_name})
+
+    def remove(self, username, group_name):
+        """Record a user leaving a group"""
+        with self._lock:
+            self.version += 1
+            groups = self._groups.get(username)
+            if groups is not None:
+                self._groups.set(username, groups - {group_name})
+
+    def invalidate(self, username=None):
+        """Forget the groups of one user, or of all users if unspecified"""
+        with self._lock:
+            self.version += 1
+            if username is None:
+                self._groups.clear()
+            else:
+                self._groups.pop(username)
+
+
+group_membership = GroupMembership()
+
+
+def reset():
+    """Discard everything cached, e.g. when connecting to a new database"""
+    bump_generation()
+    scope_cache.clear()
+    group_membership.invalidate()
+
+
+def _affects_permissions(session):
+    """Whether pending changes in a session may affect permissions"""
+    for obj in session.deleted:
+        if type(obj) in _WATCHED:
+            return True
+    for obj in session.new:
+        if _WATCHED.get(type(obj), ()) is None:
+            return True
+    for obj in session.dirty:
+        cls = type(obj)
+        if cls not in _WATCHED:
+            continue
+        attrs = _WATCHED[cls]
+        if attrs is None:
+            return True
+        state = inspect(obj)
+        if any(state.attrs[attr].history.has_changes() for attr in attrs):
+            return True
+    return False
+
+
+@event.listens_for(Session, "before_flush")
+def _before_flush(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, orm.User):
+            group_membership.invalidate(obj.name)
+        elif isinstance(obj, orm.Group):
+            group_membership.invalidate()
+    if _affects_permissions(session):
+        session.info[_CHANGED_KEY] = True
+        # bump once when changes become visible to this session
+        bump_generation()
+
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        # and again when they become visible to everyone else
+        bump_generation()
+
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    if session.info.pop(_CHANGED_KEY, False):
+        # permissions may have been resolved with the rolled back changes
+        bump_generation()
+        group_membership.invalidate()
+
+
+def _attribute_changed(target, *args):
+    # changes to objects in the database take effect in memory immediately,
+    # before they are flushed.
+    # New objects only take effect when they are added (see _before_flush).
+    state = inspect(target)
+    if state.persistent:
+        state.session.info[_CHANGED_KEY] = True
+        bump_generation()
+
+
+def _user_and_group(target, value):
+    """The (user, group) of a membership change from either side"""
+    if isinstance(target, orm.User):
+        return target, value
+    return value, target
+
+
+def _mark_changed(target):
+    # so that the index is reset if the change is rolled back
+    session = inspect(target).session
+    if session is not None:
+        session.info[_CHANGED_KEY] = True
+
+
+def _user_joined(target, value, initiator):
+    _mark_changed(target)
+    user, group = _user_and_group(target, value)
+    group_membership.add(user.name, group.name)
+
+
+def _user_left(target, value, initiator):
+    _mark_changed(target)
+    user, group = _user_and_group(target, value)
+    group_membership.remove(user.name, group.name)
+
+
+def _renamed(target, value, oldvalue, initiator):
+    if not inspect(target).persistent:
+        return
+    if isinstance(target, orm.User):
+        group_membership.invalidate(oldvalue)
+        group_membership.invalidate(value)
+    else:
+        group_membership.invalidate()
+
+
+def _listen_for_changes():
+    for cls, attrs in _WATCHED.items():
+        mapper = inspect(cls)
+        if attrs is None:
+            attrs = [prop.key for prop in mapper.attrs]
+        for attr in attrs:
+            prop = mapper.attrs[attr]
+            if isinstance(prop, RelationshipProperty) and prop.uselist:
+                identifiers = ("append", "remove")
+            else:
+                identifiers = ("set",)
+            for identifier in identifiers:
+                event.listen(getattr(cls, attr), identifier, _attribute_changed)
+
+    # membership changes are seen from both sides,
+    # which is harmless because adding and removing are idempotent
+    for attr in (orm.User.groups, orm.Group.users):
+        event.listen(attr, "append", _user_joined)
+        event.listen(attr, "remove", _user_left)
+    for cls in (orm.User, orm.Group):
+        event.listen(cls.name, "set", _renamed)
+
+
+_listen_for_changes()
+
+
+# bulk UPDATE and DELETE (e.g. purging expired shares) don't emit flush events
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_change(orm_execute_state):
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is not None and mapper.class_ in _WATCHED:
+        bump_generation()
+    if mapper is not None and mapper.class_ in (orm.User, orm.Group):
+        group_membership.invalidate()
@@ -4,6 +4,7 @@ Note: a memoized function should always return an _immutable_
 result to avoid later modifications polluting cached results.
 """
 
+import time
 from collections import OrderedDict
 from functools import wraps
 
@@ -24,24 +25,56 @@ class DoNotCache:
         self.result = result
 
 
+_missing = object()
+
+# memoized function name -> cache
+_memoized_caches = {}
+
+
 class LRUCache:
-    """A simple Least-Recently-Used (LRU) cache with a max size"""
+    """A simple Least-Recently-Used (LRU) cache with a max size
+
+    If `ttl` is given, entries expire `ttl` seconds after they are stored.
 
-    def __init__(self, maxsize=1024):
+    Counts hits, misses (including expired entries),
+    and evictions of entries to stay under `maxsize`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
         self._cache = OrderedDict()
         self.maxsize = maxsize
+        self.ttl = ttl
+        self._deadlines = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _expired(self, key):
+        """Check if an entry has expired, removing it if it has"""
+        if self.ttl is None:
+            return False
+        if self._deadlines[key] < time.monotonic():
+            self.pop(key)
+            return True
+        return False
 
     def __contains__(self, key):
-        return key in self._cache
+        return key in self._cache and not self._expired(key)
+
+    def __len__(self):
+        return len(self._cache)
 
     def get(self, key, default=None):
         """Get an item from the cache"""
-        if key in self._cache:
-            # cache hit, bump to front of the queue for LRU
-            result = self._cache[key]
-            self._cache.move_to_end(key)
-            return result
-        return default
+        # single lookup on the hit path
+        result = self._cache.get(key, _missing)
+        if result is _missing or (self.ttl is not None and self._expired(key)):
+            self.misses += 1
+            return default
+        # cache hit, bump to front of the queue for LRU
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return result
 
     def set(self, key, value):
         """Store an entry in the cache
@@ -49,9 +82,41 @@ class LRUCache:
         Purges oldest entry if cache is full
         """
         self._cache[key] = value
+        self._cache.move_to_end(key)
+        if self.ttl is not None:
+            self._deadlines[key] = time.monotonic() + self.ttl
         # cache is full, purge oldest entry
         if len(self._cache) > self.maxsize:
-            self._cache.popitem(last=False)
+            self._evict()
+
+    def _evict(self):
+        """Purge the oldest entries until the cache is within maxsize"""
+        while len(self._cache) > self.maxsize:
+            oldest, _ = self._cache.popitem(last=False)
+            self._deadlines.pop(oldest, None)
+            self.evictions += 1
+
+    def resize(self, maxsize):
+        """Change the max size of the cache, purging entries if needed"""
+        self.maxsize = maxsize
+        self._evict()
+
+    def pop(self, key, default=None):
+        """Remove an entry from the cache, returning its value"""
+        self._deadlines.pop(key, None)
+        return self._cache.pop(key, default)
+
+    def items(self):
+        """Return a list of the (key, value) pairs in the cache"""
+        return list(self._cache.items())
+
+    def clear(self):
+        """Remove all entries from the cache
+
+        Hit, miss, and eviction counts are preserved.
+        """
+        self._cache.clear()
+        self._deadlines.clear()
 
     __getitem__ = get
     __setitem__ = set
@@ -74,6 +139,10 @@ def lru_cache_key(key_func, maxsize=1024):
         def func_user(user):
             # output only varies by name
 
+    The cache is available as `func_user.cache`,
+    and registered under the function's qualified name
+    (e.g. `jupyterhub.scopes.expand_scopes`, see :func:`memoized_caches`).
+
     Args:
         key (callable):
             Should have the same signature as the decorated function.
@@ -84,29 +153,52 @@ def lru_cache_key(key_func, maxsize=1024):
 
     def cache_func(func):
         cache = LRUCache(maxsize=maxsize)
+        cache_get = cache.get
+        cache_set = cache.set
 
         # the actual decorated function:
         @wraps(func)
         def cached(*args, **kwargs):
             cache_key = key_func(*args, **kwargs)
-            if cache_key in cache:
+            result = cache_get(cache_key, _missing)
+            if result is not _missing:
                 # cache hit
-                return cache[cache_key]
+                return result
+            # cache miss, call function and cache result
+            result = func(*args, **kwargs)
+            if isinstance(result, DoNotCache):
+                # DoNotCache prevents caching
+                result = result.result
             else:
-                # cache miss, call function and cache result
-                result = func(*args, **kwargs)
-                if isinstance(result, DoNotCache):
-                    # DoNotCache prevents caching
-                    result = result.result
-                else:
-                    cache[cache_key] = result
+                cache_set(cache_key, result)
             return result
 
+        cached.cache = cache
+        cached.cache_clear = cache.clear
+        _memoized_caches[f"{func.__module__}.{func.__qualname__}"] = cache
         return cached
 
     return cache_func
 
 
+def memoized_caches():
+    """Return a dict of the caches of all functions decorated with `lru_cache_key`
+
+    Keyed by the qualified name of the function.
+    """
+    return dict(_memoized_caches)
+
+
+def clear_caches():
+    """Clear the caches of all functions decorated with `lru_cache_key`
+
+    For when the inputs of memoized functions change without changing their arguments,
+    e.g. defining new scopes, and in tests.
+    """
+    for cache in _memoized_caches.values():
+        cache.clear()
+
+
 class FrozenDict(dict):
     """A frozen dictionary subclass
 
@@ -0,0 +1,105 @@
+"""Per-request accounting of database queries
+
+Counts the SQL statements executed while handling each request, and the time
+spent in them, so that handlers issuing lots of small queries
+(e.g. lazy-loading a relationship for every item in a list, the "N+1" problem)
+show up in metrics and, optionally, in the logs.
+
+Statements are attributed to the request via a context variable,
+which follows the request into the db executor's threads.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_current = ContextVar("jupyterhub_query_stats", default=None)
+
+_START_KEY = "jupyterhub_query_start"
+
+
+class QueryStats:
+    """Database statements executed during a request
+
+    Args:
+        record_statements (bool): whether to keep the text of each statement,
+            for logging. Only the count and total duration are kept otherwise.
+    """
+
+    def __init__(self, record_statements=False):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter() if record_statements else None
+        self.stopped = False
+        # statements may be executed in db executor threads
+        self._lock = threading.Lock()
+
+    def stop(self):
+        """Stop recording statements, when the request is finished
+
+        Tasks started by the request (e.g. spawns) inherit its context,
+        and their statements shouldn't count toward the finished request.
+        """
+        with self._lock:
+            self.stopped = True
+
+    def record(self, statement, duration):
+        """Record the execution of one statement"""
+        with self._lock:
+            if self.stopped:
+                return
+            self.count += 1
+            self.duration += duration
+            if self.statements is not None:
+                self.statements[statement] += 1
+
+    def format_statements(self):
+        """Format recorded statements for logging, most repeated first
+
+        Repeated statements are usually the sign of a query in a loop.
+        """
+        if not self.statements:
+            return ""
+        lines = []
+        for statement, count in self.statements.most_common():
+            statement = " ".join(statement.split())
+            lines.append(f"  {count}x {statement}")
+        return "\n".join(lines)
+
+
+def start_query_stats(record_statements=False):
+    """Start recording statements for the current request
+
+    Returns the :class:`QueryStats` for the request.
+    """
+    stats = QueryStats(record_statements=record_statements)
+    _current.set(stats)
+    return stats
+
+
+def current_query_stats():
+    """Return the :class:`QueryStats` of the current request, if any"""
+    return _current.get()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is not None and not stats.stopped:
+        # a connection executes one statement at a time
+        conn.info[_START_KEY] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    start = conn.info.pop(_START_KEY, None)
+    if stats is None or start is None:
+        return
+    stats.record(statement, time.perf_counter() - start)
@@ -0,0 +1,182 @@
+"""In-memory cache of API token lookups
+
+Looking up an API token with :meth:`.APIToken.find`
+queries all tokens with the same prefix and hashes the token
+for comparison with each of them.
+Single-user servers, services, etc. present the same tokens over and over,
+so the Hub caches which token id a token value resolves to.
+
+Tokens are never stored in the cache, only a keyed digest of them,
+with a key that only lives in memory.
+"""
+
+import hmac
+import secrets
+import threading
+import time
+from collections import namedtuple
+from weakref import WeakSet
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from . import orm
+from ._memoize import LRUCache
+from .metrics import (
+    API_TOKEN_CACHE_LOOKUPS,
+    API_TOKEN_CACHE_SAVED_SECONDS,
+    TokenCacheResult,
+)
+
+_Entry = namedtuple("_Entry", ["token_id", "user_id", "service_id", "expires_at"])
+
+# all caches, for invalidation from database events
+_caches = WeakSet()
+
+
+class APITokenCache:
+    """A bounded LRU cache of API token lookups, with expiry
+
+    Maps a keyed digest of a token to its id and owner.
+    Entries are invalidated when the token is deleted,
+    or when its scopes, expiry, or owner change.
+    """
+
+    def __init__(self, maxsize=4096, ttl=300):
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._secret = secrets.token_bytes(32)
+        # moving average of the duration of uncached lookups,
+        # to estimate the time saved by cache hits
+        self._miss_seconds = None
+        # invalidation may come from database events in db executor threads
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, token):
+        return hmac.digest(self._secret, token.encode("utf8", "replace"), "sha256")
+
+    def _get(self, db, key):
+        """Get the token for a cache key, if the entry is still valid"""
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at is not None and entry.expires_at < orm.APIToken.now():
+            with self._lock:
+                self._cache.pop(key)
+            return None
+        # by primary key, so no query if the token is already in the session
+        orm_token = db.get(orm.APIToken, entry.token_id)
+        if (
+            orm_token is None
+            or inspect(orm_token).deleted
+            or orm_token.user_id != entry.user_id
+            or orm_token.service_id != entry.service_id
+        ):
+            with self._lock:
+                self._cache.pop(key)
+            return None
+        return orm_token
+
+    def get(self, db, token):
+        """Get a token object from the cache
+
+        Returns None on a miss, without looking up the token in the database.
+        """
+        tic = time.perf_counter()
+        orm_token = self._get(db, self._key(token))
+        if orm_token is not None:
+            API_TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.hit).inc()
+            if self._miss_seconds is not None:
+                saved = self._miss_seconds - (time.perf_counter() - tic)
+                if saved > 0:
+                    API_TOKEN_CACHE_SAVED_SECONDS.inc(saved)
+        return orm_token
+
+    def add(self, token, orm_token, duration):
+        """Record the result of looking up a token that wasn't in the cache
+
+        `duration` is the time the lookup took.
+        """
+        API_TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.miss).inc()
+        if self._miss_seconds is None:
+            self._miss_seconds = duration
+        else:
+            self._miss_seconds = 0.9 * self._miss_seconds + 0.1 * duration
+        if orm_token is not None:
+            entry = _Entry(
+                orm_token.id,
+                orm_token.user_id,
+                orm_token.service_id,
+                orm_token.expires_at,
+            )
+            with self._lock:
+                self._cache.set(self._key(token), entry)
+
+    def find(self, db, token):
+        """Find a token object by value, like :meth:`.APIToken.find`
+
+        Returns None if not found.
+        """
+        orm_token = self.get(db, token)
+        if orm_token is not None:
+            return orm_token
+        tic = time.perf_counter()
+        orm_token = orm.APIToken.find(db, token)
+        self.add(token, orm_token, time.perf_counter() - tic)
+        return orm_token
+
+    def invalidate(self, token_id):
+        """Remove the entry for a token id"""
+        with self._lock:
+            for key, entry in self._cache.items():
+                if entry.token_id == token_id:
+                    self._cache.pop(key)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._cache.clear()
+
+
+def _invalidate_token(target):
+    if target.id is None:
+        return
+    for cache in list(_caches):
+        cache.invalidate(target.id)
+
+
+def _clear_all():
+    for cache in list(_caches):
+        cache.clear()
+
+
+@event.listens_for(orm.APIToken, "after_delete")
+def _token_deleted(mapper, connection, target):
+    _invalidate_token(target)
+
+
+for _attr in ("scopes", "expires_at", "hashed", "user_id", "service_id"):
+    event.listen(
+        getattr(orm.APIToken, _attr),
+        "set",
+        lambda target, value, oldvalue, initiator: _invalidate_token(target),
+    )
+
+
+# tokens may be deleted in the database by cascade when their owner is deleted
+for _cls in (orm.User, orm.Service, orm.OAuthClient):
+    event.listen(_cls, "after_delete", lambda mapper, connection, target: _clear_all())
+
+
+# bulk DELETEs (e.g. purging expired tokens) don't emit mapper events,
+# and we don't know which tokens they delete
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_delete(orm_execute_state):
+    if orm_execute_state.is_delete and orm_execute_state.bind_mapper is inspect(
+        orm.APIToken
+    ):
+        _clear_all()
@@ -0,0 +1,129 @@
+"""Write-behind buffer for last_activity updates
+
+Every authenticated request and every activity report from a single-user server
+may update the last_activity of a user, server, or token.
+Committing each of these separately results in lots of tiny transactions.
+:class:`ActivityBuffer` keeps the most recent timestamp per object in memory
+and writes them all in one transaction, periodically and on shutdown.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+from collections import defaultdict
+
+from sqlalchemy import bindparam, or_
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.attributes import set_committed_value
+from tornado.log import app_log
+
+
+def _write_activity(db, pending):
+    """Write buffered last_activity timestamps, on the db executor
+
+    Args:
+        pending (dict): orm class -> {id: last_activity}
+    """
+    for cls, updates in pending.items():
+        table = cls.__table__
+        # one executemany UPDATE per table,
+        # never moving last_activity backward
+        db.execute(
+            table.update()
+            .where(table.c.id == bindparam("_id"))
+            .where(
+                or_(
+                    table.c.last_activity.is_(None),
+                    table.c.last_activity < bindparam("_last_activity"),
+                )
+            )
+            .values(last_activity=bindparam("_last_activity")),
+            [{"_id": id, "_last_activity": dt} for id, dt in updates.items()],
+        )
+
+
+class ActivityBuffer:
+    """Coalesce last_activity updates in memory
+
+    Only the most recent timestamp for each user, server, and token is kept.
+    Objects in the Hub's session are updated immediately,
+    without marking them as modified,
+    so the Hub (and its API) sees the new activity before it is written.
+
+    Args:
+        db_executor (DatabaseExecutor): executor to write updates with
+        enabled (bool): if False, activity is assigned to objects directly
+            and written with the next commit of the session,
+            as if there were no buffer.
+
+    .. versionadded:: 6.0
+    """
+
+    def __init__(self, db_executor, enabled=True, log=None):
+        self.db_executor = db_executor
+        self.enabled = enabled
+        self.log = log or app_log
+        self._pending = defaultdict(dict)
+
+    def __len__(self):
+        return sum(len(updates) for updates in self._pending.values())
+
+    def __contains__(self, obj):
+        """Whether an ORM object has buffered activity"""
+        return obj.id in self._pending.get(type(obj), ())
+
+    def record(self, obj, timestamp):
+        """Record activity on an object
+
+        Args:
+            obj: a User, Spawner, or APIToken (ORM objects or their wrappers)
+            timestamp (datetime): the naive UTC timestamp of the activity
+        Returns:
+            needs_commit (bool): True if the object was modified in the session
+                and the caller needs to commit,
+                False if the activity is written later by the buffer.
+        """
+        obj = getattr(obj, 'orm_user', obj)
+        obj = getattr(obj, 'orm_spawner', obj)
+        if not self.enabled or obj.id is None:
+            # not in the database yet, set the value for the next flush of the session
+            obj.last_activity = timestamp
+            return True
+        pending = self._pending[type(obj)]
+        if obj.id not in pending or pending[obj.id] < timestamp:
+            pending[obj.id] = timestamp
+        if obj.last_activity is None or obj.last_activity < timestamp:
+            set_committed_value(obj, "last_activity", timestamp)
+        return False
+
+    async def flush(self):
+        """Write all buffered activity in one transaction
+
+        Returns True if the activity was written (or there was nothing to write),
+        False on database error, in which case the activity stays buffered
+        for the next flush.
+        """
+        if not self._pending:
+            return True
+        pending = dict(self._pending)
+        self._pending = defaultdict(dict)
+        executor = self.db_executor
+        try:
+            await executor.run(_write_activity, pending)
+            if not executor.threaded:
+                executor.db.commit()
+        except SQLAlchemyError:
+            self.log.exception("Failed to write buffered activity")
+            if not executor.threaded:
+                executor.db.rollback()
+            # merge back, keeping activity recorded since the flush started
+            for cls, updates in pending.items():
+                buffered = self._pending[cls]
+                for id, dt in updates.items():
+                    if id not in buffered or buffered[id] < dt:
+                        buffered[id] = dt
+            return False
+        self.log.debug(
+            "Wrote buffered activity for %i objects",
+            sum(len(updates) for updates in pending.values()),
+        )
+        return True
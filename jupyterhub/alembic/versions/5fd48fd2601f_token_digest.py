@@ -0,0 +1,40 @@
+"""Add digest column for exact-match lookup of generated tokens
+
+Revision ID: 5fd48fd2601f
+Revises: f460b0348206
+Create Date: 2026-10-16 21:40:12.482913
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5fd48fd2601f'
+down_revision = 'f460b0348206'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+from alembic import op
+
+# existing tokens can't be given a digest, since we don't have the tokens themselves.
+# They are still found by prefix until they expire or are replaced.
+tables = ('api_tokens', 'share_codes')
+
+
+def upgrade():
+    engine = op.get_bind().engine
+    existing_tables = sa.inspect(engine).get_table_names()
+    for table in tables:
+        if table not in existing_tables:
+            continue
+        op.add_column(table, sa.Column('digest', sa.Unicode(length=255), nullable=True))
+        op.create_index(op.f(f'ix_{table}_digest'), table, ['digest'], unique=True)
+
+
+def downgrade():
+    engine = op.get_bind().engine
+    existing_tables = sa.inspect(engine).get_table_names()
+    for table in tables:
+        if table not in existing_tables:
+            continue
+        op.drop_index(op.f(f'ix_{table}_digest'), table_name=table)
+        op.drop_column(table, 'digest')
@@ -15,7 +15,7 @@ depends_on = None
 import sqlalchemy as sa
 from alembic import op
 from sqlalchemy import Column, ForeignKey, Table, text
-from sqlalchemy.orm import raiseload, relationship, selectinload
+from sqlalchemy.orm import defer, raiseload, relationship, selectinload
 from sqlalchemy.orm.session import Session
 
 from jupyterhub import orm, roles
@@ -86,6 +86,8 @@ def upgrade():
             db = Session(bind=c)
 
             for token in db.query(orm.APIToken).options(
+                # the digest column isn't added until a subsequent db upgrade
+                defer(orm.APIToken.digest),
                 selectinload(orm.APIToken.roles).defer(orm.Role.managed_by_auth),
                 raiseload("*"),
             ):
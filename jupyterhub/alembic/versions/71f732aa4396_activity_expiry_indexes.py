@@ -0,0 +1,43 @@
+"""Add indexes for activity, expiry and server lookups
+
+Revision ID: 71f732aa4396
+Revises: 5fd48fd2601f
+Create Date: 2026-10-16 22:05:31.904127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '71f732aa4396'
+down_revision = '5fd48fd2601f'
+branch_labels = None
+depends_on = None
+
+import sqlalchemy as sa
+from alembic import op
+
+indexes = [
+    ('users', 'last_activity'),
+    ('spawners', 'server_id'),
+    ('api_tokens', 'expires_at'),
+    ('oauth_codes', 'expires_at'),
+    ('shares', 'expires_at'),
+    ('share_codes', 'expires_at'),
+]
+
+
+def upgrade():
+    engine = op.get_bind().engine
+    tables = sa.inspect(engine).get_table_names()
+    for table, column in indexes:
+        if table not in tables:
+            continue
+        op.create_index(op.f(f'ix_{table}_{column}'), table, [column])
+
+
+def downgrade():
+    engine = op.get_bind().engine
+    tables = sa.inspect(engine).get_table_names()
+    for table, column in indexes:
+        if table not in tables:
+            continue
+        op.drop_index(op.f(f'ix_{table}_{column}'), table_name=table)
@@ -2,12 +2,15 @@
 
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
+import base64
+import binascii
 import json
 import warnings
 from functools import lru_cache
 from http.client import responses
 from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
+from sqlalchemy import and_, or_
 from sqlalchemy.exc import SQLAlchemyError
 from tornado import web
 
@@ -20,6 +23,81 @@ from ..utils import isoformat, url_escape_path, url_path_join
 PAGINATION_MEDIA_TYPE = "application/jupyterhub-pagination+json"
 
 
+def encode_cursor(sort, value, id):
+    """Encode the position after a row in a sorted list as an opaque cursor
+
+    `sort` is the sort parameter of the request,
+    so cursors can't be used with a different sort order.
+    `value` is the (JSON-serializable) value of the sort key for the row,
+    and `id` its id, which breaks ties.
+    """
+    data = json.dumps([sort, value, id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort, value_types=(int,)):
+    """Decode a cursor from :func:`encode_cursor`
+
+    `value_types` are the allowed types of the sort value
+    (include ``type(None)`` for nullable columns).
+
+    Returns (value, id).
+    Raises 400 if the cursor is invalid or for a different sort order.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, id = json.loads(data)
+    except (binascii.Error, ValueError, TypeError):
+        raise web.HTTPError(400, f"Invalid pagination cursor: {cursor!r}")
+    # exact type checks, because bool is a subclass of int
+    if cursor_sort != sort or type(id) is not int or type(value) not in value_types:
+        raise web.HTTPError(400, f"Invalid pagination cursor for sort={sort}")
+    return value, id
+
+
+def keyset_filter(column, id_column, direction, value, id):
+    """Filter for the rows after (value, id) in a sorted query
+
+    For queries sorted by `column` in `direction` ('asc' or 'desc')
+    and then by `id_column` in the same direction,
+    with NULLs first in ascending order and last in descending order.
+
+    This is what makes cursor pagination fast:
+    the database can seek directly to the start of the page in an index,
+    instead of counting rows to skip with OFFSET.
+    """
+    if direction == "asc":
+        if value is None:
+            return or_(
+                and_(column.is_(None), id_column > id),
+                column.is_not(None),
+            )
+        return and_(
+            column.is_not(None),
+            or_(column > value, and_(column == value, id_column > id)),
+        )
+    elif direction == "desc":
+        if value is None:
+            return and_(column.is_(None), id_column < id)
+        return or_(
+            column < value,
+            and_(column == value, id_column < id),
+            column.is_(None),
+        )
+    else:
+        raise ValueError(f"direction must be 'asc' or 'desc', got '{direction}'")
+
+
+def _scalar(db, statement):
+    """Get the single result of a statement, for the db executor"""
+    return db.execute(statement).scalar()
+
+
+def _scalars(db, statement):
+    """Get the first column of all results of a statement, for the db executor"""
+    return db.execute(statement).scalars().all()
+
+
 class APIHandler(BaseHandler):
     """Base class for API endpoints
 
@@ -281,11 +359,15 @@ class APIHandler(BaseHandler):
             ).lower() not in {"0", "false"}
         return self._include_stopped_servers
 
-    def user_model(self, user):
+    def user_model(self, user, readable_servers=None):
         """Get the JSON model for a User object
 
         User may be either a high-level User wrapper,
         or a low-level orm.User.
+
+        readable_servers, if given, is the set of Spawner ids
+        the request may read (e.g. selected with :func:`.scopes.scope_filter_clause`),
+        instead of checking the read:servers scope for each server.
         """
         is_orm = False
         if isinstance(user, orm.User):
@@ -353,7 +435,14 @@ class APIHandler(BaseHandler):
                 model['pending'] = spawners[''].pending
 
             servers = {}
-            scope_filter = self.get_scope_filter('read:servers')
+            if readable_servers is None:
+                scope_filter = self.get_scope_filter('read:servers')
+            else:
+
+                def scope_filter(spawner, kind):
+                    orm_spawner = getattr(spawner, 'orm_spawner', spawner)
+                    return orm_spawner.id in readable_servers
+
             for name, spawner in spawners.items():
                 # include 'active' servers, not just ready
                 # (this includes pending events)
@@ -529,7 +618,61 @@ class APIHandler(BaseHandler):
             )
         return offset, limit
 
-    def paginated_model(self, items, offset, limit, total_count):
+    def get_api_cursor(self, sort="id", value_types=(int,)):
+        """Get the `after` cursor of a paginated request, if any
+
+        Only for collections that support cursor pagination.
+
+        Returns (value, id) of the last row of the previous page,
+        or None if the request doesn't use a cursor.
+        """
+        after = self.get_argument("after", None)
+        if not after:
+            return None
+        if self.get_argument("offset", None) not in {None, "", "0"}:
+            raise web.HTTPError(400, "Cannot specify both offset and after")
+        return decode_cursor(after, sort, value_types)
+
+    def get_include_count(self):
+        """Whether to count the total number of results (`include_count`)
+
+        Counting can be expensive for large collections,
+        and isn't needed to follow the `next` cursor.
+        """
+        include_count = self.get_argument("include_count", "true").lower()
+        if include_count in {"true", "1", ""}:
+            return True
+        elif include_count in {"false", "0"}:
+            return False
+        raise web.HTTPError(
+            400, f"include_count must be true or false, not {include_count!r}"
+        )
+
+    async def get_total_count(self, count_statement):
+        """Count the total results of a paginated query
+
+        Returns None if `include_count=false`.
+        Counts are run on the db executor (with the read replica, if any),
+        and cached if `JupyterHub.api_page_count_cache_ttl` is set.
+        """
+        if not self.get_include_count():
+            return None
+        cache = self.settings.get("api_page_count_cache")
+        if cache is not None:
+            # the statement includes all filters, including the scopes of the request
+            compiled = count_statement.compile()
+            key = (str(compiled), repr(sorted(compiled.params.items())))
+            total_count = cache.get(key)
+            if total_count is not None:
+                return total_count
+        total_count = await self.run_db_read(_scalar, count_statement)
+        if cache is not None:
+            cache.set(key, total_count)
+        return total_count
+
+    def paginated_model(
+        self, items, offset, limit, total_count, next_cursor=None, has_next=None
+    ):
         """Return the paginated form of a collection (list or dict)
 
         A dict with { items: [], _pagination: {}}
@@ -539,8 +682,22 @@ class APIHandler(BaseHandler):
         the total number of results for the query,
         and information about how to build the next page request
         if there is one.
+
+        `total_count` may be None if the count was skipped with `include_count=false`,
+        in which case `has_next` must be given.
+        `next_cursor` is the cursor for the next page (see :func:`encode_cursor`),
+        for collections that support cursor pagination with `after`.
+        When the request uses a cursor, offsets are not known
+        and reported as None.
         """
-        next_offset = offset + limit
+        cursor_request = bool(self.get_argument("after", None))
+        if cursor_request:
+            offset = None
+            next_offset = None
+        else:
+            next_offset = offset + limit
+        if has_next is None:
+            has_next = next_offset is not None and next_offset < total_count
         data = {
             "items": items,
             "_pagination": {
@@ -550,11 +707,15 @@ class APIHandler(BaseHandler):
                 "next": None,
             },
         }
-        if next_offset < total_count:
+        if has_next:
             # if there's a next page
             next_url_parsed = urlparse(self.request.full_url())
             query = parse_qs(next_url_parsed.query, keep_blank_values=True)
-            query['offset'] = [next_offset]
+            if cursor_request:
+                query.pop('offset', None)
+                query['after'] = [next_cursor]
+            else:
+                query['offset'] = [next_offset]
             query['limit'] = [limit]
             next_url_parsed = next_url_parsed._replace(
                 query=urlencode(query, doseq=True)
@@ -565,6 +726,8 @@ class APIHandler(BaseHandler):
                 "limit": limit,
                 "url": next_url,
             }
+            if next_cursor is not None:
+                data["_pagination"]["next"]["after"] = next_cursor
         return data
 
     def options(self, *args, **kwargs):
@@ -5,11 +5,12 @@
 import json
 from warnings import warn
 
+from sqlalchemy import func, select
 from tornado import web
 
 from .. import orm
-from ..scopes import Scope, needs_scope
-from .base import APIHandler
+from ..scopes import Scope, needs_scope, scope_filter_clause
+from .base import APIHandler, _scalars, encode_cursor
 
 
 class _GroupAPIHandler(APIHandler):
@@ -47,9 +48,9 @@ class _GroupAPIHandler(APIHandler):
 
 class GroupListAPIHandler(_GroupAPIHandler):
     @needs_scope('list:groups', post_filter=True)
-    def get(self):
+    async def get(self):
         """List groups"""
-        query = full_query = self.db.query(orm.Group)
+        query = self.db.query(orm.Group)
         sub_scope = self.parsed_scopes['list:groups']
         if sub_scope != Scope.ALL:
             if not set(sub_scope).issubset({'group'}):
@@ -59,17 +60,43 @@ class GroupListAPIHandler(_GroupAPIHandler):
                     f"Invalid filter on list:group for {self.current_user}: {sub_scope}"
                 )
                 raise web.HTTPError(403)
-            query = query.filter(orm.Group.name.in_(sub_scope['group']))
+            query = query.filter(scope_filter_clause(sub_scope, 'group'))
 
         offset, limit = self.get_api_pagination()
-        query = query.order_by(orm.Group.id.asc()).offset(offset).limit(limit)
-        group_list = [self.group_model(g) for g in query]
-        total_count = full_query.count()
+        cursor = self.get_api_cursor()
+        count_statement = select(func.count()).select_from(
+            query.with_entities(orm.Group.id).statement.subquery()
+        )
+        page_query = query.with_entities(orm.Group.id).order_by(orm.Group.id.asc())
+        if cursor is not None:
+            _, last_id = cursor
+            page_query = page_query.filter(orm.Group.id > last_id)
+        else:
+            page_query = page_query.offset(offset)
+        # find the ids on the page (and one more, to tell if there's a next page),
+        # then load them in the shared session
+        ids = await self.run_db_read(_scalars, page_query.limit(limit + 1).statement)
+        has_next = len(ids) > limit
+        ids = ids[:limit]
+        by_id = {obj.id: obj for obj in query.filter(orm.Group.id.in_(ids))}
+        groups = [by_id[id] for id in ids if id in by_id]
+        group_list = [self.group_model(g) for g in groups]
+        total_count = await self.get_total_count(count_statement)
+        next_cursor = None
+        if has_next:
+            next_cursor = encode_cursor("id", ids[-1], ids[-1])
         if self.accepts_pagination:
-            data = self.paginated_model(group_list, offset, limit, total_count)
+            data = self.paginated_model(
+                group_list,
+                offset,
+                limit,
+                total_count,
+                next_cursor=next_cursor,
+                has_next=has_next,
+            )
         else:
-            query_count = query.count()
-            if offset == 0 and total_count > query_count:
+            query_count = len(groups)
+            if offset == 0 and cursor is None and has_next:
                 self.log.warning(
                     f"Truncated group list in request that does not expect pagination. Replying with {query_count} of {total_count} total groups."
                 )
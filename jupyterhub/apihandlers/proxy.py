@@ -19,6 +19,11 @@ class ProxyAPIHandler(APIHandler):
         but without clients needing to maintain separate
         """
         offset, limit = self.get_api_pagination()
+        if self.get_argument("after", None):
+            # routes come from the proxy, there's no index to seek with a cursor
+            raise web.HTTPError(
+                400, "Proxy routes don't support pagination with 'after', use offset"
+            )
 
         all_routes = await self.proxy.get_all_routes()
 
@@ -34,6 +39,8 @@ class ProxyAPIHandler(APIHandler):
                     break
                 routes[key] = all_routes[key]
 
+        # routes may be any mapping, e.g. proxy.Route
+        routes = {routespec: dict(route) for routespec, route in routes.items()}
         if self.accepts_pagination:
             data = self.paginated_model(routes, offset, limit, len(all_routes))
         else:
@@ -14,7 +14,7 @@ from pydantic import (
     field_validator,
     model_validator,
 )
-from sqlalchemy import or_
+from sqlalchemy import func, or_, select
 from sqlalchemy.orm import joinedload
 from tornado import web
 from tornado.httputil import url_concat
@@ -22,7 +22,7 @@ from tornado.httputil import url_concat
 from .. import orm
 from ..scopes import _check_scopes_exist, needs_scope
 from ..utils import isoformat
-from .base import APIHandler
+from .base import APIHandler, _scalars, encode_cursor
 from .groups import _GroupAPIHandler
 
 _share_code_id_pat = re.compile(r"sc_(\d+)")
@@ -163,9 +163,10 @@ class _ShareAPIHandler(APIHandler):
             )
         return query
 
-    def _share_list_model(self, query, kind="share"):
+    async def _share_list_model(self, query, kind="share"):
         """Finish a share query, returning the _model_"""
         offset, limit = self.get_api_pagination()
+        cursor = self.get_api_cursor()
         if kind == "share":
             model_method = self.share_model
         elif kind == "code":
@@ -180,10 +181,35 @@ class _ShareAPIHandler(APIHandler):
         elif kind == "code":
             class_ = orm.ShareCode
 
-        total_count = query.count()
-        query = query.order_by(class_.id.asc()).offset(offset).limit(limit)
-        share_list = [model_method(share) for share in query if not share.expired]
-        return self.paginated_model(share_list, offset, limit, total_count)
+        count_statement = select(func.count()).select_from(
+            query.with_entities(class_.id).statement.subquery()
+        )
+        page_query = query.with_entities(class_.id).order_by(class_.id.asc())
+        if cursor is not None:
+            _, last_id = cursor
+            page_query = page_query.filter(class_.id > last_id)
+        else:
+            page_query = page_query.offset(offset)
+        # find the ids on the page (and one more, to tell if there's a next page),
+        # then load them in the shared session
+        ids = await self.run_db_read(_scalars, page_query.limit(limit + 1).statement)
+        has_next = len(ids) > limit
+        ids = ids[:limit]
+        by_id = {obj.id: obj for obj in query.filter(class_.id.in_(ids))}
+        shares = [by_id[id] for id in ids if id in by_id]
+        share_list = [model_method(share) for share in shares if not share.expired]
+        total_count = await self.get_total_count(count_statement)
+        next_cursor = None
+        if has_next:
+            next_cursor = encode_cursor("id", ids[-1], ids[-1])
+        return self.paginated_model(
+            share_list,
+            offset,
+            limit,
+            total_count,
+            next_cursor=next_cursor,
+            has_next=has_next,
+        )
 
     def _lookup_spawner(self, user_name, server_name, raise_404=True):
         """Lookup orm.Spawner for user_name/server_name
@@ -206,7 +232,7 @@ class UserShareListAPIHandler(_ShareAPIHandler):
     """
 
     @needs_scope("read:users:shares")
-    def get(self, user_name):
+    async def get(self, user_name):
         user = self.find_user(user_name)
         if user is None:
             raise web.HTTPError(404, f"No such user: {user_name}")
@@ -218,7 +244,7 @@ class UserShareListAPIHandler(_ShareAPIHandler):
                 orm.Share.group_id.in_([group.id for group in user.groups]),
             )
         query = query.filter(filter)
-        self.finish(json.dumps(self._share_list_model(query)))
+        self.finish(json.dumps(await self._share_list_model(query)))
 
 
 class UserShareAPIHandler(_ShareAPIHandler):
@@ -262,11 +288,11 @@ class GroupShareListAPIHandler(_ShareAPIHandler, _GroupAPIHandler):
     """List shares granted to a group"""
 
     @needs_scope("read:groups:shares")
-    def get(self, group_name):
+    async def get(self, group_name):
         group = self.find_group(group_name)
         query = self._init_share_query()
         query = query.filter(orm.Share.group == group)
-        self.finish(json.dumps(self._share_list_model(query)))
+        self.finish(json.dumps(await self._share_list_model(query)))
 
 
 class GroupShareAPIHandler(_ShareAPIHandler, _GroupAPIHandler):
@@ -310,7 +336,7 @@ class ServerShareAPIHandler(_ShareAPIHandler):
     """
 
     @needs_scope("read:shares")
-    def get(self, user_name, server_name=None):
+    async def get(self, user_name, server_name=None):
         """List all shares for a given owner"""
 
         # TODO: optimize this query
@@ -331,7 +357,7 @@ class ServerShareAPIHandler(_ShareAPIHandler):
                 raise web.HTTPError(404)
             owner_id = row[0]
             query = query.filter_by(owner_id=owner_id)
-        self.finish(json.dumps(self._share_list_model(query)))
+        self.finish(json.dumps(await self._share_list_model(query)))
 
     @needs_scope('shares')
     async def post(self, user_name, server_name=None):
@@ -461,7 +487,7 @@ class ServerShareCodeAPIHandler(_ShareAPIHandler):
     """
 
     @needs_scope("read:shares")
-    def get(self, user_name, server_name=None):
+    async def get(self, user_name, server_name=None):
         """List all share codes for a given owner"""
 
         query = self._init_share_query(kind="code")
@@ -480,7 +506,7 @@ class ServerShareCodeAPIHandler(_ShareAPIHandler):
         else:
             spawner = self._lookup_spawner(user_name, server_name)
             query = query.filter_by(spawner_id=spawner.id)
-        self.finish(json.dumps(self._share_list_model(query, kind="code")))
+        self.finish(json.dumps(await self._share_list_model(query, kind="code")))
 
     @needs_scope('shares')
     async def post(self, user_name, server_name=None):
@@ -6,10 +6,10 @@ import asyncio
 import inspect
 import json
 from contextlib import aclosing
-from datetime import timedelta, timezone
+from datetime import datetime, timedelta, timezone
 
 from dateutil.parser import parse as parse_date
-from sqlalchemy import func, or_
+from sqlalchemy import func, select
 from sqlalchemy.orm import joinedload, raiseload, selectinload  # noqa
 from tornado import web
 from tornado.iostream import StreamClosedError
@@ -28,7 +28,17 @@ from ..utils import (
     url_path_join,
     utcnow,
 )
-from .base import APIHandler
+from .base import APIHandler, encode_cursor, keyset_filter
+
+
+def _page_rows(db, page_statement):
+    """Get the (id, sort key) rows on a page, for the db executor"""
+    return [tuple(row) for row in db.execute(page_statement)]
+
+
+def _spawner_ids(db, statement):
+    """Get the set of Spawner ids selected by a statement, for the db executor"""
+    return {spawner_id for (spawner_id,) in db.execute(statement)}
 
 
 class SelfAPIHandler(APIHandler):
@@ -90,7 +100,7 @@ class UserListAPIHandler(APIHandler):
         return any(spawner.ready for spawner in user.spawners.values())
 
     @needs_scope('list:users', post_filter=True)
-    def get(self):
+    async def get(self):
         state_filter = self.get_argument("state", None)
         name_filter = self.get_argument("name_filter", None)
         sort = sort_by_param = self.get_argument("sort", "id")
@@ -108,12 +118,24 @@ class UserListAPIHandler(APIHandler):
                 400,
                 f"sort must be 'id', 'name', or 'last_activity', not '{sort_by_param}'",
             )
+        # last_activity is stored in cursors as an isoformat string
+        cursor_value_types = {
+            "id": (int,),
+            "name": (str,),
+            "last_activity": (str, type(None)),
+        }[sort]
+        cursor = self.get_api_cursor(sort_by_param, cursor_value_types)
 
         # NULL is sorted inconsistently, so make it explicit
+        # and sort by id last, so the order is stable for cursors
         if sort_direction == "asc":
-            sort_order = (sort_column.is_not(None), sort_column.asc())
+            sort_order = (
+                sort_column.is_not(None),
+                sort_column.asc(),
+                orm.User.id.asc(),
+            )
         elif sort_direction == "desc":
-            sort_order = (sort_column.is_(None), sort_column.desc())
+            sort_order = (sort_column.is_(None), sort_column.desc(), orm.User.id.desc())
         else:
             # this can't happen, users don't specify direction
             raise ValueError(
@@ -160,59 +182,107 @@ class UserListAPIHandler(APIHandler):
         elif state_filter:
             raise web.HTTPError(400, f"Unrecognized state filter: {state_filter!r}")
 
-        # apply eager load options
-        query = query.options(
-            selectinload(orm.User.roles),
-            selectinload(orm.User.groups),
-            joinedload(orm.User._orm_spawners).joinedload(orm.Spawner.user),
-            # raiseload here helps us make sure we've loaded everything in one query
-            # but since we share a single db session, we can't do this for real
-            # but it's useful in testing
-            # raiseload("*"),
-        )
-
         sub_scope = self.parsed_scopes['list:users']
         if sub_scope != scopes.Scope.ALL:
-            if not set(sub_scope).issubset({'group', 'user'}):
-                # don't expand invalid !server=x filter to all users!
+            if not set(sub_scope).issubset({'group', 'user', 'server'}):
+                # don't expand invalid !service=x filter to all users!
                 self.log.warning(
                     f"Invalid filter on list:user for {self.current_user}: {sub_scope}"
                 )
                 raise web.HTTPError(403)
-            filters = []
-            if 'user' in sub_scope:
-                filters.append(orm.User.name.in_(sub_scope['user']))
-            if 'group' in sub_scope:
-                filters.append(
-                    orm.User.groups.any(
-                        orm.Group.name.in_(sub_scope['group']),
-                    )
-                )
-
-            if len(filters) == 1:
-                query = query.filter(filters[0])
-            else:
-                query = query.filter(or_(*filters))
+            # !server filters select no users (see check_scope_filter),
+            # only their !user and !group parts do
+            query = query.filter(scopes.scope_filter_clause(sub_scope, 'user'))
 
         if name_filter:
             query = query.filter(orm.User.name.ilike(f'%{name_filter}%'))
 
-        full_query = query
-        query = query.order_by(*sort_order).offset(offset).limit(limit)
+        count_statement = select(func.count()).select_from(
+            query.with_entities(orm.User.id).statement.subquery()
+        )
+        page_query = query.with_entities(orm.User.id, sort_column).order_by(*sort_order)
+        if cursor is not None:
+            value, last_id = cursor
+            if sort == "last_activity" and value is not None:
+                try:
+                    value = datetime.fromisoformat(value)
+                except (TypeError, ValueError):
+                    raise web.HTTPError(400, "Invalid pagination cursor")
+            page_query = page_query.filter(
+                keyset_filter(sort_column, orm.User.id, sort_direction, value, last_id)
+            )
+        else:
+            page_query = page_query.offset(offset)
+
+        # find the ids on the page and the total count on the db executor,
+        # then load the users for the page in the shared session.
+        # Get one more row than the page to tell if there's a next page.
+        page_statement = page_query.limit(limit + 1).statement
+        rows = await self.run_db_read(_page_rows, page_statement)
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        user_ids = [user_id for user_id, _ in rows]
+        total_count = await self.get_total_count(count_statement)
+        next_cursor = None
+        if has_next:
+            last_id, value = rows[-1]
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            next_cursor = encode_cursor(sort_by_param, value, last_id)
+
+        # apply eager load options
+        query = (
+            self.db.query(orm.User)
+            .filter(orm.User.id.in_(user_ids))
+            .options(
+                selectinload(orm.User.roles),
+                selectinload(orm.User.groups),
+                joinedload(orm.User._orm_spawners).joinedload(orm.Spawner.user),
+                # raiseload here helps us make sure we've loaded everything in one query
+                # but since we share a single db session, we can't do this for real
+                # but it's useful in testing
+                # (or set JupyterHub.db_query_log_threshold to see queries in the logs)
+                # raiseload("*"),
+            )
+        )
+        users_by_id = {u.id: u for u in query}
+
+        # check read access to the servers on the page in one query,
+        # instead of for each server
+        readable_servers = None
+        server_scope = self.parsed_scopes.get('read:servers')
+        if server_scope is not None and server_scope != scopes.Scope.ALL:
+            readable_servers = await self.db_executor.run(
+                _spawner_ids,
+                select(orm.Spawner.id).where(
+                    orm.Spawner.user_id.in_(user_ids),
+                    scopes.scope_filter_clause(server_scope, 'server'),
+                ),
+            )
 
         user_list = []
-        for u in query:
+        for user_id in user_ids:
+            u = users_by_id.get(user_id)
+            if u is None:
+                # deleted since the page was computed
+                continue
             if post_filter is None or post_filter(u):
-                user_model = self.user_model(u)
+                user_model = self.user_model(u, readable_servers=readable_servers)
                 if user_model:
                     user_list.append(user_model)
 
-        total_count = full_query.count()
         if self.accepts_pagination:
-            data = self.paginated_model(user_list, offset, limit, total_count)
+            data = self.paginated_model(
+                user_list,
+                offset,
+                limit,
+                total_count,
+                next_cursor=next_cursor,
+                has_next=has_next,
+            )
         else:
-            query_count = query.count()
-            if offset == 0 and total_count > query_count:
+            query_count = len(user_ids)
+            if offset == 0 and cursor is None and has_next:
                 self.log.warning(
                     f"Truncated user list in request that does not expect pagination. Processing {query_count} of {total_count} total users."
                 )
@@ -988,6 +1058,7 @@ class SpawnProgressAPIHandler(APIHandler):
 
     def on_finish(self):
         self._finish_future.set_result(None)
+        super().on_finish()
 
     async def keepalive(self):
         """Write empty lines periodically
@@ -1196,6 +1267,7 @@ class ActivityAPIHandler(APIHandler):
             # is valid and contains only servers that exist
             # and last_activity is defined and a valid datetime object
 
+        needs_commit = False
         # update user.last_activity if specified
         if last_activity_timestamp:
             last_activity = _parse_timestamp(last_activity_timestamp)
@@ -1203,7 +1275,7 @@ class ActivityAPIHandler(APIHandler):
                 self.log.debug(
                     "Activity for user %s: %s", user.name, isoformat(last_activity)
                 )
-                user.last_activity = last_activity
+                needs_commit = self._set_activity(user, last_activity)
             else:
                 self.log.debug(
                     "Not updating activity for %s: %s < %s",
@@ -1224,7 +1296,9 @@ class ActivityAPIHandler(APIHandler):
                         server_name,
                         isoformat(last_activity),
                     )
-                    spawner.last_activity = last_activity
+                    needs_commit = (
+                        self._set_activity(spawner, last_activity) or needs_commit
+                    )
                 else:
                     self.log.debug(
                         "Not updating server activity on %s/%s: %s < %s",
@@ -1234,7 +1308,8 @@ class ActivityAPIHandler(APIHandler):
                         isoformat(spawner.last_activity),
                     )
 
-        self.db.commit()
+        if needs_commit:
+            self.db.commit()
 
 
 default_handlers = [
@@ -30,8 +30,11 @@ import tornado.options
 from dateutil.parser import parse as parse_date
 from jinja2 import ChoiceLoader, Environment, FileSystemLoader, PrefixLoader
 from jupyter_events.logger import EventLogger
+from sqlalchemy import bindparam, inspect, or_
 from sqlalchemy.exc import OperationalError, SQLAlchemyError
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
 from tornado import gen, web
 from tornado.httpclient import AsyncHTTPClient
 from tornado.ioloop import IOLoop, PeriodicCallback
@@ -60,20 +63,27 @@ here = os.path.dirname(__file__)
 
 import jupyterhub
 
-from . import apihandlers, crypto, dbutil, handlers, orm, roles, scopes
+from . import _authz_cache, apihandlers, crypto, dbutil, handlers, orm, roles, scopes
 from ._data import DATA_FILES_PATH
+from ._memoize import LRUCache, memoized_caches
+from ._token_cache import APITokenCache
+from .activity import ActivityBuffer
 
 # classes for config
 from .auth import Authenticator, PAMAuthenticator
 from .crypto import CryptKeeper
+from .dbexecutor import DatabaseExecutor
 
 # For faking stats
 from .handlers.static import CacheControlStaticFilesHandler, LogoHandler
 from .httpclient import JupyterHubHTTPClient
 from .log import CoroutineLogFormatter, log_request
 from .metrics import (
+    DB_SESSION_OBJECTS,
     HUB_STARTUP_DURATION_SECONDS,
     INIT_SPAWNERS_DURATION_SECONDS,
+    PURGE_EXPIRED_DELETED,
+    PURGE_EXPIRED_DURATION_SECONDS,
     RUNNING_SERVERS,
     TOTAL_USERS,
     PeriodicMetricsCollector,
@@ -283,7 +293,7 @@ class JupyterHub(Application):
 
     @default('classes')
     def _load_classes(self):
-        classes = {Spawner, Authenticator, CryptKeeper}
+        classes = {Spawner, Authenticator, CryptKeeper, DatabaseExecutor}
         for name, trait in self.traits(config=True).items():
             # load entry point groups into configurable class list
             # so that they show up in config files, etc.
@@ -532,6 +542,122 @@ class JupyterHub(Application):
     last_activity_interval = Integer(
         300, help="Interval (in seconds) at which to update last-activity timestamps."
     ).tag(config=True)
+    db_session_prune_interval = Integer(
+        300,
+        help="""
+        Interval (in seconds) at which to release unused objects from the Hub's database session.
+
+        The Hub keeps one database session for its whole lifetime,
+        so without pruning, objects loaded for every user ever seen stay in memory.
+        Pruning removes users who have been idle for `db_session_prune_idle_seconds`
+        and have no running servers from the Hub's in-memory cache,
+        and expires their unmodified database objects,
+        so they can be garbage-collected if nothing else uses them,
+        and are loaded from the database again when next needed.
+
+        Set to 0 to disable pruning.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    db_session_prune_idle_seconds = Integer(
+        3600,
+        help="""
+        Time (in seconds) since a user's last activity after which pruning may remove them from memory.
+
+        Only users with no running or pending servers,
+        who haven't been looked up by the Hub (e.g. for a request) in this time, are removed.
+        See `db_session_prune_interval`.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    activity_flush_interval = Integer(
+        30,
+        help="""
+        Interval (in seconds) at which to write buffered activity to the database.
+
+        Activity of users, servers, and tokens from requests to the Hub
+        and activity reports from single-user servers
+        is collected in memory, keeping only the most recent timestamp of each,
+        and written in one transaction at this interval and on shutdown.
+
+        Set to 0 to write activity immediately, in the request that records it.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_interval = Integer(
+        300,
+        help="""
+        Interval (in seconds) at which to check that the proxy's routes are correct.
+
+        Route checks are scheduled separately from last-activity updates,
+        and the interval adapts to the state of the Hub:
+        checks back off (up to `route_check_max_interval`) while they are expensive
+        or the Hub's event loop is busy,
+        and speed up (down to `route_check_min_interval`) after routes have been
+        found missing or stale.
+        The interval returns to `route_check_interval` once checks are
+        cheap and find nothing to fix.
+
+        Set to 0 to check routes after every last-activity update instead.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_min_interval = Integer(
+        30,
+        help="""
+        Shortest interval (in seconds) between route checks,
+        used after routes have been found missing or stale.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_max_interval = Integer(
+        3600,
+        help="""
+        Longest interval (in seconds) between route checks,
+        used while route checks are expensive or the Hub is busy.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_jitter = Float(
+        0.1,
+        help="""
+        Random jitter, as a fraction of the interval, applied to route checks
+
+        Avoids route checks of several Hubs (e.g. sharing a proxy) running in lockstep.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_max_load = Float(
+        0.05,
+        help="""
+        Fraction of time route checks may take before they are backed off.
+
+        If a route check takes longer than this fraction of the current interval,
+        the interval is doubled.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+    route_check_max_loop_lag = Float(
+        0.1,
+        help="""
+        Event loop lag (in seconds) above which route checks are backed off.
+
+        The lag is measured before each route check,
+        as the time it takes the Hub's event loop to get back to it.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
     proxy_check_interval = Integer(
         5,
         help="DEPRECATED since version 0.8: Use ConfigurableHTTPProxy.check_running_interval",
@@ -1276,6 +1402,35 @@ class JupyterHub(Application):
         """,
     ).tag(config=True)
 
+    api_token_cache_size = Integer(
+        4096,
+        help="""
+        Maximum number of API tokens to keep in the in-memory token lookup cache.
+
+        Caching avoids looking up and hashing tokens on every request
+        made by single-user servers, services, etc.
+        Only a keyed digest of each token is kept in memory.
+
+        Set to 0 to disable the cache.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    api_token_cache_ttl = Integer(
+        300,
+        help="""
+        Time (in seconds) that API token lookups are cached.
+
+        Cached entries are invalidated immediately when a token is deleted,
+        expires, or its scopes change.
+        The TTL bounds how long any change made outside the Hub
+        (e.g. directly in the database) may go unnoticed.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
     api_page_default_limit = Integer(
         50,
         help="The default amount of records returned by a paginated endpoint",
@@ -1285,6 +1440,22 @@ class JupyterHub(Application):
         200, help="The maximum amount of records that can be returned at once"
     ).tag(config=True)
 
+    api_page_count_cache_ttl = Integer(
+        0,
+        help="""
+        Time (in seconds) that total counts of paginated API requests are cached.
+
+        Counting all results for every page can be expensive for large collections.
+        When set, the `total` of a paginated response may be
+        up to this many seconds out of date.
+        Clients can also skip counting altogether with `include_count=false`.
+
+        0 (default) disables caching.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
     authenticate_prometheus = Bool(
         True, help="Authentication for prometheus metrics"
     ).tag(config=True)
@@ -1566,6 +1737,108 @@ class JupyterHub(Application):
         See sqlalchemy.create_engine for details.
         """).tag(config=True)
 
+    db_read_url = Unicode(
+        '',
+        help="""
+        url for a read-only replica of the database, e.g. a Postgres hot standby.
+
+        When set, read-heavy queries that can tolerate slightly stale results
+        use the replica instead of `db_url`:
+        listing users, groups, and shares (and counting them for pagination),
+        and periodic statistics such as active user metrics.
+        Clients that modified the database in the last
+        `DatabaseExecutor.read_your_writes_seconds` read from the primary instead,
+        so they see their own changes.
+
+        The replica must have the same schema as the primary database,
+        which is never created or upgraded via this url.
+        `db_kwargs` are used for both connections.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    memoize_cache_sizes = Dict(
+        key_trait=Unicode(),
+        value_trait=Integer(),
+        help="""
+        Max number of entries cached for memoized functions, by function.
+
+        JupyterHub caches the results of expensive, frequently called functions,
+        mostly for resolving permissions (e.g. `jupyterhub.scopes.expand_scopes`),
+        by default 1024 entries each.
+        Hubs with many users or distinct permissions may benefit from larger caches.
+        Cache hits, misses, evictions, and sizes are available in the
+        `jupyterhub_memoize_cache_*` prometheus metrics, labeled by function.
+
+        For example::
+
+            c.JupyterHub.memoize_cache_sizes = {
+                "jupyterhub.scopes.expand_scopes": 10000,
+            }
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    @validate("memoize_cache_sizes")
+    def _validate_memoize_cache_sizes(self, proposal):
+        caches = memoized_caches()
+        for name, maxsize in proposal.value.items():
+            if name not in caches:
+                raise ValueError(
+                    f"JupyterHub.memoize_cache_sizes: no memoized function {name!r}."
+                    f" Memoized functions are: {', '.join(sorted(caches))}"
+                )
+            if maxsize < 1:
+                raise ValueError(
+                    f"JupyterHub.memoize_cache_sizes[{name!r}] = {maxsize} must be at least 1"
+                )
+        return proposal.value
+
+    sqlite_performance_mode = Bool(
+        False,
+        help="""
+        Tune SQLite for throughput on a single-node Hub.
+
+        Uses the write-ahead log (WAL) with `synchronous=NORMAL`,
+        so commits don't wait for the disk,
+        as well as a larger cache, memory-mapped I/O, and a busy timeout.
+        On power failure or OS crash (but not a crash of the Hub),
+        the most recent commits may be lost.
+        WAL requires all processes using the database to be on the same host,
+        so don't use it with a database on a network filesystem.
+
+        Individual PRAGMAs can be overridden with `sqlite_pragmas`.
+        Has no effect on other databases.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    sqlite_pragmas = Dict(
+        help="""
+        PRAGMAs to set on each connection to a SQLite database.
+
+        For example::
+
+            c.JupyterHub.sqlite_pragmas = {"journal_mode": "WAL", "busy_timeout": 10000}
+
+        These take precedence over `sqlite_performance_mode`.
+        Has no effect on other databases.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    def _get_sqlite_pragmas(self):
+        """The PRAGMAs to set on SQLite connections"""
+        pragmas = {}
+        if self.sqlite_performance_mode:
+            pragmas.update(orm.SQLITE_PERFORMANCE_PRAGMAS)
+        pragmas.update(self.sqlite_pragmas)
+        return pragmas
+
     upgrade_db = Bool(
         False,
         help="""Upgrade the database automatically on start.
@@ -1578,7 +1851,49 @@ class JupyterHub(Application):
     debug_db = Bool(
         False, help="log all database transactions. This has A LOT of output"
     ).tag(config=True)
+
+    db_query_log_threshold = Integer(
+        0,
+        help="""
+        Log requests that make more than this many database queries,
+        along with the statements they executed, most repeated first.
+
+        Useful for finding handlers that issue a query per item in a list
+        (lazy-loading relationships in a loop, the "N+1" problem).
+        Query counts and time spent in the database for every request
+        are always available in the
+        `jupyterhub_request_db_queries` and `jupyterhub_request_db_duration_seconds`
+        prometheus metrics.
+
+        0 (default) disables logging.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
     session_factory = Any()
+    read_session_factory = Any(None)
+
+    db_executor = Instance(DatabaseExecutor)
+
+    @default('db_executor')
+    def _db_executor_default(self):
+        return DatabaseExecutor(
+            parent=self,
+            db=self.db,
+            session_factory=self.session_factory,
+            read_session_factory=self.read_session_factory,
+        )
+
+    activity_buffer = Instance(ActivityBuffer)
+
+    @default('activity_buffer')
+    def _activity_buffer_default(self):
+        return ActivityBuffer(
+            self.db_executor,
+            enabled=self.activity_flush_interval > 0,
+            log=self.log,
+        )
 
     users = Instance(UserDict)
 
@@ -1852,6 +2167,13 @@ class JupyterHub(Application):
         if os.path.exists(path) and not os.access(path, os.W_OK):
             self.log.error("%s cannot edit %s", user, path)
 
+    def init_memoize_caches(self):
+        """Resize the caches of memoized functions (memoize_cache_sizes)"""
+        caches = memoized_caches()
+        for name, maxsize in self.memoize_cache_sizes.items():
+            self.log.debug("Memoize cache size for %s: %i", name, maxsize)
+            caches[name].resize(maxsize)
+
     def init_secrets(self):
         trait_name = 'cookie_secret'
         trait = self.traits()[trait_name]
@@ -2050,9 +2372,19 @@ class JupyterHub(Application):
 
         try:
             self.session_factory = orm.new_session_factory(
-                self.db_url, reset=self.reset_db, echo=self.debug_db, **self.db_kwargs
+                self.db_url,
+                reset=self.reset_db,
+                echo=self.debug_db,
+                sqlite_pragmas=self._get_sqlite_pragmas(),
+                **self.db_kwargs,
             )
             self.db = self.session_factory()
+            # cached permissions may come from a previous database
+            _authz_cache.reset()
+            if self.db_read_url:
+                self.read_session_factory = orm.new_read_session_factory(
+                    self.db_read_url, echo=self.debug_db, **self.db_kwargs
+                )
         except OperationalError as e:
             self.log.error("Failed to connect to db: %s", db_log_url)
             self.log.debug("Database error was:", exc_info=True)
@@ -2733,16 +3065,62 @@ class JupyterHub(Application):
     # purge expired tokens hourly
     purge_expired_tokens_interval = 3600
 
+    purge_expired_batch_size = Integer(
+        1000,
+        help="""
+        Maximum number of expired tokens, codes, or shares to delete per transaction.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
+    @validate("purge_expired_batch_size")
+    def _validate_purge_expired_batch_size(self, proposal):
+        if proposal.value < 1:
+            raise ValueError(
+                f"JupyterHub.purge_expired_batch_size = {proposal.value} must be at least 1"
+            )
+        return proposal.value
+
+    purge_expired_max_seconds = Float(
+        10,
+        help="""
+        Time budget (in seconds) for each hourly purge of expired tokens, codes, and shares.
+
+        Rows left over when the budget is used up are purged in the next run.
+        Set to 0 for no limit.
+
+        .. versionadded:: 6.0
+        """,
+    ).tag(config=True)
+
     @catch_db_error
     def purge_expired_tokens(self):
         """purge all expiring token objects from the database
 
         run periodically
         """
+        tic = time.perf_counter()
         # this should be all the subclasses of Expiring
         for cls in (orm.APIToken, orm.OAuthCode, orm.Share, orm.ShareCode):
+            max_seconds = None
+            if self.purge_expired_max_seconds:
+                max_seconds = self.purge_expired_max_seconds - (
+                    time.perf_counter() - tic
+                )
+                if max_seconds <= 0:
+                    self.log.info(
+                        "Time budget for purging expired tokens used up, continuing in next purge"
+                    )
+                    break
             self.log.debug(f"Purging expired {cls.__name__}s")
-            cls.purge_expired(self.db)
+            deleted = cls.purge_expired(
+                self.db,
+                batch_size=self.purge_expired_batch_size,
+                max_seconds=max_seconds,
+            )
+            PURGE_EXPIRED_DELETED.labels(table=cls.__tablename__).inc(deleted)
+        PURGE_EXPIRED_DURATION_SECONDS.observe(time.perf_counter() - tic)
 
     async def init_api_tokens(self):
         """Load predefined API tokens (for services) into database"""
@@ -3292,6 +3670,18 @@ class JupyterHub(Application):
         # restrict xsrf cookie to hub base path
         xsrf_cookie_kwargs["path"] = self.hub.base_url
 
+        if self.api_token_cache_size:
+            api_token_cache = APITokenCache(
+                maxsize=self.api_token_cache_size, ttl=self.api_token_cache_ttl
+            )
+        else:
+            api_token_cache = None
+
+        if self.api_page_count_cache_ttl:
+            api_page_count_cache = LRUCache(ttl=self.api_page_count_cache_ttl)
+        else:
+            api_page_count_cache = None
+
         settings = dict(
             log_function=log_request,
             config=self.config,
@@ -3300,10 +3690,15 @@ class JupyterHub(Application):
             proxy=self.proxy,
             hub=self.hub,
             activity_resolution=self.activity_resolution,
+            activity_buffer=self.activity_buffer,
             admin_users=self.authenticator.admin_users,
             admin_access=self.admin_access,
             api_page_default_limit=self.api_page_default_limit,
             api_page_max_limit=self.api_page_max_limit,
+            api_page_count_cache=api_page_count_cache,
+            api_token_cache=api_token_cache,
+            db_executor=self.db_executor,
+            db_query_log_threshold=self.db_query_log_threshold,
             authenticator=self.authenticator,
             spawner_class=self.spawner_class,
             base_url=self.base_url,
@@ -3527,6 +3922,7 @@ class JupyterHub(Application):
 
         self.init_eventlog()
         self.init_pycurl()
+        self.init_memoize_caches()
         self.init_secrets()
         self.init_internal_ssl()
         self.init_db()
@@ -3598,7 +3994,7 @@ class JupyterHub(Application):
 
             asyncio.ensure_future(finish_init_spawners())
         metrics_collector = self.metrics_collector = PeriodicMetricsCollector(
-            parent=self, db=self.db
+            parent=self, db=self.db, db_executor=self.db_executor
         )
 
     async def cleanup(self):
@@ -3639,6 +4035,7 @@ class JupyterHub(Application):
             except Exception as e:
                 self.log.error("Failed to stop user: %s", e)
 
+        await self.activity_buffer.flush()
         self.db.commit()
 
         if self.pid_file and os.path.exists(self.pid_file):
@@ -3649,6 +4046,8 @@ class JupyterHub(Application):
             http_client = JupyterHubHTTPClient.instance()
             await http_client.close()
 
+        self.db_executor.close()
+
         self.log.info("...done")
 
     def write_config_file(self):
@@ -3683,56 +4082,310 @@ class JupyterHub(Application):
         with open(self.config_file, mode='w') as f:
             f.write(config_text)
 
-    @catch_db_error
-    async def update_last_activity(self):
-        """Update User.last_activity timestamps from the proxy"""
-        routes = await self.proxy.get_all_routes()
-        users_count = 0
-        active_users_count = 0
-        now = utcnow(with_tz=False)
-        for prefix, route in routes.items():
+    # time of the last successful activity poll of the proxy
+    _last_activity_poll = Any(None)
+    # (time, routes) of the routing table fetched by the last route check,
+    # reused by the next activity poll instead of fetching it again
+    # if it is no older than _checked_routes_max_age seconds
+    _checked_routes = Any(None)
+    _checked_routes_max_age = 5
+    # how long check_proxy_routes sleeps to measure event loop lag
+    _loop_lag_probe_seconds = 0.01
+
+    @staticmethod
+    def _write_route_activity(db, activity):
+        """Write last_activity of running servers, on the db executor
+
+        Args:
+            activity (dict): (user name, server name) -> last activity
+
+        Returns:
+            user_updates (dict): user id -> new last_activity
+            spawner_updates (dict): spawner id -> new last_activity
+            missing (list): (user name, server name) of routes without a running server
+        """
+        # resolve all running servers in one query
+        # routes only exist for running servers
+        query = (
+            db.query(
+                orm.User.id.label("user_id"),
+                orm.User.name.label("user_name"),
+                orm.User.last_activity.label("user_activity"),
+                orm.Spawner.id.label("spawner_id"),
+                orm.Spawner.name.label("spawner_name"),
+                orm.Spawner.last_activity.label("spawner_activity"),
+            )
+            .join(orm.Spawner, orm.Spawner.user_id == orm.User.id)
+            .filter(orm.Spawner.server_id.is_not(None))
+        )
+        running = {(row.user_name, row.spawner_name): row for row in query}
+
+        # only write timestamps that move forward
+        user_updates = {}
+        spawner_updates = {}
+        missing = []
+        for key, dt in activity.items():
+            if key not in running:
+                missing.append(key)
+                continue
+            row = running[key]
+            user_activity = user_updates.get(row.user_id, row.user_activity)
+            if user_activity is None or user_activity < dt:
+                user_updates[row.user_id] = dt
+            if row.spawner_activity is None or row.spawner_activity < dt:
+                spawner_updates[row.spawner_id] = dt
+
+        for cls, updates in (
+            (orm.User, user_updates),
+            (orm.Spawner, spawner_updates),
+        ):
+            if not updates:
+                continue
+            table = cls.__table__
+            # one executemany UPDATE per table,
+            # never moving last_activity backward
+            # if it was updated since it was read above
+            db.execute(
+                table.update()
+                .where(table.c.id == bindparam("_id"))
+                .where(
+                    or_(
+                        table.c.last_activity.is_(None),
+                        table.c.last_activity < bindparam("_last_activity"),
+                    )
+                )
+                .values(last_activity=bindparam("_last_activity")),
+                [{"_id": id, "_last_activity": dt} for id, dt in updates.items()],
+            )
+        return user_updates, spawner_updates, missing
+
+    async def _record_route_activity(self, routes):
+        """Record last_activity from proxy routes in the database
+
+        Running servers are resolved in a single query,
+        and changed timestamps are written with one executemany UPDATE per table,
+        so the number of queries doesn't grow with the number of routes.
+        The queries run on the db executor, off the event loop if possible.
+
+        Returns True if the activity was committed, False on database error.
+        """
+        # collect the most recent activity per (user, server)
+        activity = {}
+        for route in routes.values():
             route_data = route['data']
             if 'user' not in route_data:
                 # not a user route, ignore it
                 continue
             if 'server_name' not in route_data:
                 continue
-            users_count += 1
             if 'last_activity' not in route_data:
                 # no last activity data (possibly proxy other than CHP)
                 continue
-            user = orm.User.find(self.db, route_data['user'])
-            if user is None:
-                self.log.warning("Found no user for route: %s", route)
-                continue
-            spawner = user.orm_spawners.get(route_data['server_name'])
-            if spawner is None:
-                self.log.warning("Found no spawner for route: %s", route)
-                continue
             dt = parse_date(route_data['last_activity'])
             if dt.tzinfo:
                 # strip timezone info to naive UTC datetime
                 dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+            key = (route_data['user'], route_data['server_name'])
+            if key not in activity or activity[key] < dt:
+                activity[key] = dt
 
-            if user.last_activity:
-                user.last_activity = max(user.last_activity, dt)
-            else:
-                user.last_activity = dt
-            if spawner.last_activity:
-                spawner.last_activity = max(spawner.last_activity, dt)
-            else:
-                spawner.last_activity = dt
-            if (now - user.last_activity).total_seconds() < self.active_user_window:
-                active_users_count += 1
+        if not activity:
+            return True
 
         try:
-            self.db.commit()
+            user_updates, spawner_updates, missing = await self.db_executor.run(
+                self._write_route_activity, activity
+            )
+            if not self.db_executor.threaded:
+                self.db.commit()
         except SQLAlchemyError:
             self.log.exception("Rolling back session due to database error")
             self.db.rollback()
+            return False
+
+        for key in missing:
+            self.log.warning("Found no running server for route: %s:%s", *key)
+
+        # keep objects already loaded in the session in sync
+        for cls, updates in (
+            (orm.User, user_updates),
+            (orm.Spawner, spawner_updates),
+        ):
+            for id, dt in updates.items():
+                obj = self.db.identity_map.get(identity_key(cls, id))
+                if obj is not None and (
+                    obj.last_activity is None or obj.last_activity < dt
+                ):
+                    set_committed_value(obj, "last_activity", dt)
+        return True
+
+    def _release_orm_user(self, orm_user):
+        """Expire the database objects of a user removed from `self.users`
+
+        Returns the number of objects expired.
+        """
+        state = inspect(orm_user)
+        if state.modified or not state.persistent or orm_user in self.activity_buffer:
+            return 0
+        expired = 0
+        for rel in state.mapper.relationships:
+            if rel.secondary is None:
+                # one-to-many relationships are only held by the user
+                continue
+            # expire loaded collections on the other side holding on to the user,
+            # e.g. Role.users, to be loaded again when needed
+            reverse = rel.back_populates
+            for obj in state.dict.get(rel.key, ()):
+                obj_state = inspect(obj)
+                if reverse in obj_state.dict and not obj_state.modified:
+                    self.db.expire(obj, [reverse])
+                    expired += 1
+        for orm_spawner in state.dict.get('_orm_spawners', ()):
+            spawner_state = inspect(orm_spawner)
+            if spawner_state.modified or orm_spawner in self.activity_buffer:
+                continue
+            self.db.expire(orm_spawner)
+            expired += 1
+        self.db.expire(orm_user)
+        return expired + 1
+
+    @catch_db_error
+    async def prune_db_session(self):
+        """Release database objects that aren't in use from the shared session
+
+        Idle users without active servers are removed from `self.users`,
+        and their database objects are expired,
+        dropping their loaded attributes and relationships,
+        so they can be garbage-collected
+        (the session only holds weak references to unmodified objects).
+        Loaded collections of other objects that would keep them in memory
+        (e.g. `Role.users` and `Group.users`) are expired, too.
+        Objects of users and services that are in use are left alone.
+        """
+        # write buffered activity first,
+        # so expired objects load up-to-date activity
+        await self.activity_buffer.flush()
+
+        db = self.db
+        evicted = self.users.evict_idle(self.db_session_prune_idle_seconds)
+        n_evicted = len(evicted)
+        expired = sum(self._release_orm_user(user.orm_user) for user in evicted)
+        del evicted
+
+        counts = {}
+        for obj in db.identity_map.values():
+            table = inspect(obj).mapper.local_table.name
+            counts[table] = counts.get(table, 0) + 1
+        for mapper in orm.Base.registry.mappers:
+            table = mapper.local_table.name
+            DB_SESSION_OBJECTS.labels(table=table).set(counts.get(table, 0))
+        self.log.debug(
+            "Pruned db session: removed %i idle users, expired %i objects, %i objects in session",
+            n_evicted,
+            expired,
+            sum(counts.values()),
+        )
+
+    @catch_db_error
+    async def update_last_activity(self):
+        """Update User.last_activity timestamps from the proxy
+
+        Only routes with activity since the previous poll are requested
+        if the proxy implements :meth:`.Proxy.get_active_routes`.
+
+        Routes are checked here too if periodic route checks are disabled
+        (`route_check_interval = 0`).
+        """
+        now = utcnow(with_tz=False)
+        routes = None
+        try:
+            active_routes = await self.proxy.get_active_routes(self._last_activity_poll)
+        except NotImplementedError:
+            checked = self._checked_routes
+            self._checked_routes = None
+            if (
+                checked is not None
+                and self._last_activity_poll is not None
+                and checked[0] >= self._last_activity_poll
+                and (now - checked[0]).total_seconds() < self._checked_routes_max_age
+            ):
+                # the route check just fetched the routing table
+                now, routes = checked
+            else:
+                routes = await self.proxy.get_all_routes()
+            active_routes = routes
+        if not await self._record_route_activity(active_routes):
             return
+        # activity is recorded up to the start of this poll
+        self._last_activity_poll = now
+
+        if not self.route_check_interval:
+            await self.proxy.check_routes(
+                self.users, self._service_map, routes, incremental=True
+            )
+
+    def _next_route_check_interval(self, interval, changed, duration, loop_lag):
+        """Compute the interval (in seconds) until the next route check
 
-        await self.proxy.check_routes(self.users, self._service_map, routes)
+        Args:
+            interval: the current interval
+            changed: the number of routes the last check added or deleted
+            duration: how long the last check took
+            loop_lag: the event loop lag measured before the last check
+        """
+        base = self.route_check_interval
+        if changed:
+            # routes have drifted, check again sooner
+            interval = interval / 2
+        elif (
+            duration > self.route_check_max_load * interval
+            or loop_lag > self.route_check_max_loop_lag
+        ):
+            # checks are expensive or the Hub is busy, back off
+            interval = interval * 2
+        elif interval < base:
+            interval = min(interval * 2, base)
+        elif interval > base and 4 * duration < self.route_check_max_load * interval:
+            # only come back down if checks would stay cheap at the shorter interval
+            interval = max(interval / 2, base)
+        lower = min(self.route_check_min_interval, base)
+        upper = max(self.route_check_max_interval, base)
+        return min(max(interval, lower), upper)
+
+    async def check_proxy_routes(self):
+        """Periodic check of the proxy's routes
+
+        Reschedules itself according to :meth:`_next_route_check_interval`.
+        """
+        pc = self._periodic_callbacks.get("check_routes")
+        # measure how late the event loop wakes us up from a short sleep
+        tic = time.perf_counter()
+        await asyncio.sleep(self._loop_lag_probe_seconds)
+        loop_lag = max(time.perf_counter() - tic - self._loop_lag_probe_seconds, 0)
+
+        tic = time.perf_counter()
+        fetched = utcnow(with_tz=False)
+        routes = await self.proxy.get_all_routes()
+        self._checked_routes = (fetched, routes)
+        changed = await self.proxy.check_routes(
+            self.users, self._service_map, routes, incremental=True
+        )
+        duration = time.perf_counter() - tic
+        if pc is None:
+            return
+        interval = pc.callback_time / 1e3
+        next_interval = self._next_route_check_interval(
+            interval, changed, duration, loop_lag
+        )
+        if next_interval != interval:
+            self.log.debug(
+                "Next route check in %is (changed routes: %i, duration: %.3fs, loop lag: %.3fs)",
+                next_interval,
+                changed,
+                duration,
+                loop_lag,
+            )
+            pc.callback_time = 1e3 * next_interval
 
     async def start_service(
         self,
@@ -3936,6 +4589,29 @@ class JupyterHub(Application):
             self._periodic_callbacks["last_activity"] = pc
             pc.start()
 
+        if self.db_session_prune_interval:
+            pc = PeriodicCallback(
+                self.prune_db_session, 1e3 * self.db_session_prune_interval
+            )
+            self._periodic_callbacks["prune_db_session"] = pc
+            pc.start()
+
+        if self.activity_flush_interval:
+            pc = PeriodicCallback(
+                self.activity_buffer.flush, 1e3 * self.activity_flush_interval
+            )
+            self._periodic_callbacks["activity_flush"] = pc
+            pc.start()
+
+        if self.route_check_interval:
+            pc = PeriodicCallback(
+                self.check_proxy_routes,
+                1e3 * self.route_check_interval,
+                jitter=self.route_check_jitter,
+            )
+            self._periodic_callbacks["check_routes"] = pc
+            pc.start()
+
         if self.proxy.should_start:
             self.log.info("JupyterHub is now running at %s", self.proxy.public_url)
         else:
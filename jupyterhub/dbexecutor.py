@@ -0,0 +1,232 @@
+"""Run database work off the event loop
+
+The Hub's shared db session is used on the event loop,
+so every query blocks the event loop until the database responds.
+:class:`DatabaseExecutor` runs functions in worker threads instead,
+each with its own session.
+
+Functions run on the executor get a session as their first argument.
+They must not use ORM objects from the Hub's shared session,
+and should return plain data (ids, tuples, numbers, ...).
+Use ids to get the corresponding objects in the shared session,
+e.g. with ``db.get(orm.User, user_id)``,
+which doesn't need to query the database if the object is already loaded.
+To avoid loading an object again, a function can instead return it
+detached from the worker's session (with ``db.expunge``),
+to be added to the shared session with ``db.merge(obj, load=False)``.
+
+Only databases other than SQLite (e.g. PostgreSQL or MySQL) are accessed
+in worker threads. With SQLite, everything still runs on the event loop.
+
+Read-only work that can tolerate slightly stale results
+(listing, counting, statistics) can be run with :meth:`DatabaseExecutor.run_read`,
+which uses a read replica of the database, if there is one.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from traitlets import Any, Float, Integer, default
+from traitlets.config import LoggingConfigurable
+
+from ._memoize import LRUCache
+
+
+class DatabaseExecutor(LoggingConfigurable):
+    """Run database work in worker threads, each with its own session
+
+    SQLite databases are always accessed on the event loop with the shared session,
+    because SQLite only allows one writer at a time,
+    and in-memory SQLite databases can't be shared across connections.
+    So only deployments using another database (e.g. PostgreSQL or MySQL)
+    get database work off the event loop.
+
+    .. versionadded:: 6.0
+    """
+
+    threads = Integer(
+        1,
+        config=True,
+        help="""
+        Number of threads to run database work in.
+
+        Only used with databases other than SQLite (e.g. PostgreSQL or MySQL).
+        SQLite databases are always accessed on the event loop.
+
+        Set to 0 to run all database work on the event loop.
+        """,
+    )
+
+    max_pending = Integer(
+        100,
+        config=True,
+        help="""
+        Maximum number of database calls waiting for or running in a worker thread.
+
+        Further calls wait for a slot,
+        so a slow database doesn't lead to an unbounded backlog of work.
+        """,
+    )
+
+    db = Any(help="The Hub's shared db session, used when not running in threads")
+
+    session_factory = Any(help="Callable returning a new db session for a worker")
+
+    read_session_factory = Any(
+        None,
+        help="""
+        Callable returning a new db session for a read replica of the database,
+        used by :meth:`run_read`.
+        None if there is no replica.
+        """,
+    )
+
+    read_your_writes_seconds = Float(
+        5,
+        config=True,
+        help="""
+        Time (in seconds) after a client modifies the database
+        during which its reads go to the primary database instead of the replica.
+
+        This way, clients see their own changes right away
+        (e.g. a user created by an admin shows up in the admin's next user list),
+        even if the replica lags behind the primary.
+        Should be longer than the usual replication lag.
+        """,
+    )
+
+    @default('session_factory')
+    def _default_session_factory(self):
+        from sqlalchemy.orm import sessionmaker
+
+        return sessionmaker(bind=self.db.get_bind(), expire_on_commit=False)
+
+    _executor = Any(None)
+    _semaphore = Any(None)
+
+    _read_db = Any(None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._local = threading.local()
+        self._recent_writers = LRUCache(
+            maxsize=10000, ttl=self.read_your_writes_seconds
+        )
+
+    @property
+    def threaded(self):
+        """Whether database work runs off the event loop
+
+        False for SQLite, and if `threads` is 0.
+        """
+        if not self.threads:
+            return False
+        url = self.db.get_bind().url
+        return url.get_backend_name() != 'sqlite'
+
+    def _get_session(self, read=False):
+        """Get the session of the current worker thread"""
+        if read:
+            db = getattr(self._local, 'read_db', None)
+            if db is None:
+                db = self._local.read_db = self.read_session_factory()
+            return db
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self.session_factory()
+        return db
+
+    def _call(self, db, func, args, kwargs):
+        """Call func with a session, committing on success"""
+        try:
+            result = func(db, *args, **kwargs)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return result
+
+    def _call_in_thread(self, func, args, kwargs, read=False):
+        db = self._get_session(read=read)
+        try:
+            return self._call(db, func, args, kwargs)
+        finally:
+            # don't keep objects or connections between calls
+            db.close()
+
+    async def _run(self, func, args, kwargs, read=False):
+        if not self.threaded:
+            if not read:
+                # the transaction of the shared session belongs to the caller
+                return func(self.db, *args, **kwargs)
+            if self._read_db is None:
+                self._read_db = self.read_session_factory()
+            try:
+                return self._call(self._read_db, func, args, kwargs)
+            finally:
+                self._read_db.close()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.threads, thread_name_prefix='jupyterhub-db'
+            )
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        # run in a copy of the current context,
+        # so queries are attributed to the current request (see _query_stats)
+        context = contextvars.copy_context()
+        async with self._semaphore:
+            return await asyncio.wrap_future(
+                self._executor.submit(
+                    context.run, self._call_in_thread, func, args, kwargs, read
+                )
+            )
+
+    async def run(self, func, *args, **kwargs):
+        """Run `func(db, *args, **kwargs)`, off the event loop if possible
+
+        In a worker thread, the session is committed if func returns,
+        and rolled back if it raises.
+        When running on the event loop (see :attr:`threaded`),
+        func gets the Hub's shared session,
+        which is neither committed nor rolled back,
+        so callers that modify the database must commit the shared session
+        (or roll it back on error) themselves, as usual.
+
+        Returns the result of func.
+        """
+        return await self._run(func, args, kwargs)
+
+    async def run_read(self, func, *args, **kwargs):
+        """Run read-only `func(db, *args, **kwargs)` on the read replica
+
+        Like :meth:`run`, but uses a session for the read replica, if there is one,
+        so results may lag slightly behind the primary database.
+        func must not modify the database.
+        Without a replica, this is the same as :meth:`run`.
+        """
+        if self.read_session_factory is None:
+            return await self.run(func, *args, **kwargs)
+        return await self._run(func, args, kwargs, read=True)
+
+    def record_write(self, writer):
+        """Record that a client (e.g. a user or service name) modified the database
+
+        Until `read_your_writes_seconds` have passed,
+        :meth:`wrote_recently` is True for this client,
+        and their reads should use the primary database.
+        """
+        if self.read_session_factory is not None:
+            self._recent_writers.set(writer, True)
+
+    def wrote_recently(self, writer):
+        """Whether a client modified the database recently (see :meth:`record_write`)"""
+        return writer in self._recent_writers
+
+    def close(self):
+        """Shut down the worker threads"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
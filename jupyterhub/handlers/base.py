@@ -16,7 +16,9 @@ from http.client import responses
 from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse, urlunparse
 
 from jinja2 import TemplateNotFound
+from sqlalchemy import inspect
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import lazyload
 from tornado import gen, web
 from tornado.httputil import HTTPHeaders, url_concat
 from tornado.ioloop import IOLoop
@@ -24,6 +26,7 @@ from tornado.log import app_log
 from tornado.web import RequestHandler, addslash
 
 from .. import __version__, orm, roles, scopes
+from .._query_stats import start_query_stats
 from .._xsrf_utils import (
     _anonymous_xsrf_id,
     _set_xsrf_cookie,
@@ -78,6 +81,53 @@ reasons = {
 SESSION_COOKIE_NAME = 'jupyterhub-session-id'
 
 
+def _find_token(db, token):
+    """Find an API token and its user, for running on the db executor
+
+    Both are returned detached from the worker's session,
+    to be added to the shared session with :func:`_merge_loaded`.
+    """
+    orm_token = orm.APIToken.find(db, token)
+    if orm_token is None:
+        return None, None
+    orm_user = None
+    if orm_token.user_id is not None:
+        orm_user = db.get(orm.User, orm_token.user_id, options=[lazyload("*")])
+    db.expunge_all()
+    return orm_token, orm_user
+
+
+def _find_cookie_user(db, cookie_id):
+    """Find the user with a cookie id, for running on the db executor
+
+    The user is returned detached from the worker's session,
+    to be added to the shared session with :func:`_merge_loaded`.
+    """
+    orm_user = (
+        db.query(orm.User)
+        .options(lazyload("*"))
+        .filter(orm.User.cookie_id == cookie_id)
+        .first()
+    )
+    db.expunge_all()
+    return orm_user
+
+
+def _merge_loaded(db, obj):
+    """Get the shared session's instance of an object loaded on the db executor
+
+    Objects already in the session are used as they are,
+    so recorded activity isn't overwritten.
+    Others are added to it without loading them from the database again.
+    Only columns are loaded on the executor,
+    so relationships are loaded on first access, as usual.
+    """
+    existing = db.identity_map.get(inspect(obj).key)
+    if existing is not None:
+        return existing
+    return db.merge(obj, load=False)
+
+
 class BaseHandler(RequestHandler):
     """Base Handler class with access to common methods and properties."""
 
@@ -87,6 +137,9 @@ class BaseHandler(RequestHandler):
     _accept_cookie_auth = True
     _accept_token_auth = False
 
+    # users looked up by cookie id on the db executor
+    _resolved_cookie_users = None
+
     async def prepare(self):
         """Identify the user during the prepare stage of each request
 
@@ -99,6 +152,9 @@ class BaseHandler(RequestHandler):
         The current user (None if not logged in) may be accessed
         via the `self.current_user` property during the handling of any request.
         """
+        self._query_stats = start_query_stats(
+            record_statements=bool(self.settings.get("db_query_log_threshold"))
+        )
         self.expanded_scopes = set()
         try:
             await self.get_current_user()
@@ -202,8 +258,26 @@ class BaseHandler(RequestHandler):
         if self.db.dirty:
             self.log.warning("Rolling back dirty objects %s", self.db.dirty)
             self.db.rollback()
+        if (
+            self.request.method not in self._db_read_methods
+            and self.get_status() < 400
+            and self.db_executor is not None
+        ):
+            # the request may have modified the database,
+            # so the client should read from the primary for a while
+            writer = self._db_writer
+            if writer is not None:
+                self.db_executor.record_write(writer)
         super().finish(*args, **kwargs)
 
+    def on_finish(self):
+        # the request has been logged,
+        # don't count statements from tasks it started
+        query_stats = getattr(self, "_query_stats", None)
+        if query_stats is not None:
+            query_stats.stop()
+        super().on_finish()
+
     # ---------------------------------------------------------------
     # Security policies
     # ---------------------------------------------------------------
@@ -360,26 +434,43 @@ class BaseHandler(RequestHandler):
         If last_activity was more recent than self.activity_resolution seconds ago,
         do nothing to avoid unnecessarily frequent database commits.
 
+        Activity is recorded in the activity buffer if there is one,
+        which writes it to the database later.
+
         Args:
             obj: an ORM object with a last_activity attribute
             timestamp (datetime, optional): the timestamp of activity to register.
         Returns:
-            recorded (bool): True if activity was recorded, False if not.
+            recorded (bool): True if activity was recorded in the db session
+                and needs to be committed,
+                False if not (or if it was recorded in the activity buffer).
         """
         if timestamp is None:
             timestamp = utcnow(with_tz=False)
         resolution = self.settings.get("activity_resolution", 0)
         if not obj.last_activity or resolution == 0:
             self.log.debug("Recording first activity for %s", obj)
-            obj.last_activity = timestamp
-            return True
+            return self._set_activity(obj, timestamp)
         if (timestamp - obj.last_activity).total_seconds() > resolution:
             # this debug line will happen just too often
             # uncomment to debug last_activity updates
             # self.log.debug("Recording activity for %s", obj)
+            return self._set_activity(obj, timestamp)
+        return False
+
+    @property
+    def activity_buffer(self):
+        return self.settings.get('activity_buffer')
+
+    def _set_activity(self, obj, timestamp):
+        """Set last_activity on an object, via the activity buffer if there is one
+
+        Returns True if the db session needs to be committed.
+        """
+        if self.activity_buffer is None:
             obj.last_activity = timestamp
             return True
-        return False
+        return self.activity_buffer.record(obj, timestamp)
 
     async def refresh_auth(self, user, force=False):
         """Refresh user authentication info
@@ -440,12 +531,78 @@ class BaseHandler(RequestHandler):
             auth_info['auth_state'] = await user.get_auth_state()
         return await self.auth_to_user(auth_info, user)
 
+    @property
+    def db_executor(self):
+        return self.settings.get('db_executor')
+
+    @property
+    def _db_threaded(self):
+        """Whether db lookups should run on the db executor"""
+        return self.db_executor is not None and self.db_executor.threaded
+
+    # requests with these methods don't count as writes for read-your-writes
+    _db_read_methods = {"GET", "HEAD", "OPTIONS"}
+
+    @property
+    def _db_writer(self):
+        """Identify the client of the request, for read-your-writes
+
+        None if the client isn't authenticated.
+        """
+        user = getattr(self, '_jupyterhub_user', None)
+        if user is None:
+            return None
+        return f"{user.kind}:{user.name}"
+
+    async def run_db_read(self, func, *args, **kwargs):
+        """Run read-only `func(db, *args, **kwargs)` on the db executor
+
+        Uses the read replica, if there is one,
+        unless the client of the request modified the database recently.
+        See :meth:`.DatabaseExecutor.run_read`.
+        """
+        writer = self._db_writer
+        if writer is not None and self.db_executor.wrote_recently(writer):
+            return await self.db_executor.run(func, *args, **kwargs)
+        return await self.db_executor.run_read(func, *args, **kwargs)
+
+    async def _resolve_token(self):
+        """Look up the API token of the request on the db executor
+
+        The result is used by :meth:`get_token`,
+        so the lookup doesn't block the event loop.
+        """
+        token = self.get_auth_token()
+        if token is None or not self._db_threaded:
+            return
+        cache = self.settings.get('api_token_cache')
+        if cache is not None:
+            orm_token = cache.get(self.db, token)
+            if orm_token is not None:
+                self._resolved_token = orm_token
+                return
+        tic = time.perf_counter()
+        found, orm_user = await self.db_executor.run(_find_token, token)
+        orm_token = None
+        if found is not None:
+            if orm_user is not None:
+                _merge_loaded(self.db, orm_user)
+            orm_token = _merge_loaded(self.db, found)
+        if cache is not None:
+            cache.add(token, orm_token, time.perf_counter() - tic)
+        self._resolved_token = orm_token
+
     @functools.lru_cache
     def get_token(self):
         """get token from authorization header"""
+        if hasattr(self, '_resolved_token'):
+            return self._resolved_token
         token = self.get_auth_token()
         if token is None:
             return None
+        cache = self.settings.get('api_token_cache')
+        if cache is not None:
+            return cache.find(self.db, token)
         orm_token = orm.APIToken.find(self.db, token)
         return orm_token
 
@@ -475,11 +632,34 @@ class BaseHandler(RequestHandler):
 
         return self._user_from_orm(orm_token.user)
 
-    def _user_for_cookie(self, cookie_name, cookie_value=None):
-        """Get the User for a given cookie, if there is one"""
+    def _get_cookie_id(self, cookie_name, cookie_value=None):
+        """Get the cookie id from a cookie, if it is valid"""
         cookie_id = self.get_secure_cookie(
             cookie_name, cookie_value, max_age_days=self.cookie_max_age_days
         )
+        if cookie_id is None:
+            return None
+        return cookie_id.decode('utf8', 'replace')
+
+    async def _resolve_cookie_user(self, cookie_name, cookie_value=None):
+        """Look up the user for a cookie on the db executor
+
+        The result is used by :meth:`_user_for_cookie`,
+        so the lookup doesn't block the event loop.
+        """
+        if not self._db_threaded:
+            return
+        cookie_id = self._get_cookie_id(cookie_name, cookie_value)
+        if cookie_id is None:
+            return
+        orm_user = await self.db_executor.run(_find_cookie_user, cookie_id)
+        if orm_user is not None:
+            orm_user = _merge_loaded(self.db, orm_user)
+        self._resolved_cookie_users = {cookie_id: orm_user}
+
+    def _user_for_cookie(self, cookie_name, cookie_value=None):
+        """Get the User for a given cookie, if there is one"""
+        cookie_id = self._get_cookie_id(cookie_name, cookie_value)
 
         def clear():
             self.clear_cookie(cookie_name, path=self.hub.base_url)
@@ -489,8 +669,10 @@ class BaseHandler(RequestHandler):
                 self.log.warning("Invalid or expired cookie token")
                 clear()
             return
-        cookie_id = cookie_id.decode('utf8', 'replace')
-        u = self.db.query(orm.User).filter(orm.User.cookie_id == cookie_id).first()
+        if self._resolved_cookie_users and cookie_id in self._resolved_cookie_users:
+            u = self._resolved_cookie_users[cookie_id]
+        else:
+            u = self.db.query(orm.User).filter(orm.User.cookie_id == cookie_id).first()
         user = self._user_from_orm(u)
         if user is None:
             self.log.warning("Invalid cookie token")
@@ -524,8 +706,10 @@ class BaseHandler(RequestHandler):
             user = None
             try:
                 if self._accept_token_auth:
+                    await self._resolve_token()
                     user = self.get_current_user_token()
                 if user is None and self._accept_cookie_auth:
+                    await self._resolve_cookie_user(self.hub.cookie_name)
                     user = self.get_current_user_cookie()
                 if user and isinstance(user, User):
                     user = await self.refresh_auth(user)
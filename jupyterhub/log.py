@@ -122,6 +122,25 @@ def _scrub_headers(headers):
 # log_request adapted from IPython (BSD)
 
 
+def _log_query_stats(handler, uri):
+    """Log the database statements of requests making too many queries
+
+    See JupyterHub.db_query_log_threshold
+    """
+    query_stats = getattr(handler, "_query_stats", None)
+    threshold = handler.settings.get("db_query_log_threshold")
+    if not threshold or query_stats is None or query_stats.count <= threshold:
+        return
+    access_log.warning(
+        "%s %s made %i database queries (%.2fms):\n%s",
+        handler.request.method,
+        uri,
+        query_stats.count,
+        1000.0 * query_stats.duration,
+        query_stats.format_statements(),
+    )
+
+
 def log_request(handler):
     """log a bit more information about each request than tornado's default
 
@@ -129,6 +148,7 @@ def log_request(handler):
     - get proxied IP instead of proxy IP
     - log referer for redirect and failed requests
     - log user-agent for failed requests
+    - log database statements of requests making many queries
     - record per-request metrics in prometheus
     """
     status = handler.get_status()
@@ -190,4 +210,5 @@ def log_request(handler):
         if location:
             ns['location'] = f' -> {_scrub_uri(location)}'
     log_method(msg.format(**ns))
+    _log_query_stats(handler, uri)
     prometheus_log_method(handler)
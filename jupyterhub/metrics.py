@@ -28,12 +28,15 @@ import time
 from datetime import timedelta
 from enum import Enum
 
-from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from tornado.ioloop import PeriodicCallback
-from traitlets import Any, Bool, Dict, Float, Integer
+from traitlets import Any, Bool, Dict, Float, Integer, default
 from traitlets.config import LoggingConfigurable
 
 from . import orm
+from ._memoize import memoized_caches
+from .dbexecutor import DatabaseExecutor
 from .utils import utcnow
 
 metrics_prefix = os.getenv('JUPYTERHUB_METRICS_PREFIX', 'jupyterhub')
@@ -96,6 +99,21 @@ REQUEST_DURATION_SECONDS = Histogram(
     namespace=metrics_prefix,
 )
 
+REQUEST_DB_QUERIES = Histogram(
+    'request_db_queries',
+    'Number of database queries made while handling an HTTP request',
+    ['handler'],
+    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float("inf")],
+    namespace=metrics_prefix,
+)
+
+REQUEST_DB_DURATION_SECONDS = Histogram(
+    'request_db_duration_seconds',
+    'Time spent in database queries while handling an HTTP request',
+    ['handler'],
+    namespace=metrics_prefix,
+)
+
 SERVER_SPAWN_DURATION_SECONDS = Histogram(
     'server_spawn_duration_seconds',
     'Time taken for server spawning operation',
@@ -149,6 +167,115 @@ PROXY_POLL_DURATION_SECONDS = Histogram(
     namespace=metrics_prefix,
 )
 
+PROXY_RESTORE_DURATION_SECONDS = Histogram(
+    'proxy_restore_duration_seconds',
+    'Duration for restoring all routes on a new proxy',
+    namespace=metrics_prefix,
+)
+
+API_TOKEN_CACHE_LOOKUPS = Counter(
+    'api_token_cache_lookups',
+    'Lookups of API tokens in the token cache',
+    ['result'],
+    namespace=metrics_prefix,
+)
+
+
+class TokenCacheResult(Enum):
+    """
+    Possible values for 'result' label of API_TOKEN_CACHE_LOOKUPS
+    """
+
+    hit = 'hit'
+    miss = 'miss'
+
+    def __str__(self):
+        return self.value
+
+
+for r in TokenCacheResult:
+    API_TOKEN_CACHE_LOOKUPS.labels(result=r)
+
+API_TOKEN_CACHE_SAVED_SECONDS = Counter(
+    'api_token_cache_saved_seconds',
+    'Estimated time saved by API token cache hits, compared to looking up the token in the database',
+    namespace=metrics_prefix,
+)
+
+
+class MemoizeCollector:
+    """Collect hit, miss, and eviction counts and sizes of memoized functions
+
+    The caches count for themselves, and are only read when metrics are collected,
+    to keep cache hits cheap.
+    """
+
+    def _families(self):
+        return (
+            CounterMetricFamily(
+                f"{metrics_prefix}_memoize_cache_hits",
+                "Calls of memoized functions answered from their cache",
+                labels=["function"],
+            ),
+            CounterMetricFamily(
+                f"{metrics_prefix}_memoize_cache_misses",
+                "Calls of memoized functions not in their cache",
+                labels=["function"],
+            ),
+            CounterMetricFamily(
+                f"{metrics_prefix}_memoize_cache_evictions",
+                "Entries evicted from the caches of memoized functions to stay under their max size",
+                labels=["function"],
+            ),
+            GaugeMetricFamily(
+                f"{metrics_prefix}_memoize_cache_size",
+                "Number of entries in the caches of memoized functions",
+                labels=["function"],
+            ),
+        )
+
+    def describe(self):
+        return self._families()
+
+    def collect(self):
+        hits, misses, evictions, size = families = self._families()
+        for name, cache in sorted(memoized_caches().items()):
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            evictions.add_metric([name], cache.evictions)
+            size.add_metric([name], len(cache))
+        return families
+
+
+MEMOIZE_CACHES = MemoizeCollector()
+REGISTRY.register(MEMOIZE_CACHES)
+
+PURGE_EXPIRED_DURATION_SECONDS = Histogram(
+    'purge_expired_duration_seconds',
+    'Time taken to purge expired tokens, codes, and shares from the database',
+    namespace=metrics_prefix,
+)
+
+PURGE_EXPIRED_DELETED = Counter(
+    'purge_expired_deleted',
+    'Expired rows deleted from the database',
+    ['table'],
+    namespace=metrics_prefix,
+)
+
+for cls in (orm.APIToken, orm.OAuthCode, orm.Share, orm.ShareCode):
+    PURGE_EXPIRED_DELETED.labels(table=cls.__tablename__)
+
+DB_SESSION_OBJECTS = Gauge(
+    'db_session_objects',
+    "Number of objects in the Hub's database session, as of the last pruning of the session",
+    ['table'],
+    namespace=metrics_prefix,
+)
+
+for mapper in orm.Base.registry.mappers:
+    DB_SESSION_OBJECTS.labels(table=mapper.local_table.name)
+
 LOGIN_DURATION_SECONDS = Histogram(
     'login_duration_seconds',
     'duration for all authentication attempts',
@@ -369,6 +496,9 @@ def prometheus_log_method(handler):
        Errors: the number of failed requests per second.
        Duration: the amount of time each request takes expressed as a time interval.
 
+    as well as the number of database queries made by each request,
+    and the time spent in them.
+
     We use a fully qualified name of the handler as a label,
     rather than every url path to reduce cardinality.
 
@@ -376,11 +506,19 @@ def prometheus_log_method(handler):
     that is the 'log_function' tornado setting. This makes it get called
     at the end of every request, allowing us to record the metrics we need.
     """
+    handler_name = f'{handler.__class__.__module__}.{type(handler).__name__}'
     REQUEST_DURATION_SECONDS.labels(
         method=handler.request.method,
-        handler=f'{handler.__class__.__module__}.{type(handler).__name__}',
+        handler=handler_name,
         code=handler.get_status(),
     ).observe(handler.request.request_time())
+    # database queries, for handlers that record them (see BaseHandler.prepare)
+    query_stats = getattr(handler, "_query_stats", None)
+    if query_stats is not None:
+        REQUEST_DB_QUERIES.labels(handler=handler_name).observe(query_stats.count)
+        REQUEST_DB_DURATION_SECONDS.labels(handler=handler_name).observe(
+            query_stats.duration
+        )
 
 
 class PeriodicMetricsCollector(LoggingConfigurable):
@@ -449,26 +587,59 @@ class PeriodicMetricsCollector(LoggingConfigurable):
 
     db = Any(help="SQLAlchemy db session to use for performing queries")
 
-    def update_active_users(self):
-        """Update active users metrics."""
+    db_executor = Any(
+        help="DatabaseExecutor to run queries with, off the event loop (and on the read replica) if possible"
+    )
+
+    @default("db_executor")
+    def _default_db_executor(self):
+        return DatabaseExecutor(parent=self, db=self.db)
+
+    @staticmethod
+    def _count_active_users(db, cutoffs):
+        """Count the users active since each cutoff, on the db executor"""
+        return {
+            period: db.query(orm.User).filter(orm.User.last_activity >= cutoff).count()
+            for period, cutoff in cutoffs.items()
+        }
 
+    def _active_user_cutoffs(self):
         # All the metrics should be based off a cutoff from a *fixed* point, so we calculate
         # the fixed point here - and then calculate the individual cutoffs in relation to this
         # fixed point.
         now = utcnow()
-        cutoffs = {
+        return {
             ActiveUserPeriods.twenty_four_hours: now - timedelta(hours=24),
             ActiveUserPeriods.seven_days: now - timedelta(days=7),
             ActiveUserPeriods.thirty_days: now - timedelta(days=30),
         }
-        for period, cutoff in cutoffs.items():
-            value = (
-                self.db.query(orm.User).filter(orm.User.last_activity >= cutoff).count()
-            )
 
+    def _set_active_users(self, counts):
+        for period, value in counts.items():
             self.log.info(f'Found {value} active users in the last {period}')
             ACTIVE_USERS.labels(period=period.value).set(value)
 
+    def update_active_users(self):
+        """Update active users metrics.
+
+        Queries the database with the shared session, blocking the event loop.
+        The periodic update uses :meth:`update_active_users_async` instead.
+        """
+        cutoffs = self._active_user_cutoffs()
+        self._set_active_users(self._count_active_users(self.db, cutoffs))
+
+    async def update_active_users_async(self):
+        """Update active users metrics on the db executor
+
+        Like :meth:`update_active_users`,
+        but off the event loop (and on the read replica) if possible.
+
+        .. versionadded:: 6.0
+        """
+        cutoffs = self._active_user_cutoffs()
+        counts = await self.db_executor.run_read(self._count_active_users, cutoffs)
+        self._set_active_users(counts)
+
     async def _measure_event_loop_interval(self):
         """Measure the event loop responsiveness
 
@@ -510,13 +681,15 @@ class PeriodicMetricsCollector(LoggingConfigurable):
         if self.active_users_enabled:
             # Setup periodic refresh of the metric
             self._periodic_callbacks["active_users"] = PeriodicCallback(
-                self.update_active_users,
+                self.update_active_users_async,
                 self.active_users_update_interval * 1000,
                 jitter=0.01,
             )
 
             # Update the metrics once on startup too
-            self.update_active_users()
+            self._tasks["active_users"] = asyncio.create_task(
+                self.update_active_users_async()
+            )
 
         if self.event_loop_interval_enabled:
             self._tasks["event_loop_tick"] = asyncio.create_task(
@@ -3,9 +3,12 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 import enum
+import hashlib
 import json
 import numbers
+import re
 import secrets
+import time
 from base64 import decodebytes, encodebytes
 from datetime import timedelta
 from functools import lru_cache, partial
@@ -25,6 +28,7 @@ from sqlalchemy import (
     Table,
     Unicode,
     create_engine,
+    delete,
     event,
     exc,
     inspect,
@@ -306,7 +310,7 @@ class User(Base):
     user_info = Column(JSONDict)
     admin = Column(Boolean(create_constraint=False), default=False)
     created = Column(DateTime, default=utcnow)
-    last_activity = Column(DateTime, nullable=True)
+    last_activity = Column(DateTime, nullable=True, index=True)
 
     api_tokens = relationship(
         "APIToken", back_populates="user", cascade="all, delete-orphan"
@@ -395,7 +399,9 @@ class Spawner(Base):
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
     user = relationship("User", back_populates="_orm_spawners")
 
-    server_id = Column(Integer, ForeignKey('servers.id', ondelete='SET NULL'))
+    server_id = Column(
+        Integer, ForeignKey('servers.id', ondelete='SET NULL'), index=True
+    )
     server = relationship(
         Server,
         back_populates="spawner",
@@ -577,18 +583,52 @@ class Expiring:
             return self.expires_in <= 0
 
     @classmethod
-    def purge_expired(cls, db):
-        """Purge expired API Tokens from the database"""
+    def purge_expired(cls, db, batch_size=1000, max_seconds=None):
+        """Purge expired objects from the database
+
+        Expired rows are deleted with bulk DELETE statements
+        of up to `batch_size` rows, committing after each batch,
+        without loading them into the session.
+        Objects already in the session are removed from it.
+
+        If `max_seconds` is given, stop starting new batches after that long,
+        leaving the remaining rows for the next purge.
+
+        Returns:
+            deleted (int): the number of rows deleted
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be at least 1, not {batch_size}")
         now = cls.now()
-        deleted = False
-        for obj in (
-            db.query(cls).filter(cls.expires_at != None).filter(cls.expires_at < now)
-        ):
-            app_log.debug("Purging expired %s", obj)
-            deleted = True
-            db.delete(obj)
-        if deleted:
+        if max_seconds is not None:
+            deadline = time.perf_counter() + max_seconds
+        deleted = 0
+        while True:
+            ids = [
+                row[0]
+                for row in db.query(cls.id)
+                .filter(cls.expires_at != None)
+                .filter(cls.expires_at < now)
+                .limit(batch_size)
+            ]
+            if not ids:
+                break
+            # synchronize_session marks objects in the session as deleted,
+            # which expires their relationships
+            db.execute(
+                delete(cls)
+                .where(cls.id.in_(ids))
+                .execution_options(synchronize_session="evaluate")
+            )
             db.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+            if max_seconds is not None and time.perf_counter() >= deadline:
+                break
+        if deleted:
+            app_log.debug("Purged %i expired %s", deleted, cls.__tablename__)
+        return deleted
 
 
 class Hashed(Expiring):
@@ -605,6 +645,9 @@ class Hashed(Expiring):
     generated = True
     generated_salt_bytes = 8
     generated_rounds = 1
+    # algorithm for the unsalted digest of generated tokens,
+    # used to look them up by exact match
+    digest_algorithm = "sha256"
 
     @property
     def token(self):
@@ -620,9 +663,12 @@ class Hashed(Expiring):
             # ref: https://security.stackexchange.com/a/151262/155114
             rounds = self.generated_rounds
             salt_bytes = self.generated_salt_bytes
+            # for the same reason, they can be found by an unsalted digest
+            self.digest = self.token_digest(token)
         else:
             rounds = self.rounds
             salt_bytes = self.salt_bytes
+            self.digest = None
         self.hashed = hash_token(
             token, rounds=rounds, salt=salt_bytes, algorithm=self.algorithm
         )
@@ -644,6 +690,28 @@ class Hashed(Expiring):
                 f"Collision on {cls.__name__}: {token[: cls.prefix_length]}..."
             )
 
+    @classmethod
+    def token_digest(cls, token):
+        """Return the unsalted digest of a generated token"""
+        return hashlib.new(
+            cls.digest_algorithm, token.encode('utf8', 'replace')
+        ).hexdigest()
+
+    @classmethod
+    def find_digest(cls, db, token):
+        """Start the query for a generated token matching exactly.
+
+        Returns an SQLAlchemy query filtered by the token's digest,
+        which matches at most one token.
+
+        .. versionadded:: 6.0
+        """
+        digest_match = db.query(cls).filter_by(digest=cls.token_digest(token))
+        digest_match = digest_match.filter(
+            or_(cls.expires_at == None, cls.expires_at >= cls.now())
+        )
+        return digest_match
+
     @classmethod
     def find_prefix(cls, db, token):
         """Start the query for matching token.
@@ -653,11 +721,15 @@ class Hashed(Expiring):
         .. versionchanged:: 1.2
 
             Excludes expired matches.
+
+        .. versionchanged:: 6.0
+
+            Excludes tokens with a digest, which are found with :meth:`find_digest`.
         """
         prefix = token[: cls.prefix_length]
         # since we can't filter on hashed values, filter on prefix
         # so we aren't comparing with all tokens
-        prefix_match = db.query(cls).filter_by(prefix=prefix)
+        prefix_match = db.query(cls).filter_by(prefix=prefix, digest=None)
         prefix_match = prefix_match.filter(
             or_(cls.expires_at == None, cls.expires_at >= cls.now())
         )
@@ -672,6 +744,14 @@ class Hashed(Expiring):
         `kind='user'` only returns API tokens for users
         `kind='service'` only returns API tokens for services
         """
+        found = (
+            cls.find_digest(db, token)
+            .options(joinedload(cls.user), joinedload(cls.service))
+            .first()
+        )
+        if found is not None:
+            return found
+
         prefix_match = cls.find_prefix(db, token).options(
             joinedload(cls.user), joinedload(cls.service)
         )
@@ -721,7 +801,7 @@ class _Share:
 
     # the permissions granted (!server filter will always be applied)
     scopes = Column(JSONList)
-    expires_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True, index=True)
 
     @classmethod
     def apply_filter(cls, scopes, spawner):
@@ -937,6 +1017,8 @@ class ShareCode(_Share, Hashed, Base):
 
     hashed = Column(Unicode(255), unique=True)
     prefix = Column(Unicode(16), index=True)
+    # added in 6.0
+    digest = Column(Unicode(255), index=True, unique=True, nullable=True)
     exchange_count = Column(Integer, default=0)
     last_exchanged_at = Column(DateTime, nullable=True, default=None)
 
@@ -984,9 +1066,14 @@ class ShareCode(_Share, Hashed, Base):
     @classmethod
     def find(cls, db, code, *, spawner=None):
         """Lookup a single ShareCode by code"""
+        digest_match = cls.find_digest(db, code)
         prefix_match = cls.find_prefix(db, code)
         if spawner:
+            digest_match = digest_match.filter_by(spawner_id=spawner.id)
             prefix_match = prefix_match.filter_by(spawner_id=spawner.id)
+        share_code = digest_match.first()
+        if share_code is not None:
+            return share_code
         for share_code in prefix_match:
             if share_code.match(code):
                 return share_code
@@ -1051,6 +1138,8 @@ class APIToken(Hashed, Base):
     id = Column(Integer, primary_key=True)
     hashed = Column(Unicode(255), unique=True)
     prefix = Column(Unicode(16), index=True)
+    # added in 6.0
+    digest = Column(Unicode(255), index=True, unique=True, nullable=True)
 
     @property
     def api_id(self):
@@ -1084,7 +1173,7 @@ class APIToken(Hashed, Base):
     # token metadata for bookkeeping
     now = staticmethod(utcnow)  # for expiry
     created = Column(DateTime, default=utcnow)
-    expires_at = Column(DateTime, default=None, nullable=True)
+    expires_at = Column(DateTime, default=None, nullable=True, index=True)
     last_activity = Column(DateTime)
     note = Column(Unicode(1023))
     scopes = Column(JSONList, default=[])
@@ -1111,24 +1200,33 @@ class APIToken(Hashed, Base):
         `kind='user'` only returns API tokens for users
         `kind='service'` only returns API tokens for services
         """
+        digest_match = cls.find_digest(db, token)
         prefix_match = cls.find_prefix(db, token)
         if kind == 'user':
+            digest_match = digest_match.filter(cls.user_id != None)
             prefix_match = prefix_match.filter(cls.user_id != None)
         elif kind == 'service':
+            digest_match = digest_match.filter(cls.service_id != None)
             prefix_match = prefix_match.filter(cls.service_id != None)
         elif kind is not None:
             raise ValueError(f"kind must be 'user', 'service', or None, not {kind!r}")
-        for orm_token in prefix_match:
-            if orm_token.match(token):
-                if not orm_token.client_id:
-                    app_log.warning(
-                        "Deleting stale oauth token for %s with no client",
-                        orm_token.user and orm_token.user.name,
-                    )
-                    db.delete(orm_token)
-                    db.commit()
-                    return
-                return orm_token
+
+        found = digest_match.first()
+        if found is None:
+            # tokens without a digest (user-provided, or created before 6.0)
+            for orm_token in prefix_match:
+                if orm_token.match(token):
+                    found = orm_token
+                    break
+        if found is not None and not found.client_id:
+            app_log.warning(
+                "Deleting stale oauth token for %s with no client",
+                found.user and found.user.name,
+            )
+            db.delete(found)
+            db.commit()
+            return
+        return found
 
     @classmethod
     def new(
@@ -1262,7 +1360,7 @@ class OAuthCode(Expiring, Base):
         back_populates="codes",
     )
     code = Column(Unicode(36))
-    expires_at = Column(Integer)
+    expires_at = Column(Integer, index=True)
     redirect_uri = Column(Unicode(1023))
     session_id = Column(Unicode(255))
     # state = Column(Unicode(1023))
@@ -1358,6 +1456,52 @@ def register_foreign_keys(engine):
         cursor.close()
 
 
+# PRAGMAs for SQLite performance mode
+# WAL lets readers and the writer proceed concurrently,
+# and with synchronous=NORMAL, commits don't wait for fsync
+# (the database stays consistent, but the most recent commits
+# may be lost on power failure or OS crash, not on a crash of the Hub)
+SQLITE_PERFORMANCE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # 256MB
+    "mmap_size": 268435456,
+    # negative: KiB, i.e. 64MB
+    "cache_size": -65536,
+    # ms
+    "busy_timeout": 5000,
+}
+
+
+def register_sqlite_pragmas(engine, pragmas):
+    """register PRAGMAs to set on each connection to a SQLite database
+
+    Args:
+        engine: the sqlalchemy engine
+        pragmas (dict): PRAGMA name -> value, e.g. ``{"journal_mode": "WAL"}``
+    """
+    statements = []
+    for name, value in pragmas.items():
+        if not re.fullmatch(r"\w+", name):
+            raise ValueError(f"Invalid SQLite PRAGMA name: {name!r}")
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, str)):
+            raise ValueError(
+                f"SQLite PRAGMA {name} must be an int or str, not {value!r}"
+            )
+        if isinstance(value, str) and not re.fullmatch(r"\w+", value):
+            raise ValueError(f"Invalid value for SQLite PRAGMA {name}: {value!r}")
+        statements.append(f"PRAGMA {name}={value}")
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_con, con_record):
+        cursor = dbapi_con.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
 def _expire_relationship(target, relationship_prop):
     """Expire relationship backrefs
 
@@ -1551,10 +1695,8 @@ def add_row_format(base):
         t.dialect_kwargs['mysql_ROW_FORMAT'] = 'DYNAMIC'
 
 
-def new_session_factory(
-    url="sqlite:///:memory:", reset=False, expire_on_commit=False, **kwargs
-):
-    """Create a new session at url"""
+def _new_engine(url, sqlite_pragmas=None, **kwargs):
+    """Create an engine for url, with JupyterHub's connection handling"""
     if url.startswith('sqlite'):
         kwargs.setdefault('connect_args', {'check_same_thread': False})
 
@@ -1571,9 +1713,28 @@ def new_session_factory(
     engine = create_engine(url, **kwargs)
     if url.startswith('sqlite'):
         register_foreign_keys(engine)
+        if sqlite_pragmas:
+            register_sqlite_pragmas(engine, sqlite_pragmas)
 
     # enable pessimistic disconnect handling
     register_ping_connection(engine)
+    return engine
+
+
+def new_session_factory(
+    url="sqlite:///:memory:",
+    reset=False,
+    expire_on_commit=False,
+    sqlite_pragmas=None,
+    **kwargs,
+):
+    """Create a new session at url
+
+    `sqlite_pragmas` are PRAGMAs to set on each connection,
+    if the database is SQLite.
+    See :func:`register_sqlite_pragmas`.
+    """
+    engine = _new_engine(url, sqlite_pragmas=sqlite_pragmas, **kwargs)
 
     if reset:
         Base.metadata.drop_all(engine)
@@ -1593,6 +1754,17 @@ def new_session_factory(
     return session_factory
 
 
+def new_read_session_factory(url, **kwargs):
+    """Create a session factory for a read-only replica of the database at url
+
+    Unlike :func:`new_session_factory`, the schema is never created or checked,
+    since the replica can't be written to.
+    It must be a replica of the Hub's database, with the same schema.
+    """
+    engine = _new_engine(url, **kwargs)
+    return sessionmaker(bind=engine, expire_on_commit=False)
+
+
 def get_class(resource_name):
     """Translates resource string names to ORM classes"""
     class_dict = {
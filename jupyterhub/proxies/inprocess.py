@@ -0,0 +1,532 @@
+"""A proxy running in the Hub's own event loop
+
+Enable with::
+
+    c.JupyterHub.proxy_class = "in-process"
+
+The routing table lives in memory,
+so adding and removing routes is instant and involves no network requests,
+and there is no separate proxy process to manage.
+
+.. versionadded:: 6.0
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import copy
+import ssl
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote, urlparse
+
+from tornado import httputil, web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_unix_socket
+from tornado.websocket import WebSocketClosedError, WebSocketHandler, websocket_connect
+from traitlets import Any, Bool, Float, Integer
+
+from ..objects import Server
+from ..proxy import Proxy
+from ..utils import url_path_join
+
+# headers that apply to a single connection, and must not be forwarded
+# https://www.rfc-editor.org/rfc/rfc9110#section-7.6.1
+_HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# headers of the websocket handshake, set by the websocket client
+_WEBSOCKET_HEADERS = {
+    "sec-websocket-key",
+    "sec-websocket-version",
+    "sec-websocket-extensions",
+    "sec-websocket-protocol",
+}
+
+
+def _route_key(path):
+    """Split a routespec or request path into unescaped segments"""
+    return tuple(unquote(segment) for segment in path.split("/") if segment)
+
+
+class _TrieNode:
+    __slots__ = ("children", "routespec")
+
+    def __init__(self):
+        self.children = {}
+        self.routespec = None
+
+
+class RouteTrie:
+    """Longest-prefix routing table
+
+    Routes are stored by path segment,
+    so lookup cost depends on the depth of the request path,
+    not the number of routes.
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+
+    def add(self, key, routespec):
+        node = self._root
+        for segment in key:
+            node = node.children.setdefault(segment, _TrieNode())
+        node.routespec = routespec
+
+    def remove(self, key):
+        """Remove a route, pruning empty nodes"""
+        path = [self._root]
+        node = self._root
+        for segment in key:
+            node = node.children.get(segment)
+            if node is None:
+                return
+            path.append(node)
+        node.routespec = None
+        # prune nodes with no route and no children
+        for depth in range(len(key), 0, -1):
+            node = path[depth]
+            if node.routespec is not None or node.children:
+                break
+            del path[depth - 1].children[key[depth - 1]]
+
+    def match(self, key):
+        """Return the routespec with the longest prefix matching key"""
+        node = self._root
+        match = node.routespec
+        for segment in key:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.routespec is not None:
+                match = node.routespec
+        return match
+
+
+class InProcessProxyHandler(WebSocketHandler):
+    """Forward requests, including websockets, to the target of their route"""
+
+    def initialize(self, proxy):
+        self.proxy = proxy
+        self.route = None
+        self.ws_client = None
+
+    def check_xsrf_cookie(self):
+        # xsrf checks are up to the target
+        pass
+
+    def check_origin(self, origin):
+        # origin checks are up to the target
+        return True
+
+    def set_default_headers(self):
+        # only forward headers set by the target
+        self.clear_header("Content-Type")
+        self.clear_header("Server")
+
+    def prepare(self):
+        host = None
+        if self.proxy.host_routing:
+            host, port = httputil.split_host_and_port(self.request.host)
+        self.route = self.proxy._match_route(host, self.request.path)
+
+    def _upstream_url(self, scheme=None):
+        """The URL of the request on the target"""
+        target = self.route["target"]
+        if scheme:
+            proto, sep, rest = target.partition("://")
+            target = f"{scheme}://{rest}"
+        return target.rstrip("/") + self.request.uri
+
+    def _upstream_headers(self, exclude=_HOP_BY_HOP_HEADERS):
+        headers = httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name.lower() not in exclude:
+                headers.add(name, value)
+        # X-Forwarded headers, as consumed by tornado's xheaders=True
+        remote_ip = self.request.remote_ip
+        forwarded_for = self.request.headers.get("X-Forwarded-For")
+        if forwarded_for:
+            remote_ip = f"{forwarded_for}, {remote_ip}"
+        headers["X-Forwarded-For"] = remote_ip
+        headers["X-Forwarded-Proto"] = self.request.protocol
+        headers["X-Forwarded-Host"] = self.request.host
+        return headers
+
+    async def get(self, *args):
+        if self.route is None:
+            return await self._route_not_found()
+        if self.request.headers.get("Upgrade", "").lower() == "websocket":
+            return await super().get(*args)
+        return await self.proxy_request()
+
+    async def _route_not_found(self):
+        self.proxy.log.debug("No route for %s", self.request.uri)
+        await self._error_page(404)
+
+    async def _error_page(self, status_code):
+        """Serve an error page from the Hub
+
+        Like configurable-http-proxy's error target,
+        so users get a useful page when e.g. their server is unreachable.
+        """
+        error_url = url_path_join(self.proxy.hub.url, "error", str(status_code))
+        error_url += "?url=" + quote(self.request.uri, safe="")
+        try:
+            response = await self.proxy.http_client.fetch(
+                error_url, raise_error=False, follow_redirects=False
+            )
+        except OSError as e:
+            response = None
+            error = e
+        else:
+            error = response.error
+        self.set_status(status_code)
+        if response is not None and response.code == 200:
+            self.set_header(
+                "Content-Type",
+                response.headers.get("Content-Type", "text/html; charset=UTF-8"),
+            )
+            self.finish(response.body)
+        else:
+            self.proxy.log.warning(
+                "Failed to fetch error page %s: %s", error_url, error
+            )
+            self.finish()
+
+    async def proxy_request(self, *args):
+        """Forward an http request to the route target"""
+        if self.route is None:
+            return await self._route_not_found()
+        self.proxy._record_activity(self.route["routespec"])
+
+        upstream_status = {}
+
+        def header_callback(line):
+            line = line.rstrip("\r\n")
+            if line.startswith("HTTP/"):
+                # new response (there may be more than one, e.g. 100 Continue)
+                start_line = httputil.parse_response_start_line(line)
+                upstream_status["code"] = start_line.code
+                upstream_status["reason"] = start_line.reason
+                upstream_status["headers"] = httputil.HTTPHeaders()
+            elif line:
+                upstream_status["headers"].parse_line(line)
+
+        def write_headers():
+            if upstream_status.get("written"):
+                return
+            upstream_status["written"] = True
+            self.set_status(upstream_status["code"], upstream_status["reason"])
+            for name, value in upstream_status["headers"].get_all():
+                if name.lower() not in _HOP_BY_HOP_HEADERS:
+                    self.add_header(name, value)
+
+        def streaming_callback(chunk):
+            write_headers()
+            self.write(chunk)
+            self.flush()
+
+        body = self.request.body
+        if not body and self.request.method not in {"POST", "PUT", "PATCH"}:
+            body = None
+
+        request = HTTPRequest(
+            self._upstream_url(),
+            method=self.request.method,
+            headers=self._upstream_headers(),
+            body=body,
+            follow_redirects=False,
+            decompress_response=False,
+            allow_nonstandard_methods=True,
+            connect_timeout=self.proxy.connect_timeout,
+            request_timeout=self.proxy.request_timeout,
+            header_callback=header_callback,
+            streaming_callback=streaming_callback,
+            validate_cert=self.proxy.validate_cert,
+        )
+        try:
+            response = await self.proxy.http_client.fetch(request, raise_error=False)
+            error = response.error if response.code == 599 else None
+        except OSError as e:
+            error = e
+        if error is not None:
+            # couldn't reach the target
+            self.proxy.log.warning(
+                "Proxy request to %s failed: %s", self._upstream_url(), error
+            )
+            if not upstream_status.get("written"):
+                await self._error_page(503)
+                return
+        else:
+            # write headers, in case the response had no body
+            write_headers()
+        self.finish()
+
+    head = post = put = patch = delete = options = proxy_request
+
+    def select_subprotocol(self, subprotocols):
+        # the target selects the subprotocol,
+        # which we can't know until we've connected,
+        # so select the first requested, as the target most likely will
+        if subprotocols:
+            return subprotocols[0]
+        return None
+
+    async def open(self, *args):
+        """Open a websocket to the target, before accepting messages"""
+        routespec = self.route["routespec"]
+        self.proxy._record_activity(routespec)
+        request = HTTPRequest(
+            self._upstream_url(
+                scheme="wss" if self.route["target"].startswith("https") else "ws"
+            ),
+            headers=self._upstream_headers(
+                exclude=_HOP_BY_HOP_HEADERS | _WEBSOCKET_HEADERS
+            ),
+            connect_timeout=self.proxy.connect_timeout,
+            validate_cert=self.proxy.validate_cert,
+        )
+
+        def on_upstream_message(message):
+            if message is None:
+                # target closed the connection
+                self.close()
+                return
+            self.proxy._record_activity(routespec)
+            try:
+                self.write_message(message, binary=isinstance(message, bytes))
+            except WebSocketClosedError:
+                pass
+
+        subprotocol = self.selected_subprotocol
+        try:
+            self.ws_client = await websocket_connect(
+                request,
+                on_message_callback=on_upstream_message,
+                subprotocols=[subprotocol] if subprotocol else None,
+            )
+        except Exception as e:
+            self.proxy.log.warning("Proxy websocket to %s failed: %s", request.url, e)
+            self.close(1011, "Failed to connect to target")
+
+    async def on_message(self, message):
+        self.proxy._record_activity(self.route["routespec"])
+        if self.ws_client is None:
+            return
+        try:
+            await self.ws_client.write_message(
+                message, binary=isinstance(message, bytes)
+            )
+        except WebSocketClosedError:
+            self.close()
+
+    def on_ping(self, data):
+        if self.ws_client is not None:
+            self.ws_client.ping(data)
+
+    def on_close(self):
+        if self.ws_client is not None:
+            self.ws_client.close(self.close_code, self.close_reason)
+            self.ws_client = None
+
+
+class InProcessProxy(Proxy):
+    """Proxy implementation running in the Hub's event loop
+
+    Routes are stored in memory, in a longest-prefix routing trie,
+    and requests (including websockets) are forwarded with tornado.
+
+    Because it runs in the Hub process,
+    it must be started by the Hub (``should_start`` is always True),
+    and all routes are lost when the Hub restarts, to be restored by the Hub on startup.
+    Targets on unix sockets are not supported.
+
+    Enable with::
+
+        c.JupyterHub.proxy_class = "in-process"
+
+    .. versionadded:: 6.0
+    """
+
+    connect_timeout = Float(
+        20,
+        config=True,
+        help="Timeout (in seconds) for connecting to route targets.",
+    )
+
+    request_timeout = Float(
+        0,
+        config=True,
+        help="""Timeout (in seconds) for complete requests to route targets.
+
+        0 means no timeout.
+        """,
+    )
+
+    validate_cert = Bool(
+        True,
+        config=True,
+        help="Whether to validate the certificates of https route targets.",
+    )
+
+    max_body_size = Integer(
+        100 * 1024 * 1024,
+        config=True,
+        help="Maximum size (in bytes) of request bodies forwarded to targets.",
+    )
+
+    http_server = Any()
+    http_client = Any()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        if not self.should_start:
+            raise ValueError(
+                f"{self.__class__.__name__} runs in the Hub process,"
+                " so should_start must be True"
+            )
+        # routespec -> route dict ({'routespec', 'target', 'data'})
+        self._routes = {}
+        # routespec -> time.time() of last activity
+        self._activity = {}
+        self._trie = RouteTrie()
+
+    def _key_for_routespec(self, routespec):
+        if self.host_routing and routespec != "/":
+            host, slash, path = routespec.partition("/")
+            return (host.lower(),) + _route_key(path)
+        return _route_key(routespec)
+
+    def _match_route(self, host, path):
+        """Return the route matching a request, or None
+
+        With host routing, the host is the first segment of the key,
+        and only the default route ('/') matches requests for any host.
+        """
+        key = _route_key(path)
+        if host is not None:
+            key = (host.lower(),) + key
+        routespec = self._trie.match(key)
+        if routespec is None:
+            return None
+        return self._routes[routespec]
+
+    def _record_activity(self, routespec):
+        self._activity[routespec] = time.time()
+
+    def _make_app(self):
+        return web.Application(
+            [(r".*", InProcessProxyHandler, {"proxy": self})],
+            # don't log every proxied request
+            log_function=lambda handler: None,
+            websocket_ping_interval=None,
+        )
+
+    async def start(self):
+        """Start listening for requests on the public URL"""
+        self.http_client = AsyncHTTPClient(force_instance=True)
+        ssl_context = None
+        if self.ssl_cert:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self.ssl_cert, self.ssl_key)
+        self.http_server = HTTPServer(
+            self._make_app(),
+            ssl_options=ssl_context,
+            max_body_size=self.max_body_size,
+            max_buffer_size=self.max_body_size,
+        )
+        server = Server.from_url(self.public_url)
+        if server._unix_socket:
+            self.http_server.add_socket(bind_unix_socket(unquote(server.connect_addr)))
+        else:
+            self.http_server.listen(server.port, address=server.ip)
+        self.log.info("In-process proxy listening on %s", server.bind_url)
+
+    async def stop(self):
+        """Stop listening and close connections"""
+        if self.http_server is not None:
+            self.http_server.stop()
+            await self.http_server.close_all_connections()
+            self.http_server = None
+        if self.http_client is not None:
+            self.http_client.close()
+            self.http_client = None
+
+    async def add_route(self, routespec, target, data):
+        routespec = self.validate_routespec(routespec)
+        if urlparse(target).scheme not in {"http", "https"}:
+            raise ValueError(f"In-process proxy cannot route to {target!r}")
+        self._routes[routespec] = {
+            "routespec": routespec,
+            "target": target,
+            "data": copy.deepcopy(data or {}),
+        }
+        self._trie.add(self._key_for_routespec(routespec), routespec)
+
+    async def delete_route(self, routespec):
+        routespec = self.validate_routespec(routespec)
+        if self._routes.pop(routespec, None) is None:
+            self.log.warning("Route %s already deleted", routespec)
+            return
+        self._activity.pop(routespec, None)
+        self._trie.remove(self._key_for_routespec(routespec))
+
+    async def add_routes(self, routes):
+        # no requests to make, so add them all at once
+        for routespec, target, data in routes:
+            await self.add_route(routespec, target, data)
+
+    async def delete_routes(self, routespecs):
+        for routespec in routespecs:
+            await self.delete_route(routespec)
+
+    def _route_model(self, route):
+        """Copy a route, with last_activity in its data like configurable-http-proxy"""
+        route = copy.deepcopy(route)
+        timestamp = self._activity.get(route["routespec"])
+        if timestamp is not None:
+            route["data"]["last_activity"] = datetime.fromtimestamp(
+                timestamp, timezone.utc
+            ).isoformat()
+        return route
+
+    async def get_all_routes(self):
+        return {
+            routespec: self._route_model(route)
+            for routespec, route in self._routes.items()
+        }
+
+    async def get_route(self, routespec):
+        routespec = self.validate_routespec(routespec)
+        route = self._routes.get(routespec)
+        if route is None:
+            return None
+        return self._route_model(route)
+
+    async def get_active_routes(self, since=None):
+        if since is None:
+            routespecs = list(self._activity)
+        else:
+            if since.tzinfo is None:
+                # naive timestamps are UTC
+                since = since.replace(tzinfo=timezone.utc)
+            cutoff = since.timestamp()
+            routespecs = [
+                routespec
+                for routespec, timestamp in self._activity.items()
+                if timestamp > cutoff
+            ]
+        return {
+            routespec: self._route_model(self._routes[routespec])
+            for routespec in routespecs
+        }
@@ -0,0 +1,336 @@
+"""A proxy spreading user routes across several backend proxies
+
+Enable with::
+
+    c.JupyterHub.proxy_class = "sharded"
+    c.ShardedProxy.shards = [
+        {"public_url": "http://127.0.0.1:8000", "api_url": "http://127.0.0.1:8001", "pid_file": "proxy-0.pid"},
+        {"public_url": "http://127.0.0.1:8010", "api_url": "http://127.0.0.1:8011", "pid_file": "proxy-1.pid"},
+    ]
+
+Each user server route is stored on exactly one shard,
+chosen by consistent hashing of its routespec,
+while routes for the Hub, services, and extra routes are stored on every shard.
+Whatever sends traffic to the shards (e.g. a load balancer or ingress)
+is responsible for sending requests for each user to the shard holding their routes,
+or to any shard for other routes.
+:meth:`ShardedProxy.shard_for` identifies the shard holding a route.
+
+.. versionadded:: 6.0
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+import asyncio
+import hashlib
+from bisect import bisect
+from functools import partial
+
+from traitlets import Any, Dict, Integer, List, TraitError, default, validate
+
+from ..proxy import ConfigurableHTTPProxy, Proxy, _one_at_a_time
+from ..traitlets import EntryPointType
+from ..utils import maybe_future, url_path_join
+
+
+def _hash(key):
+    """Stable 64-bit hash of a string, for placement on the hash ring"""
+    return int.from_bytes(hashlib.sha256(key.encode("utf8")).digest()[:8], "big")
+
+
+class ShardedProxy(Proxy):
+    """Proxy implementation spreading user routes across several proxies
+
+    User server routes are assigned to shards by consistent hashing on the routespec,
+    so adding or removing a shard only moves the routes of that shard.
+    Routes for the Hub, services, and :attr:`extra_routes` are replicated to every shard.
+
+    Operations on the shards are performed concurrently,
+    and :meth:`check_routes` reconciles each shard against the routes it should hold.
+
+    .. versionadded:: 6.0
+    """
+
+    shard_class = EntryPointType(
+        default_value=ConfigurableHTTPProxy,
+        klass=Proxy,
+        entry_point_group="jupyterhub.proxies",
+        config=True,
+        help="""The Proxy class to use for each shard.
+
+        Configuration for this class (e.g. `c.ConfigurableHTTPProxy.auth_token`)
+        applies to all shards, and can be overridden per-shard in :attr:`shards`.
+        """,
+    )
+
+    shards = List(
+        Dict(),
+        config=True,
+        help="""Configuration of each shard.
+
+        A list of dicts of trait values passed to :attr:`shard_class` for each shard,
+        e.g. `public_url` and `api_url` of each configurable-http-proxy.
+
+        Each dict may have a `name` key, identifying the shard on the hash ring (default: its index).
+        Names should not change when shards are added or removed,
+        so that routes of the remaining shards stay where they are.
+        """,
+    )
+
+    @validate("shards")
+    def _validate_shards(self, proposal):
+        shards = proposal.value
+        if not shards:
+            raise TraitError("ShardedProxy.shards must have at least one shard")
+        names = [str(shard.get("name", i)) for i, shard in enumerate(shards)]
+        if len(set(names)) != len(names):
+            raise TraitError(f"ShardedProxy.shards names must be unique, got {names}")
+        return shards
+
+    virtual_nodes = Integer(
+        128,
+        config=True,
+        help="""Number of points on the hash ring for each shard.
+
+        More points spread routes more evenly across shards.
+        """,
+    )
+
+    proxies = List(help="The Proxy instance of each shard")
+
+    @default("proxies")
+    def _default_proxies(self):
+        if not self.shards:
+            raise ValueError("ShardedProxy.shards must be configured")
+        proxies = []
+        for i, shard_config in enumerate(self.shards):
+            kwargs = dict(
+                db_factory=self.db_factory,
+                public_url=self.public_url,
+                parent=self,
+                app=self.app,
+                log=self.log,
+                hub=self.hub,
+                host_routing=self.host_routing,
+                ssl_cert=self.ssl_cert,
+                ssl_key=self.ssl_key,
+            )
+            kwargs.update(
+                {key: value for key, value in shard_config.items() if key != "name"}
+            )
+            proxy = self.shard_class(**kwargs)
+            # only restore this shard's own routes if it restarts
+            proxy._route_filter = partial(self._shard_holds, i)
+            proxies.append(proxy)
+        return proxies
+
+    _ring = Any()
+
+    @default("_ring")
+    def _default_ring(self):
+        ring = []
+        for i, shard_config in enumerate(self.shards):
+            name = str(shard_config.get("name", i))
+            for vnode in range(self.virtual_nodes):
+                ring.append((_hash(f"{name}-{vnode}"), i))
+        ring.sort()
+        return [point for point, i in ring], [i for point, i in ring]
+
+    def _is_sharded(self, routespec):
+        """Whether a route is a user server route, stored on only one shard"""
+        path = routespec[routespec.find("/") :]
+        return path.startswith(url_path_join(self.app.base_url, "user/"))
+
+    def _shard_index(self, routespec):
+        """Return the index of the shard holding a route, or None if it is on every shard"""
+        if not self._is_sharded(routespec):
+            return None
+        points, indices = self._ring
+        position = bisect(points, _hash(routespec)) % len(points)
+        return indices[position]
+
+    def _shard_holds(self, index, routespec):
+        """Whether the shard at `index` should hold a route"""
+        return self._shard_index(routespec) in {None, index}
+
+    def shard_for(self, routespec):
+        """Return the Proxy instance serving a route
+
+        For routes replicated to every shard, this is the first shard.
+        """
+        routespec = self.validate_routespec(routespec)
+        index = self._shard_index(routespec)
+        return self.proxies[index or 0]
+
+    async def start(self):
+        """Start every shard that should be started by the Hub"""
+        await asyncio.gather(
+            *(
+                maybe_future(proxy.start())
+                for proxy in self.proxies
+                if proxy.should_start
+            )
+        )
+
+    async def stop(self):
+        """Stop every shard started by the Hub"""
+        await asyncio.gather(
+            *(
+                maybe_future(proxy.stop())
+                for proxy in self.proxies
+                if proxy.should_start
+            )
+        )
+
+    def _group_routes(self, routes):
+        """Group (routespec, ...) tuples by the shards that should hold them
+
+        Returns a list of lists, one per shard.
+        """
+        groups = [[] for proxy in self.proxies]
+        for route in routes:
+            index = self._shard_index(self.validate_routespec(route[0]))
+            if index is None:
+                for group in groups:
+                    group.append(route)
+            else:
+                groups[index].append(route)
+        return groups
+
+    async def add_route(self, routespec, target, data):
+        await self.add_routes([(routespec, target, data)])
+
+    async def delete_route(self, routespec):
+        await self.delete_routes([routespec])
+
+    async def add_routes(self, routes):
+        groups = self._group_routes(routes)
+        await asyncio.gather(
+            *(
+                proxy.add_routes(group)
+                for proxy, group in zip(self.proxies, groups)
+                if group
+            )
+        )
+
+    async def delete_routes(self, routespecs):
+        groups = self._group_routes([(routespec,) for routespec in routespecs])
+        await asyncio.gather(
+            *(
+                proxy.delete_routes([routespec for (routespec,) in group])
+                for proxy, group in zip(self.proxies, groups)
+                if group
+            )
+        )
+
+    def _merge_routes(self, shard_routes):
+        """Merge the routing tables of all shards
+
+        Args:
+            shard_routes (list): the routes of each shard, as returned by get_all_routes
+
+        Returns:
+            routes (dict): the merged routing table.
+                User routes are taken from the shard that should hold them,
+                and replicated routes from the first shard that has them.
+            repairs (list): (to_add, to_delete) for each shard:
+                replicated routes missing or different on the shard,
+                and user routes on the wrong shard.
+        """
+        routes = {}
+        repairs = [([], []) for proxy in self.proxies]
+        for index, shard in enumerate(shard_routes):
+            for routespec, route in shard.items():
+                owner = self._shard_index(routespec)
+                if owner is None:
+                    routes.setdefault(routespec, route)
+                elif owner == index:
+                    routes[routespec] = route
+                else:
+                    self.log.warning(
+                        "Deleting route %s from shard %i, it belongs on shard %i",
+                        routespec,
+                        index,
+                        owner,
+                    )
+                    repairs[index][1].append(routespec)
+        for routespec, route in routes.items():
+            if self._shard_index(routespec) is not None:
+                continue
+            for index, shard in enumerate(shard_routes):
+                shard_route = shard.get(routespec)
+                if shard_route is None or shard_route["target"] != route["target"]:
+                    self.log.warning(
+                        "Replicating route %s to shard %i", routespec, index
+                    )
+                    repairs[index][0].append(
+                        (routespec, route["target"], route["data"])
+                    )
+        return routes, repairs
+
+    # per-shard routes of the last merged routing table returned by get_all_routes,
+    # so check_routes doesn't need to fetch them again
+    _last_shard_routes = Any(None)
+
+    async def _get_shard_routes(self):
+        return await asyncio.gather(*(proxy.get_all_routes() for proxy in self.proxies))
+
+    async def get_all_routes(self):
+        shard_routes = await self._get_shard_routes()
+        routes, repairs = self._merge_routes(shard_routes)
+        self._last_shard_routes = (routes, shard_routes)
+        return routes
+
+    async def get_route(self, routespec):
+        return await self.shard_for(routespec).get_route(routespec)
+
+    async def get_active_routes(self, since=None):
+        # raises NotImplementedError if any shard doesn't implement it
+        shard_routes = await asyncio.gather(
+            *(proxy.get_active_routes(since) for proxy in self.proxies)
+        )
+        routes = {}
+        for index, shard in enumerate(shard_routes):
+            for routespec, route in shard.items():
+                owner = self._shard_index(routespec)
+                if owner is not None and owner != index:
+                    continue
+                if routespec in routes:
+                    # replicated route, keep the most recent activity
+                    previous = routes[routespec]["data"].get("last_activity") or ""
+                    if (route["data"].get("last_activity") or "") <= previous:
+                        continue
+                routes[routespec] = route
+        return routes
+
+    @_one_at_a_time
+    async def check_routes(
+        self, user_dict, service_dict, routes=None, incremental=False
+    ):
+        """Check that all users are properly routed on the proxy.
+
+        In addition to the checks of :meth:`.Proxy.check_routes`,
+        moves user routes to the shard they belong on,
+        and makes sure every shard has all replicated routes.
+        """
+        if routes and self._last_shard_routes and routes is self._last_shard_routes[0]:
+            shard_routes = self._last_shard_routes[1]
+        else:
+            shard_routes = await self._get_shard_routes()
+        self._last_shard_routes = None
+        routes, repairs = self._merge_routes(shard_routes)
+
+        futures = []
+        for proxy, (to_add, to_delete) in zip(self.proxies, repairs):
+            if to_add:
+                futures.append(proxy.add_routes(to_add))
+            if to_delete:
+                futures.append(proxy.delete_routes(to_delete))
+        await asyncio.gather(*futures)
+
+        changed = await super().check_routes(
+            user_dict, service_dict, routes, incremental=incremental
+        )
+        return changed + sum(
+            len(to_add) + len(to_delete) for to_add, to_delete in repairs
+        )
@@ -18,10 +18,13 @@ Route Specification:
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 import asyncio
+import codecs
 import json
 import os
+import re
 import signal
 import time
+from collections.abc import Mapping
 from functools import wraps
 from subprocess import Popen
 from urllib.parse import quote, unquote, urlparse
@@ -47,7 +50,11 @@ from jupyterhub.httpclient import fetch
 from jupyterhub.traitlets import Command
 
 from . import utils
-from .metrics import CHECK_ROUTES_DURATION_SECONDS, PROXY_POLL_DURATION_SECONDS
+from .metrics import (
+    CHECK_ROUTES_DURATION_SECONDS,
+    PROXY_POLL_DURATION_SECONDS,
+    PROXY_RESTORE_DURATION_SECONDS,
+)
 from .objects import Server
 from .utils import (
     exponential_backoff,
@@ -79,6 +86,115 @@ def _one_at_a_time(method):
     return locked_method
 
 
+class Route(Mapping):
+    """A route in the proxy
+
+    A compact, read-only mapping with the keys
+    ``routespec``, ``target``, and ``data``,
+    in the format returned by :meth:`Proxy.get_all_routes`.
+    Proxies with very large routing tables can use this instead of a dict per route.
+
+    .. versionadded:: 6.0
+    """
+
+    __slots__ = ("routespec", "target", "data")
+
+    def __init__(self, routespec, target, data):
+        self.routespec = routespec
+        self.target = target
+        self.data = data
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.routespec} → {self.target}>"
+
+
+_json_whitespace = re.compile(r"[ \t\n\r]*")
+# characters that may continue a number or literal
+_json_scalar_tail = re.compile(r"[0-9a-zA-Z.+\-]*")
+
+
+async def _iter_json_object(chunks):
+    """Incrementally parse a JSON object from an async iterable of bytes
+
+    Yields the (key, value) pairs of the top-level object as each one is complete,
+    so the whole document is never held in memory at once.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf8")()
+    buf = ""
+    pos = 0
+    # what we expect next: '{', first key (or '}'), key, ':', value, ',' or '}', end
+    state = "start"
+    key = None
+    async for chunk in chunks:
+        buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+        while True:
+            pos = _json_whitespace.match(buf, pos).end()
+            if pos == len(buf):
+                break
+            if state == "start":
+                if buf[pos] != "{":
+                    raise ValueError(f"Expected JSON object, got {buf[pos:pos + 20]!r}")
+                pos += 1
+                state = "first"
+            elif state == "first" and buf[pos] == "}":
+                pos += 1
+                state = "end"
+            elif state in {"first", "key"}:
+                try:
+                    key, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # incomplete, wait for more data
+                    break
+                if not isinstance(key, str):
+                    raise ValueError(f"Expected JSON object key, got {key!r}")
+                pos = end
+                state = "colon"
+            elif state == "colon":
+                if buf[pos] != ":":
+                    raise ValueError(f"Expected ':', got {buf[pos:pos + 20]!r}")
+                pos += 1
+                state = "value"
+            elif state == "value":
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    break
+                if not isinstance(value, (dict, list, str)):
+                    if _json_scalar_tail.match(buf, end).end() == len(buf):
+                        # a number or literal may be truncated, wait for more data
+                        break
+                pos = end
+                state = "next"
+                yield key, value
+            elif state == "next":
+                if buf[pos] == ",":
+                    state = "key"
+                elif buf[pos] == "}":
+                    state = "end"
+                else:
+                    raise ValueError(f"Expected ',' or '}}', got {buf[pos:pos + 20]!r}")
+                pos += 1
+            else:
+                raise ValueError(
+                    f"Unexpected data after JSON object: {buf[pos:pos + 20]!r}"
+                )
+    if state != "end":
+        raise ValueError("Incomplete JSON object")
+
+
 class Proxy(LoggingConfigurable):
     """Base class for configurable proxies that JupyterHub can use.
 
@@ -97,10 +213,18 @@ class Proxy(LoggingConfigurable):
 
     And the following method(s) are optional, but can be provided:
 
+    - :meth:`.get_active_routes` returns only routes with recent activity.
+      If not implemented, the Hub polls :meth:`.get_all_routes` for activity.
+
+    - :meth:`.iter_routes` iterates over routes as they are fetched,
+      for large routing tables.
     - :meth:`.get_route` gets a single route.
       There is a default implementation that extracts data from :meth:`.get_all_routes`,
       but implementations may choose to provide a more efficient implementation
       of fetching a single route.
+    - :meth:`.add_routes` and :meth:`.delete_routes` add and delete routes in bulk.
+      The default implementations call :meth:`.add_route` and :meth:`.delete_route`
+      for each route, but implementations may provide a more efficient bulk operation.
     """
 
     db_factory = Any()
@@ -303,16 +427,84 @@ class Proxy(LoggingConfigurable):
         routes = await self.get_all_routes()
         return routes.get(routespec)
 
+    async def iter_routes(self):
+        """Iterate over all the routes associated by JupyterHub in the proxy
+
+        Yields ``(routespec, route)`` pairs,
+        in the same format as the items of :meth:`.get_all_routes`.
+
+        The default implementation iterates over :meth:`.get_all_routes`.
+        Implementations may override this to yield routes as they are received,
+        without holding the whole routing table in memory.
+
+        .. versionadded:: 6.0
+        """
+        routes = await self.get_all_routes()
+        for routespec, route in routes.items():
+            yield routespec, route
+
+    async def get_active_routes(self, since=None):
+        """Return the routes with activity more recent than `since`.
+
+        Used by the Hub to update last_activity timestamps
+        without fetching the whole routing table on every poll.
+
+        Args:
+            since (datetime): naive UTC datetime of the previous poll.
+                If None, return all routes with activity.
+
+        Returns:
+            routes (dict): routespec -> route dict, in the same format as :meth:`.get_all_routes`,
+                only including routes whose ``data['last_activity']`` is more recent than `since`.
+
+        Implementations that can efficiently select recently active routes
+        should implement this method.
+        The default raises NotImplementedError,
+        in which case the Hub uses :meth:`.get_all_routes` instead.
+
+        .. versionadded:: 6.0
+        """
+        raise NotImplementedError()
+
+    async def add_routes(self, routes):
+        """Add multiple routes to the proxy.
+
+        Args:
+            routes (list): list of ``(routespec, target, data)`` tuples,
+                with the same meaning as the arguments of :meth:`.add_route`.
+
+        The default implementation calls :meth:`.add_route` for each route concurrently.
+        Implementations may override this to add routes in bulk.
+
+        .. versionadded:: 6.0
+        """
+        await asyncio.gather(
+            *(
+                self.add_route(routespec, target, data)
+                for routespec, target, data in routes
+            )
+        )
+
+    async def delete_routes(self, routespecs):
+        """Delete multiple routes from the proxy.
+
+        Args:
+            routespecs (list): list of routespecs to delete.
+
+        The default implementation calls :meth:`.delete_route` for each route concurrently.
+        Implementations may override this to delete routes in bulk.
+
+        .. versionadded:: 6.0
+        """
+        await asyncio.gather(
+            *(self.delete_route(routespec) for routespec in routespecs)
+        )
+
     # Most basic implementers must only implement above methods
 
     async def add_service(self, service):
         """Add a service's server to the proxy table."""
-        if not service.server:
-            raise RuntimeError(
-                "Service %s does not have an http endpoint to add to the proxy.",
-                service.name,
-            )
-
+        route = self._service_route(service)
         self.log.info(
             "Adding service %s to proxy %s => %s",
             service.name,
@@ -320,13 +512,13 @@ class Proxy(LoggingConfigurable):
             service.server.host,
         )
 
-        await self.add_route(
-            service.proxy_spec, service.server.host, {'service': service.name}
-        )
+        self.mark_route_dirty(service.proxy_spec, ('service', service))
+        await self.add_route(*route)
 
     async def delete_service(self, service):
         """Remove a service's server from the proxy table."""
         self.log.info("Removing service %s from proxy", service.name)
+        self.mark_route_dirty(service.proxy_spec)
         await self.delete_route(service.proxy_spec)
 
     async def add_user(self, user, server_name=''):
@@ -338,26 +530,15 @@ class Proxy(LoggingConfigurable):
             spawner.proxy_spec,
             spawner.server.host,
         )
-
-        if spawner.pending and spawner.pending != 'spawn':
-            raise RuntimeError(
-                f"{spawner._log_name} is pending {spawner.pending}, shouldn't be added to the proxy yet!"
-            )
-
-        await self.add_route(
-            spawner.proxy_spec,
-            spawner.server.host,
-            {'user': user.name, 'server_name': server_name},
-        )
+        route = self._user_route(user, server_name)
+        self.mark_route_dirty(spawner.proxy_spec, ('user', user, server_name))
+        await self.add_route(*route)
 
     async def delete_user(self, user, server_name=''):
         """Remove a user's server from the proxy table."""
-        routespec = user.proxy_spec
-        if server_name:
-            routespec = url_path_join(
-                user.proxy_spec, url_escape_path(server_name), '/'
-            )
+        routespec = self._user_routespec(user, server_name)
         self.log.info("Removing user %s from proxy (%s)", user.name, routespec)
+        self.mark_route_dirty(routespec, ('user', user, server_name))
         await self.delete_route(routespec)
 
     async def add_all_services(self, service_dict):
@@ -365,127 +546,380 @@ class Proxy(LoggingConfigurable):
 
         Used when loading up a new proxy.
         """
-        futures = []
+        routes = []
         for service in service_dict.values():
             if service.server:
-                futures.append(self.add_service(service))
-        # wait after submitting them all
-        await asyncio.gather(*futures)
+                routes.append((('service', service), self._service_route(service)))
+        self.log.info("Adding %i service routes to proxy", len(routes))
+        await self._add_owned_routes(routes)
 
     async def add_all_users(self, user_dict):
         """Update the proxy table from the database.
 
         Used when loading up a new proxy.
         """
-        futures = []
+        routes = []
         for user in user_dict.values():
             for name, spawner in user.spawners.items():
                 if spawner.ready:
-                    futures.append(self.add_user(user, name))
-        # wait after submitting them all
+                    routes.append((('user', user, name), self._user_route(user, name)))
+        self.log.info("Adding %i user routes to proxy", len(routes))
+        await self._add_owned_routes(routes)
+
+    async def _add_owned_routes(self, owned_routes):
+        """Add routes, given as a list of ``(owner, (routespec, target, data))``
+
+        Routes are added in bulk with :meth:`.add_routes`,
+        except if a subclass overrides :meth:`.add_user` or :meth:`.add_service`:
+        then those are called for each route of a user's server or a service,
+        as they were before bulk route updates.
+        Owners are as in the route index (see :meth:`.check_routes`).
+        """
+        cls = type(self)
+        user_hook = cls.add_user is not Proxy.add_user
+        service_hook = cls.add_service is not Proxy.add_service
+        routes = []
+        futures = []
+        for owner, route in owned_routes:
+            if owner[0] == 'user' and user_hook:
+                _, user, server_name = owner
+                futures.append(self.add_user(user, server_name))
+            elif owner[0] == 'service' and service_hook:
+                futures.append(self.add_service(owner[1]))
+            else:
+                routes.append(route)
+        if routes:
+            futures.append(self.add_routes(routes))
         await asyncio.gather(*futures)
 
+    check_routes_full_interval = Integer(
+        3600,
+        config=True,
+        help="""
+        Interval (in seconds) between full sweeps in periodic route checks.
+
+        Periodic route checks (see `JupyterHub.route_check_interval`)
+        only reconcile routes whose state may have changed since the previous check:
+        servers that have started or stopped, services that have been added or removed,
+        and routes that differ between the proxy and the Hub's last-known routing table.
+        Every `check_routes_full_interval` seconds, a full check of every user,
+        server, and service is performed instead.
+
+        Set to 0 to perform a full check every time.
+
+        .. versionadded:: 6.0
+        """,
+    )
+
+    # index of the routes the Hub wants in the proxy
+    # routespec -> (owner, target), where owner is one of:
+    # ('hub',), ('extra',), ('user', user, server_name), ('service', service)
+    # target is None for routes of pending servers, which should be left alone
+    _route_index = Dict()
+    # routes that need to be checked on the next incremental check
+    # routespec -> owner (or None if unknown)
+    _dirty_routes = Dict()
+    _last_full_check = Any(None)
+    # optional callable(routespec) -> bool, restricting the routes restored by
+    # restore_routes to those this proxy is responsible for (e.g. one shard of a ShardedProxy)
+    _route_filter = Any(None)
+
+    def mark_route_dirty(self, routespec, owner=None):
+        """Mark a route to be reconciled on the next incremental route check
+
+        Called on state changes (servers starting and stopping, services being added and removed).
+        """
+        self._dirty_routes[routespec] = owner
+
+    def _user_routespec(self, user, server_name=''):
+        """Return the routespec for a user's server"""
+        routespec = user.proxy_spec
+        if server_name:
+            routespec = url_path_join(
+                user.proxy_spec, url_escape_path(server_name), '/'
+            )
+        return routespec
+
     @_one_at_a_time
-    async def check_routes(self, user_dict, service_dict, routes=None):
-        """Check that all users are properly routed on the proxy."""
+    async def check_routes(
+        self, user_dict, service_dict, routes=None, incremental=False
+    ):
+        """Check that all users are properly routed on the proxy.
+
+        If `incremental` is True, only routes that may have changed since the last check
+        are reconciled, unless a full check is due according to
+        :attr:`check_routes_full_interval`.
+
+        Returns the number of routes that were added, updated, or deleted.
+
+        .. versionchanged:: 6.0
+            Added `incremental` argument, and return the number of changed routes.
+        """
         start = time.perf_counter()  # timer starts here when user is created
         if not routes:
             self.log.debug("Fetching routes to check")
             routes = await self.get_all_routes()
 
-        self.log.debug("Checking routes")
+        now = time.monotonic()
+        if (
+            incremental
+            and self.check_routes_full_interval
+            and self._last_full_check is not None
+            and now - self._last_full_check < self.check_routes_full_interval
+        ):
+            self.log.debug("Checking changed routes")
+            to_add, to_delete = self._check_routes_incremental(
+                user_dict, service_dict, routes
+            )
+        else:
+            self.log.debug("Checking routes")
+            to_add, to_delete = self._check_routes_full(user_dict, service_dict, routes)
+            self._last_full_check = now
 
-        user_routes = {path for path, r in routes.items() if 'user' in r['data']}
         futures = []
+        if to_add:
+            futures.append(self._add_owned_routes(to_add))
+        if to_delete:
+            futures.append(self.delete_routes(to_delete))
+        await asyncio.gather(*futures)
+        stop = time.perf_counter()  # timer stops here when user is deleted
+        CHECK_ROUTES_DURATION_SECONDS.observe(stop - start)  # histogram metric
+        return len(to_add) + len(to_delete)
 
-        good_routes = {self.app.hub.routespec}
+    def _check_routes_full(self, user_dict, service_dict, routes):
+        """Check every route the Hub knows about
 
-        hub = self.hub
-        if self.app.hub.routespec not in routes:
-            futures.append(self.add_hub_route(hub))
-        else:
-            route = routes[self.app.hub.routespec]
-            if route['target'] != hub.host:
-                self.log.warning(
-                    "Updating Hub route %s → %s", route['target'], hub.host
-                )
-                futures.append(self.add_hub_route(hub))
+        Rebuilds the route index from scratch.
+
+        Returns lists of ``(owner, route)`` to add and routespecs to delete.
+        """
+        to_add = []
+        to_delete = []
+        self._route_index = {}
+        # everything is going to be checked
+        self._dirty_routes = {}
+
+        self._check_hub_route(routes, to_add)
 
         for user in user_dict.values():
             for name, spawner in user.spawners.items():
-                if spawner.ready:
-                    spec = spawner.proxy_spec
-                    good_routes.add(spec)
-                    if spec not in user_routes:
-                        self.log.warning(
-                            "Adding missing route for %s (%s)", spec, spawner.server
-                        )
-                        futures.append(self.add_user(user, name))
-                    else:
-                        route = routes[spec]
-                        if route['target'] != spawner.server.host:
-                            self.log.warning(
-                                "Updating route for %s (%s → %s)",
-                                spec,
-                                route['target'],
-                                spawner.server,
-                            )
-                            futures.append(self.add_user(user, name))
-                elif spawner.pending:
-                    # don't consider routes stale if the spawner is in any pending event
-                    # wait until after the pending state clears before taking any actions
-                    # they could be pending deletion from the proxy!
-                    good_routes.add(spawner.proxy_spec)
-
-        # check service routes
-        service_routes = {
-            r['data']['service']: r for r in routes.values() if 'service' in r['data']
-        }
+                self._check_spawner_route(user, name, spawner, routes, to_add)
+
         for service in service_dict.values():
-            if service.server is None:
-                continue
-            good_routes.add(service.proxy_spec)
-            if service.name not in service_routes:
-                self.log.warning(
-                    "Adding missing route for %s (%s)", service.name, service.server
-                )
-                futures.append(self.add_service(service))
-            else:
-                route = service_routes[service.name]
-                if route['target'] != service.server.host:
-                    self.log.warning(
-                        "Updating route for %s (%s → %s)",
-                        route['routespec'],
-                        route['target'],
-                        service.server.host,
-                    )
-                    futures.append(self.add_service(service))
+            self._check_service_route(service, routes, to_add)
 
         # Add extra routes we've been configured for
         for routespec, url in self.extra_routes.items():
-            good_routes.add(routespec)
-            futures.append(self.add_route(routespec, url, {'extra': True}))
+            self._route_index[routespec] = (('extra',), url)
+            to_add.append((('extra',), (routespec, url, {'extra': True})))
 
         # Now delete the routes that shouldn't be there
         for routespec in routes:
-            if routespec not in good_routes:
+            if routespec not in self._route_index:
                 self.log.warning("Deleting stale route %s", routespec)
-                futures.append(self.delete_route(routespec))
+                to_delete.append(routespec)
+        return to_add, to_delete
 
-        await asyncio.gather(*futures)
-        stop = time.perf_counter()  # timer stops here when user is deleted
-        CHECK_ROUTES_DURATION_SECONDS.observe(stop - start)  # histogram metric
+    def _check_routes_incremental(self, user_dict, service_dict, routes):
+        """Check only routes that may have changed
+
+        Checks:
+
+        - routes marked with :meth:`mark_route_dirty`
+        - routes in the proxy that are not in the route index, and vice versa
+        - routes whose target in the proxy doesn't match the route index
+        - routes of pending servers
+
+        Returns lists of ``(owner, route)`` to add and routespecs to delete.
+        """
+        to_add = []
+        to_delete = []
+        dirty = self._dirty_routes
+        self._dirty_routes = {}
+        index = self._route_index
+
+        for routespec in routes.keys() - index.keys():
+            dirty.setdefault(routespec, None)
+        for routespec, (owner, target) in index.items():
+            route = routes.get(routespec)
+            if target is None:
+                # always check pending routes
+                dirty.setdefault(routespec, owner)
+            elif route is None or route['target'] != target:
+                dirty.setdefault(routespec, owner)
+
+        if not dirty:
+            return to_add, to_delete
+
+        users_by_name = None
+        for routespec, owner in dirty.items():
+            indexed = index.pop(routespec, None)
+            if owner is None and indexed is not None:
+                owner = indexed[0]
+            route = routes.get(routespec)
+            if owner is None and route is not None:
+                # identify the owner from the route data
+                data = route['data']
+                if data.get('hub'):
+                    owner = ('hub',)
+                elif data.get('extra'):
+                    owner = ('extra',)
+                elif 'user' in data:
+                    if users_by_name is None:
+                        users_by_name = {u.name: u for u in user_dict.values()}
+                    user = users_by_name.get(data['user'])
+                    if user is not None:
+                        owner = ('user', user, data.get('server_name', ''))
+                elif 'service' in data:
+                    service = service_dict.get(data['service'])
+                    if service is not None:
+                        owner = ('service', service)
+            if owner is None:
+                if routespec == self.app.hub.routespec:
+                    owner = ('hub',)
+                elif routespec in self.extra_routes:
+                    owner = ('extra',)
+
+            kind = owner[0] if owner else None
+            if kind == 'hub':
+                self._check_hub_route(routes, to_add)
+            elif kind == 'extra':
+                url = self.extra_routes.get(routespec)
+                if url is not None:
+                    self._route_index[routespec] = (owner, url)
+                    if route is None or route['target'] != url:
+                        to_add.append((owner, (routespec, url, {'extra': True})))
+            elif kind == 'user':
+                _, user, name = owner
+                spawner = user.spawners.get(name)
+                # look in the cache only, UserDict.get would load users
+                # removed from it (e.g. by evict_idle) again
+                if spawner is not None and dict.get(user_dict, user.id) is user:
+                    self._check_spawner_route(user, name, spawner, routes, to_add)
+            elif kind == 'service':
+                service = owner[1]
+                if service_dict.get(service.name) is service:
+                    self._check_service_route(service, routes, to_add)
+
+            if routespec in routes and routespec not in self._route_index:
+                self.log.warning("Deleting stale route %s", routespec)
+                to_delete.append(routespec)
+        return to_add, to_delete
+
+    def _check_hub_route(self, routes, to_add):
+        """Check the Hub's own route"""
+        hub = self.hub
+        routespec = self.app.hub.routespec
+        self._route_index[routespec] = (('hub',), hub.host)
+        if routespec not in routes:
+            to_add.append((('hub',), self._hub_route(hub)))
+        else:
+            route = routes[routespec]
+            if route['target'] != hub.host:
+                self.log.warning(
+                    "Updating Hub route %s → %s", route['target'], hub.host
+                )
+                to_add.append((('hub',), self._hub_route(hub)))
+
+    def _check_spawner_route(self, user, name, spawner, routes, to_add):
+        """Check the route for a single server"""
+        owner = ('user', user, name)
+        if spawner.ready:
+            spec = spawner.proxy_spec
+            self._route_index[spec] = (owner, spawner.server.host)
+            route = routes.get(spec)
+            if route is None or 'user' not in route['data']:
+                self.log.warning(
+                    "Adding missing route for %s (%s)", spec, spawner.server
+                )
+                to_add.append((owner, self._user_route(user, name)))
+            elif route['target'] != spawner.server.host:
+                self.log.warning(
+                    "Updating route for %s (%s → %s)",
+                    spec,
+                    route['target'],
+                    spawner.server,
+                )
+                to_add.append((owner, self._user_route(user, name)))
+        elif spawner.pending:
+            # don't consider routes stale if the spawner is in any pending event
+            # wait until after the pending state clears before taking any actions
+            # they could be pending deletion from the proxy!
+            self._route_index[spawner.proxy_spec] = (owner, None)
+
+    def _check_service_route(self, service, routes, to_add):
+        """Check the route for a single service"""
+        if service.server is None:
+            return
+        spec = service.proxy_spec
+        owner = ('service', service)
+        self._route_index[spec] = (owner, service.server.host)
+        route = routes.get(spec)
+        if route is None or route['data'].get('service') != service.name:
+            self.log.warning(
+                "Adding missing route for %s (%s)", service.name, service.server
+            )
+            to_add.append((owner, self._service_route(service)))
+        elif route['target'] != service.server.host:
+            self.log.warning(
+                "Updating route for %s (%s → %s)",
+                route['routespec'],
+                route['target'],
+                service.server.host,
+            )
+            to_add.append((owner, self._service_route(service)))
+
+    def _hub_route(self, hub):
+        """Return (routespec, target, data) for the Hub's route"""
+        return (hub.routespec, self.hub.host, {'hub': True})
+
+    def _user_route(self, user, server_name=''):
+        """Return (routespec, target, data) for a user's server"""
+        spawner = user.spawners[server_name]
+        if spawner.pending and spawner.pending != 'spawn':
+            raise RuntimeError(
+                f"{spawner._log_name} is pending {spawner.pending}, shouldn't be added to the proxy yet!"
+            )
+        return (
+            spawner.proxy_spec,
+            spawner.server.host,
+            {'user': user.name, 'server_name': server_name},
+        )
+
+    def _service_route(self, service):
+        """Return (routespec, target, data) for a service"""
+        if not service.server:
+            raise RuntimeError(
+                f"Service {service.name} does not have an http endpoint to add to the proxy."
+            )
+        return (service.proxy_spec, service.server.host, {'service': service.name})
 
     def add_hub_route(self, hub):
         """Add the default route for the Hub"""
         self.log.info("Adding route for Hub: %s => %s", hub.routespec, hub.host)
-        return self.add_route(hub.routespec, self.hub.host, {'hub': True})
+        return self.add_route(*self._hub_route(hub))
 
     async def restore_routes(self):
         self.log.info("Setting up routes on new proxy")
-        await self.add_hub_route(self.app.hub)
-        await self.add_all_users(self.app.users)
-        await self.add_all_services(self.app._service_map)
+        restore_start = time.perf_counter()
+        # restore all routes in a single bulk operation
+        routes = [(('hub',), self._hub_route(self.app.hub))]
+        for user in self.app.users.values():
+            for name, spawner in user.spawners.items():
+                if spawner.ready:
+                    routes.append((('user', user, name), self._user_route(user, name)))
+        for service in self.app._service_map.values():
+            if service.server:
+                routes.append((('service', service), self._service_route(service)))
+        if self._route_filter is not None:
+            routes = [
+                (owner, route)
+                for owner, route in routes
+                if self._route_filter(route[0])
+            ]
+        self.log.info("Restoring %i routes", len(routes))
+        await self._add_owned_routes(routes)
+        PROXY_RESTORE_DURATION_SECONDS.observe(time.perf_counter() - restore_start)
         self.log.info("New proxy back up and good to go")
 
 
@@ -1020,20 +1454,29 @@ class ConfigurableHTTPProxy(Proxy):
         """Reformat CHP data format to JupyterHub's proxy API."""
         target = chp_data.pop('target')
         chp_data.pop('jupyterhub')
-        return {'routespec': routespec, 'target': target, 'data': chp_data}
+        return Route(routespec, target, chp_data)
+
+    async def iter_routes(self):
+        """Fetch the proxy's routes, yielding them as they are parsed
+
+        The routing table is parsed incrementally as it is received,
+        so the whole response is never held in memory.
+        """
+        resp = await self.api_request('')
+        async with resp:
+            async for chp_path, chp_data in _iter_json_object(
+                resp.content.iter_chunked(64 * 1024)
+            ):
+                routespec = self._routespec_from_chp_path(chp_path)
+                if 'jupyterhub' not in chp_data:
+                    # exclude routes not associated with JupyterHub
+                    self.log.debug("Omitting non-jupyterhub route %r", routespec)
+                    continue
+                yield routespec, self._reformat_routespec(routespec, chp_data)
 
     async def get_all_routes(self):
         """Fetch the proxy's routes."""
         proxy_poll_start_time = time.perf_counter()
-        resp = await self.api_request('')
-        chp_routes = await resp.json()
-        all_routes = {}
-        for chp_path, chp_data in chp_routes.items():
-            routespec = self._routespec_from_chp_path(chp_path)
-            if 'jupyterhub' not in chp_data:
-                # exclude routes not associated with JupyterHub
-                self.log.debug("Omitting non-jupyterhub route %r", routespec)
-                continue
-            all_routes[routespec] = self._reformat_routespec(routespec, chp_data)
+        all_routes = {routespec: route async for routespec, route in self.iter_routes()}
         PROXY_POLL_DURATION_SECONDS.observe(time.perf_counter() - proxy_poll_start_time)
         return all_routes
@@ -100,6 +100,38 @@ def roles_to_scopes(roles):
     return raw_scopes
 
 
+# role id: (raw scopes, expanded scopes without owner), see _expanded_role_scopes
+_role_scopes = {}
+
+
+def _expanded_role_scopes(role):
+    """Get the scopes of a role, expanded as far as possible without an owner
+
+    Stored per role until its scopes change,
+    since roles are held by many users, and change rarely.
+
+    Returns (expanded, owner_scopes) from scopes.expand_scopes_without_owner
+    """
+    raw_scopes = frozenset(role.scopes)
+    entry = _role_scopes.get(role.id)
+    if entry is None or entry[0] != raw_scopes:
+        entry = (raw_scopes, scopes.expand_scopes_without_owner(raw_scopes))
+        if role.id is not None:
+            _role_scopes[role.id] = entry
+    return entry[1]
+
+
+def clear_expanded_role_scopes(role=None):
+    """Discard stored expansions of role scopes
+
+    For one role, or all roles if unspecified (e.g. when scope definitions change).
+    """
+    if role is None:
+        _role_scopes.clear()
+    else:
+        _role_scopes.pop(role.id, None)
+
+
 def roles_to_expanded_scopes(roles, owner):
     """Returns a set of fully expanded scopes for a specified role or list of roles
 
@@ -111,7 +143,13 @@ def roles_to_expanded_scopes(roles, owner):
     Returns:
       expanded scopes (set): set of all expanded scopes for the role(s)
     """
-    return scopes.expand_scopes(roles_to_scopes(roles), owner=owner)
+    expanded = frozenset()
+    owner_scopes = frozenset()
+    for role in roles:
+        role_expanded, role_owner_scopes = _expanded_role_scopes(role)
+        expanded |= role_expanded
+        owner_scopes |= role_owner_scopes
+    return scopes.expand_scopes_for_owner(expanded, owner_scopes, owner)
 
 
 _role_name_pattern = re.compile(r'^[a-z][a-z0-9\-_~\.]{1,253}[a-z0-9]$')
@@ -217,6 +255,10 @@ def create_role(db, role_dict, *, commit=True, reset_to_defaults=True):
                 )
     if commit:
         db.commit()
+    if role.id is not None:
+        # store the expanded scopes of the new definition
+        clear_expanded_role_scopes(role)
+        _expanded_role_scopes(role)
     return role
 
 
@@ -229,6 +271,7 @@ def delete_role(db, rolename):
 
     role = orm.Role.find(db, rolename)
     if role:
+        clear_expanded_role_scopes(role)
         db.delete(role)
         db.commit()
         app_log.info('Role %s has been deleted', rolename)
@@ -29,6 +29,12 @@ from tornado import web
 from tornado.log import app_log
 
 from . import orm, roles
+from ._authz_cache import (
+    bump_generation,
+    get_generation,
+    group_membership,
+    scope_cache,
+)
 from ._memoize import DoNotCache, FrozenDict, lru_cache_key
 
 """when modifying the scope definitions
@@ -195,8 +201,12 @@ class Scope(Enum):
 
 
 def _intersection_cache_key(scopes_a, scopes_b, db=None):
-    """Cache key function for scope intersections"""
-    return (frozenset(scopes_a), frozenset(scopes_b))
+    """Cache key function for scope intersections
+
+    With a db, intersections may depend on group membership.
+    """
+    version = group_membership.version if db is not None else None
+    return (frozenset(scopes_a), frozenset(scopes_b), version)
 
 
 @lru_cache_key(_intersection_cache_key)
@@ -217,21 +227,10 @@ def _intersect_expanded_scopes(scopes_a, scopes_b, db=None):
     scopes_a = frozenset(scopes_a)
     scopes_b = frozenset(scopes_b)
 
-    # cached lookups for group membership of users and servers
-    @lru_cache
     def groups_for_user(username):
         """Get set of group names for a given username"""
-        # if we need a group lookup, the result is not cacheable
-        nonlocal needs_db
-        needs_db = True
-        group_query = (
-            db.query(orm.Group.name)
-            .join(orm.User.groups)
-            .filter(orm.User.name == username)
-        )
-        return {row[0] for row in group_query}
+        return group_membership.groups_for_user(db, username)
 
-    @lru_cache
     def groups_for_server(server):
         """Get set of group names for a given server"""
         username, _, servername = server.partition("/")
@@ -240,9 +239,8 @@ def _intersect_expanded_scopes(scopes_a, scopes_b, db=None):
     parsed_scopes_a = parse_scopes(scopes_a)
     parsed_scopes_b = parse_scopes(scopes_b)
 
-    # track whether we need a db lookup (for groups)
-    # because we can't cache the intersection if we do
-    # if there are no group filters, this is cacheable
+    # track whether we needed a db lookup (for groups) but didn't have one,
+    # because we can't cache an incomplete intersection
     needs_db = False
 
     common_bases = parsed_scopes_a.keys() & parsed_scopes_b.keys()
@@ -316,7 +314,6 @@ def _intersect_expanded_scopes(scopes_a, scopes_b, db=None):
                     # resolve group/server hierarchy if db available
                     servers = servers.difference(common_servers)
                     if db is not None and servers and 'group' in b:
-                        needs_db = True
                         for server in servers:
                             server_groups = groups_for_server(server)
                             if server_groups & b['group']:
@@ -348,7 +345,7 @@ def _intersect_expanded_scopes(scopes_a, scopes_b, db=None):
 
     intersection = unparse_scopes(common_filters)
     if needs_db:
-        # return intersection, but don't cache it if it needed db lookups
+        # return intersection, but don't cache it if it was missing db lookups
         return DoNotCache(intersection)
 
     return intersection
@@ -379,6 +376,22 @@ def get_scopes_for(orm_object):
                 f"Only allow orm objects or User wrappers, got {orm_object}"
             )
 
+    key = scope_cache.key_for(orm_object)
+    if key is None:
+        return _resolve_scopes_for(orm_object)
+    # read the generation before resolving,
+    # so changes made while resolving invalidate the result
+    generation = get_generation()
+    cached = scope_cache.get(key, generation)
+    if cached is not None:
+        return cached
+    expanded_scopes = _resolve_scopes_for(orm_object)
+    scope_cache.set(key, generation, expanded_scopes)
+    return expanded_scopes
+
+
+def _resolve_scopes_for(orm_object):
+    """Resolve scopes for an orm object, bypassing the cache"""
     owner = None
     if isinstance(orm_object, orm.APIToken):
         owner = orm_object.user or orm_object.service
@@ -579,6 +592,32 @@ def expand_scopes(scopes, owner=None, oauth_client=None):
       expanded scopes (set): set of all expanded scopes, with filters applied for the owner
     """
     expanded_scopes = set(chain.from_iterable(map(_expand_scope, scopes)))
+    owner_scopes = {scope for scope in expanded_scopes if _depends_on_owner(scope)}
+    expanded_scopes -= owner_scopes
+    expanded_scopes |= _fill_owner_scopes(owner_scopes, owner, oauth_client)
+
+    # reduce to discard overlapping scopes
+    # return immutable frozenset because the result is cached
+    return frozenset(reduce_scopes(expanded_scopes))
+
+
+# filters filled in for the owner by expand_scopes
+_owner_filters = {"user", "service", "server"}
+
+
+def _depends_on_owner(scope):
+    """Whether an expanded scope is `self` or has a filter to fill in for the owner"""
+    return scope == 'self' or scope.partition('!')[2] in _owner_filters
+
+
+def _fill_owner_scopes(owner_scopes, owner, oauth_client=None):
+    """Fill in expanded scopes that depend on the owner, for expand_scopes
+
+    Returns the set of scopes for the owner
+    """
+    filled_scopes = set()
+    if not owner_scopes:
+        return filled_scopes
 
     filter_replacements = {
         "user": None,
@@ -599,36 +638,69 @@ def expand_scopes(scopes, owner=None, oauth_client=None):
             spawner = oauth_client.spawner
             filter_replacements["server"] = f"server={spawner.user.name}/{spawner.name}"
 
-    for scope in expanded_scopes.copy():
-        base_scope, _, filter = scope.partition('!')
-        if filter in filter_replacements:
-            # translate !user into !user={username}
-            # and !service into !service={servicename}
-            # and !server into !server={username}/{servername}
-            expanded_scopes.remove(scope)
-            expanded_filter = filter_replacements[filter]
-            if expanded_filter:
-                # translate
-                expanded_scopes.add(f'{base_scope}!{expanded_filter}')
+    for scope in owner_scopes:
+        if scope == 'self':
+            if user_name:
+                filled_scopes |= _expand_self_scope(user_name)
             else:
                 warnings.warn(
-                    f"Not expanding !{filter} filter without target {filter} in {scope}",
-                    stacklevel=3,
+                    f"Not expanding 'self' scope for owner {owner} which is not a User",
+                    stacklevel=4,
                 )
-
-    if 'self' in expanded_scopes:
-        expanded_scopes.remove('self')
-        if user_name:
-            expanded_scopes |= _expand_self_scope(user_name)
+            continue
+        base_scope, _, filter = scope.partition('!')
+        # translate !user into !user={username}
+        # and !service into !service={servicename}
+        # and !server into !server={username}/{servername}
+        expanded_filter = filter_replacements[filter]
+        if expanded_filter:
+            filled_scopes.add(f'{base_scope}!{expanded_filter}')
         else:
             warnings.warn(
-                f"Not expanding 'self' scope for owner {owner} which is not a User",
-                stacklevel=3,
+                f"Not expanding !{filter} filter without target {filter} in {scope}",
+                stacklevel=4,
             )
+    return filled_scopes
 
-    # reduce to discard overlapping scopes
-    # return immutable frozenset because the result is cached
-    return frozenset(reduce_scopes(expanded_scopes))
+
+def expand_scopes_without_owner(scopes):
+    """Expand raw scopes as far as possible without knowing their owner
+
+    For precomputing the expanded scopes of roles,
+    which are held by many users and services.
+    Finish with :func:`expand_scopes_for_owner`.
+
+    Arguments:
+      scopes (collection(str)): collection of raw scopes
+
+    Returns:
+      (expanded, owner_scopes) where
+      expanded (frozenset): expanded scopes that don't depend on the owner
+      owner_scopes (frozenset): expanded scopes that do, i.e. `self`
+          and scopes with owner-based filters such as `!user`
+    """
+    expanded = frozenset(chain.from_iterable(map(_expand_scope, scopes)))
+    owner_scopes = frozenset(filter(_depends_on_owner, expanded))
+    return expanded - owner_scopes, owner_scopes
+
+
+def expand_scopes_for_owner(expanded, owner_scopes, owner):
+    """Finish expanding scopes from :func:`expand_scopes_without_owner`
+
+    Equivalent to `expand_scopes(scopes, owner=owner)`,
+    but only the owner-dependent scopes are expanded.
+
+    Arguments:
+      expanded (collection(str)): expanded scopes that don't depend on the owner
+      owner_scopes (collection(str)): expanded scopes that do
+      owner (obj): orm.User or orm.Service holding the scopes
+
+    Returns:
+      expanded scopes (frozenset)
+    """
+    if owner_scopes:
+        expanded = frozenset(expanded).union(_fill_owner_scopes(owner_scopes, owner))
+    return reduce_scopes(expanded)
 
 
 def _resolve_requested_scopes(requested_scopes, have_scopes, user, client, db):
@@ -1149,6 +1221,64 @@ def check_scope_filter(sub_scope, orm_resource, kind):
     return False
 
 
+def _user_filter_clause(sub_scope):
+    """SQL clause selecting orm.User rows matching a scope filter"""
+    clauses = []
+    if 'user' in sub_scope:
+        clauses.append(orm.User.name.in_(sub_scope['user']))
+    if 'group' in sub_scope:
+        clauses.append(orm.User.groups.any(orm.Group.name.in_(sub_scope['group'])))
+    return sa.or_(sa.false(), *clauses)
+
+
+def _server_filter_clause(sub_scope):
+    """SQL clause selecting orm.Spawner rows matching a scope filter"""
+    servers = sub_scope.get('server', [])
+    # check_scope_filter matches the server name alone, too
+    clauses = [orm.Spawner.name.in_(servers)] if servers else []
+    for server in servers:
+        user_name, _, server_name = server.partition('/')
+        clauses.append(
+            sa.and_(
+                orm.Spawner.name == server_name,
+                orm.Spawner.user.has(orm.User.name == user_name),
+            )
+        )
+    if 'user' in sub_scope or 'group' in sub_scope:
+        # fall back on access to the owner of the server
+        clauses.append(orm.Spawner.user.has(_user_filter_clause(sub_scope)))
+    return sa.or_(sa.false(), *clauses)
+
+
+def scope_filter_clause(sub_scope, kind):
+    """Return a SQL clause selecting the resources a sub_scope filter applies to
+
+    The database equivalent of :func:`check_scope_filter`,
+    so list queries only fetch the rows a request has access to,
+    instead of checking every resource in Python.
+
+    param sub_scope: parsed_scopes filter (i.e. dict or Scope.ALL)
+    param kind: 'user', 'group', or 'server',
+        for clauses on orm.User, orm.Group, or orm.Spawner, respectively.
+
+    Services are listed from memory and shares by owner,
+    so there are no clauses for them.
+
+    Returns a clause for ``query.filter()``,
+    or None if sub_scope is Scope.ALL and no filter is needed.
+    """
+    if sub_scope is Scope.ALL:
+        return None
+    if kind == 'user':
+        return _user_filter_clause(sub_scope)
+    elif kind == 'group':
+        return orm.Group.name.in_(sub_scope.get('group', []))
+    elif kind == 'server':
+        return _server_filter_clause(sub_scope)
+    else:
+        raise ValueError(f"kind must be 'user', 'group', or 'server', not {kind!r}")
+
+
 def describe_parsed_scopes(parsed_scopes, username=None):
     """Return list of descriptions of parsed scopes
 
@@ -1327,3 +1457,6 @@ def define_custom_scopes(scopes):
         # deferred evaluation for debug-logging
         app_log.debug("Defining custom scope %s=%s", scope, scope_definition)
         scope_definitions[scope] = scope_definition
+    # expansion of custom scopes may have changed
+    roles.clear_expanded_role_scopes()
+    bump_generation()
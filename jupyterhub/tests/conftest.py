@@ -44,9 +44,11 @@ from traitlets import default
 
 import jupyterhub.services.service
 
-from .. import crypto, orm, scopes
+from .. import _authz_cache, crypto, orm, scopes
+from .._memoize import clear_caches
 from ..roles import (
     assign_default_roles,
+    clear_expanded_role_scopes,
     create_role,
     get_default_roles,
     mock_roles,
@@ -158,7 +160,9 @@ def db():
     _db.commit()
     assign_default_roles(_db, user)
     _db.commit()
-    return _db
+    yield _db
+    # don't leave permissions cached from this database for the next test
+    _authz_cache.reset()
 
 
 @fixture(scope='module')
@@ -601,6 +605,9 @@ def preserve_scopes():
     scope_definitions = copy.deepcopy(scopes.scope_definitions)
     yield scope_definitions
     scopes.scope_definitions = scope_definitions
+    _authz_cache.bump_generation()
+    clear_caches()
+    clear_expanded_role_scopes()
 
 
 # collect db query counts and report the top N tests by db query count
@@ -0,0 +1,143 @@
+"""Mock configurable-http-proxy REST API
+
+Implements the routing table API of configurable-http-proxy
+(``/api/routes``), without proxying any requests,
+so that ConfigurableHTTPProxy can be tested and benchmarked without node.
+
+The server runs in a background thread with its own event loop,
+so its work does not block the Hub's event loop, like a separate proxy process.
+
+Latency and errors can be injected to simulate a slow or flaky proxy.
+"""
+
+import asyncio
+import json
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+from tornado import web
+from tornado.httpserver import HTTPServer
+
+from jupyterhub.utils import isoformat, random_port
+
+
+class RoutesHandler(web.RequestHandler):
+    """The /api/routes endpoint of configurable-http-proxy"""
+
+    def initialize(self, chp):
+        self.chp = chp
+
+    async def prepare(self):
+        chp = self.chp
+        chp.request_count[self.request.method] += 1
+        if self.request.headers.get("Authorization") != f"token {chp.auth_token}":
+            raise web.HTTPError(403)
+        if chp.latency:
+            await asyncio.sleep(chp.latency)
+        if chp.error_rate and chp.random.random() < chp.error_rate:
+            chp.error_count += 1
+            self.set_status(500)
+            self.finish("injected error")
+
+    def _path(self, path):
+        # CHP stores unescaped paths without trailing slash
+        path = unquote(path).rstrip("/")
+        return path or "/"
+
+    def get(self, path):
+        routes = self.chp.routes
+        if path.strip("/"):
+            route = routes.get(self._path(path))
+            if route is None:
+                raise web.HTTPError(404)
+            routes = route
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(routes))
+
+    def post(self, path):
+        data = json.loads(self.request.body)
+        data["last_activity"] = isoformat(datetime.now(timezone.utc))
+        self.chp.routes[self._path(path)] = data
+        self.set_status(201)
+
+    def delete(self, path):
+        self.chp.routes.pop(self._path(path), None)
+        self.set_status(204)
+
+
+class MockCHP:
+    """Mock configurable-http-proxy REST API, running in a background thread
+
+    Use as a context manager::
+
+        with MockCHP(auth_token="secret") as chp:
+            c.ConfigurableHTTPProxy.api_url = chp.api_url
+
+    Args:
+        auth_token (str): the token the Hub must use
+        latency (float): seconds to wait before handling each request
+        error_rate (float): fraction of requests that fail with a 500 error
+        seed (int): random seed for error injection
+        port (int): port for the API (default: random)
+    """
+
+    def __init__(self, auth_token, latency=0, error_rate=0, seed=None, port=None):
+        self.auth_token = auth_token
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.port = port or random_port()
+        self.api_url = f"http://127.0.0.1:{self.port}"
+        # CHP path -> route data
+        self.routes = {}
+        self.request_count = Counter()
+        self.error_count = 0
+        self._loop = None
+        self._thread = None
+
+    def set_activity(self, path, timestamp):
+        """Set the last_activity of a route, as if it had received traffic"""
+        self.routes[path]["last_activity"] = isoformat(timestamp)
+
+    def reset_counts(self):
+        self.request_count = Counter()
+        self.error_count = 0
+
+    def _run(self, started):
+        self._loop = loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application(
+            [(r"/api/routes(.*)", RoutesHandler, {"chp": self})],
+            log_function=lambda handler: None,
+        )
+        server = HTTPServer(app)
+        server.listen(self.port, "127.0.0.1")
+        loop.call_soon(started.set)
+        try:
+            loop.run_forever()
+        finally:
+            server.stop()
+            loop.close()
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
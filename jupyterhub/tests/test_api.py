@@ -4,6 +4,8 @@ import asyncio
 import json
 import re
 import sys
+import threading
+import time
 import uuid
 from copy import deepcopy
 from dataclasses import dataclass
@@ -14,13 +16,16 @@ from urllib.parse import parse_qs, quote, urlparse
 import pytest
 from dateutil.parser import parse as parse_date
 from pytest import fixture, mark
+from sqlalchemy import event
 from tornado.httputil import url_concat
 from tornado.web import HTTPError
 
 import jupyterhub
 
 from .. import orm
-from ..apihandlers.base import PAGINATION_MEDIA_TYPE
+from .._memoize import LRUCache
+from ..apihandlers.base import PAGINATION_MEDIA_TYPE, encode_cursor
+from ..dbexecutor import DatabaseExecutor
 from ..objects import Server
 from ..spawner import SpawnException
 from ..utils import url_path_join as ujoin
@@ -74,6 +79,53 @@ async def test_auth_api(app):
     assert r.status_code == 403
 
 
+async def test_token_auth_threaded(app):
+    db = app.db
+    user = add_user(db, app=app, name="threaded-auth")
+    api_token = user.new_api_token()
+    cookies = await app.login_user(user.name)
+    # neither cached nor loaded in the Hub's session
+    app.tornado_settings['api_token_cache'].clear()
+    db.expunge(orm.APIToken.find(db, api_token))
+    main_thread = threading.current_thread()
+    on_loop = []
+
+    # inject database latency for token lookups
+    def slow_token_query(conn, cursor, statement, *args):
+        if "FROM api_tokens" in statement:
+            if threading.current_thread() is main_thread:
+                on_loop.append(statement)
+            time.sleep(0.2)
+
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.02)
+            ticks += 1
+
+    engine = db.get_bind()
+    event.listen(engine, "before_cursor_execute", slow_token_query)
+    ticker = asyncio.create_task(tick())
+    try:
+        with mock.patch.object(DatabaseExecutor, "threaded", True):
+            r = await api_request(
+                app, 'user', headers={'Authorization': f'token {api_token}'}
+            )
+            cookie_r = await api_request(app, 'user', cookies=cookies)
+    finally:
+        ticker.cancel()
+        event.remove(engine, "before_cursor_execute", slow_token_query)
+    assert r.status_code == 200
+    assert r.json()['name'] == user.name
+    assert cookie_r.status_code == 200
+    assert cookie_r.json()['name'] == user.name
+    # the token was looked up off the event loop, which kept running
+    assert on_loop == []
+    assert ticks >= 5
+
+
 @mark.parametrize(
     "content_type, status",
     [
@@ -615,6 +667,129 @@ async def test_get_users_sort_invalid(app):
     assert r.status_code == 400
 
 
+@mark.user
+@pytest.mark.parametrize(
+    "sort", ["id", "name", "-name", "last_activity", "-last_activity"]
+)
+async def test_get_users_cursor(app, sort):
+    db = app.db
+    now = utcnow()
+    # ties and NULLs in last_activity are ordered by id
+    last_activities = [now, None, now - timedelta(hours=1), None, now]
+    for i, last_activity in enumerate(last_activities):
+        u = add_user(db, app=app, name=f'cursor-{(7 * i) % 5}')
+        u.last_activity = last_activity
+    db.commit()
+
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    params = {"name_filter": "cursor-", "sort": sort}
+    r = await api_request(app, 'users', params=params, headers=headers)
+    assert r.status_code == 200
+    expected = [u["name"] for u in r.json()["items"]]
+    assert len(expected) == 5
+
+    # follow cursors, 2 at a time
+    params["limit"] = 2
+    params["include_count"] = "false"
+    names = []
+    pages = 0
+    while True:
+        r = await api_request(app, 'users', params=params, headers=headers)
+        assert r.status_code == 200
+        page = r.json()
+        pages += 1
+        names.extend(u["name"] for u in page["items"])
+        pagination = page["_pagination"]
+        assert pagination["total"] is None
+        if pagination["next"] is None:
+            break
+        next_query = parse_qs(urlparse(pagination["next"]["url"]).query)
+        if "after" in params:
+            # next url continues with a cursor
+            assert pagination["offset"] is None
+            assert next_query["after"] == [pagination["next"]["after"]]
+            assert "offset" not in next_query
+        params["after"] = pagination["next"]["after"]
+    assert pages == 3
+    assert names == expected
+
+    # a cursor is only valid for the same sort
+    params["sort"] = "-id" if sort == "id" else "id"
+    r = await api_request(app, 'users', params=params, headers=headers)
+    assert r.status_code == 400
+
+
+@mark.user
+async def test_get_users_read_replica(app, tmp_path):
+    # an empty database standing in for a replica that hasn't caught up
+    replica_url = f"sqlite:///{tmp_path / 'replica.sqlite'}"
+    orm.new_session_factory(replica_url)().close()
+    executor = app.db_executor
+    executor.read_session_factory = orm.new_read_session_factory(replica_url)
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    try:
+        # reads don't count as writes, consecutive reads stay on the replica
+        for i in range(2):
+            r = await api_request(app, "users", headers=headers)
+            assert r.status_code == 200
+            page = r.json()
+            assert page["items"] == []
+            assert page["_pagination"]["total"] == 0
+
+        # after a write, the client reads from the primary
+        r = await api_request(
+            app, "users/replica-rw", method="post", data=json.dumps({})
+        )
+        assert r.status_code == 201
+        r = await api_request(app, "users", headers=headers)
+        assert r.status_code == 200
+        page = r.json()
+        assert "replica-rw" in [u["name"] for u in page["items"]]
+        assert page["_pagination"]["total"] == app.db.query(orm.User).count()
+    finally:
+        executor.read_session_factory = None
+        executor._recent_writers.clear()
+
+
+async def test_get_users_cursor_invalid(app):
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    r = await api_request(app, "users", params={"after": "notacursor"}, headers=headers)
+    assert r.status_code == 400
+    r = await api_request(
+        app, "users", params={"limit": 1, "include_count": "false"}, headers=headers
+    )
+    assert r.status_code == 200
+    after = r.json()["_pagination"]["next"]["after"]
+    r = await api_request(
+        app, "users", params={"after": after, "offset": 1}, headers=headers
+    )
+    assert r.status_code == 400
+    r = await api_request(app, "users", params={"include_count": "x"}, headers=headers)
+    assert r.status_code == 400
+
+
+@mark.parametrize(
+    "sort, value",
+    [
+        ("id", "1"),
+        ("id", True),
+        ("name", {"a": 1}),
+        ("name", ["a"]),
+        ("name", None),
+        ("last_activity", {}),
+        ("last_activity", 5),
+        ("-last_activity", ["2024-01-01T00:00:00"]),
+    ],
+)
+async def test_get_users_cursor_value_type(app, sort, value):
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    after = encode_cursor(sort, value, 1)
+    r = await api_request(
+        app, "users", params={"sort": sort, "after": after}, headers=headers
+    )
+    assert r.status_code == 400
+
+
 @mark.user
 async def test_get_self(app):
     db = app.db
@@ -1757,6 +1932,17 @@ async def test_get_proxy_pagination(app, offset):
     assert list(reply["items"].keys()) == [app.hub.routespec][offset:]
 
 
+async def test_get_proxy_after(app):
+    # routes don't support cursor pagination
+    r = await api_request(
+        app,
+        "proxy",
+        params={"after": encode_cursor("id", 1, 1)},
+        headers={"Accept": PAGINATION_MEDIA_TYPE},
+    )
+    assert r.status_code == 400
+
+
 async def test_cookie(app):
     db = app.db
     name = 'patience'
@@ -2129,6 +2315,52 @@ async def test_groups_list(app):
         }
     ]
 
+    # Test cursor for pagination
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    r = await api_request(app, "groups?limit=1", headers=headers)
+    r.raise_for_status()
+    page = r.json()
+    assert [g['name'] for g in page['items']] == ['alphaflight']
+    assert page['_pagination']['total'] == 2
+    after = page['_pagination']['next']['after']
+    r = await api_request(
+        app, f"groups?limit=1&include_count=false&after={after}", headers=headers
+    )
+    r.raise_for_status()
+    page = r.json()
+    assert [g['name'] for g in page['items']] == ['betaflight']
+    assert page['_pagination']['total'] is None
+    assert page['_pagination']['offset'] is None
+    assert page['_pagination']['next'] is None
+
+
+@mark.group
+async def test_groups_list_count_cache(app):
+    headers = {"Accept": PAGINATION_MEDIA_TYPE}
+    with mock.patch.dict(
+        app.tornado_settings, {"api_page_count_cache": LRUCache(ttl=60)}
+    ):
+        r = await api_request(app, "groups", headers=headers)
+        r.raise_for_status()
+        total = r.json()['_pagination']['total']
+        group = orm.Group(name='count-cache')
+        app.db.add(group)
+        app.db.commit()
+        try:
+            # the cached count is used
+            r = await api_request(app, "groups", headers=headers)
+            r.raise_for_status()
+            page = r.json()
+            assert page['_pagination']['total'] == total
+            assert 'count-cache' in [g['name'] for g in page['items']]
+            app.tornado_settings["api_page_count_cache"].clear()
+            r = await api_request(app, "groups", headers=headers)
+            r.raise_for_status()
+            assert r.json()['_pagination']['total'] == total + 1
+        finally:
+            app.db.delete(group)
+            app.db.commit()
+
 
 @mark.group
 async def test_add_multi_group(app):
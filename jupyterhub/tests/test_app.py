@@ -2,26 +2,31 @@
 
 import asyncio
 import binascii
+import gc
 import json
 import logging
 import os
 import re
 import sys
 import time
+import weakref
 from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from subprocess import PIPE, Popen, check_output
 from tempfile import NamedTemporaryFile, TemporaryDirectory
 from unittest.mock import patch
 
 import pytest
 import traitlets
+from sqlalchemy import event, inspect
 from traitlets.config import Config
 
 from jupyterhub.roles import get_default_roles
 from jupyterhub.scopes import get_scopes_for
 
-from .. import orm
+from .. import metrics, orm
 from ..app import COOKIE_SECRET_BYTES, JupyterHub
+from ..utils import utcnow
 from .mocking import MockHub
 from .test_api import add_user
 
@@ -401,6 +406,40 @@ def test_url_config(hub_config, expected):
         assert getattr(app, key) == value
 
 
+def test_memoize_cache_sizes():
+    from jupyterhub import scopes
+
+    cache = scopes.expand_scopes.cache
+    maxsize = cache.maxsize
+    try:
+        cfg = Config()
+        cfg.JupyterHub.memoize_cache_sizes = {"jupyterhub.scopes.expand_scopes": 5}
+        hub = JupyterHub(config=cfg)
+        # validating the config doesn't resize caches
+        assert cache.maxsize == maxsize
+        hub.init_memoize_caches()
+        assert cache.maxsize == 5
+    finally:
+        cache.resize(maxsize)
+
+    for sizes in (
+        {"jupyterhub.scopes.nosuchfunction": 5},
+        {"jupyterhub.scopes.expand_scopes": 0},
+    ):
+        cfg = Config()
+        cfg.JupyterHub.memoize_cache_sizes = sizes
+        with pytest.raises(ValueError):
+            JupyterHub(config=cfg)
+    assert cache.maxsize == maxsize
+
+
+def test_purge_expired_batch_size():
+    cfg = Config()
+    cfg.JupyterHub.purge_expired_batch_size = 0
+    with pytest.raises(ValueError):
+        JupyterHub(config=cfg)
+
+
 @pytest.mark.parametrize(
     "base_url, hub_routespec, expected_routespec, should_warn, bad_prefix",
     [
@@ -676,3 +715,204 @@ async def test_revoke_blocked_users(username, groupname, new_hub):
     kept_user = app2.users[kept_username]
     assert 'user' in [r.name for r in kept_user.roles]
     await app2.stop()
+
+
+def _count_db_executions(db):
+    """Return a list that counts statements executed on db"""
+    executions = []
+
+    @event.listens_for(db.get_bind(), "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        executions.append(statement)
+
+    return executions
+
+
+@pytest.mark.parametrize("n_routes", [10, 100, 1000])
+async def test_record_route_activity_query_count(n_routes):
+    # the number of queries for recording activity should not depend
+    # on the number of routes
+    hub = MockHub(db_url="sqlite:///:memory:")
+    hub.init_db()
+    db = hub.db
+    now = utcnow(with_tz=False)
+    routes = {}
+    for i in range(n_routes):
+        orm_user = orm.User(name=f"activity-{i}")
+        db.add(orm_user)
+        orm_spawner = orm.Spawner(user=orm_user, name="")
+        orm_spawner.server = orm.Server()
+        db.add(orm_spawner)
+        routes[f"/user/{orm_user.name}/"] = {
+            "routespec": f"/user/{orm_user.name}/",
+            "target": "http://127.0.0.1:1234",
+            "data": {
+                "user": orm_user.name,
+                "server_name": "",
+                "last_activity": (now - timedelta(seconds=i)).isoformat() + "Z",
+            },
+        }
+    db.commit()
+    # start from a clean session, with one user loaded
+    db.expunge_all()
+    loaded_user = orm.User.find(db, "activity-0")
+
+    executions = _count_db_executions(db)
+    assert await hub._record_route_activity(routes)
+    # one SELECT, one executemany UPDATE per table (plus connection ping)
+    assert len(executions) <= 4, executions
+    # objects in the session are updated
+    assert loaded_user.last_activity == now
+    for i in range(n_routes):
+        orm_user = orm.User.find(db, f"activity-{i}")
+        expected = now - timedelta(seconds=i)
+        assert orm_user.last_activity == expected
+        assert orm_user.orm_spawners[""].last_activity == expected
+
+
+async def test_record_route_activity_monotonic():
+    # activity written since the running servers were read isn't overwritten
+    hub = MockHub(db_url="sqlite:///:memory:")
+    hub.init_db()
+    db = hub.db
+    now = utcnow(with_tz=False)
+    orm_user = orm.User(name="activity-race", last_activity=now - timedelta(hours=1))
+    db.add(orm_user)
+    orm_spawner = orm.Spawner(user=orm_user, name="")
+    orm_spawner.server = orm.Server()
+    db.add(orm_spawner)
+    db.commit()
+    user_id = orm_user.id
+
+    newer = now + timedelta(minutes=1)
+    engine = db.get_bind()
+    written = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def concurrent_write(conn, cursor, statement, parameters, context, executemany):
+        if written or not statement.lstrip().startswith("UPDATE users"):
+            return
+        # another writer updates activity after the running servers are read
+        cursor.connection.cursor().execute(
+            "UPDATE users SET last_activity = ? WHERE id = ?",
+            (newer.isoformat(sep=" "), user_id),
+        )
+        written.append(True)
+
+    try:
+        user_updates, spawner_updates, missing = hub._write_route_activity(
+            db, {("activity-race", ""): now}
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", concurrent_write)
+    assert written
+    assert user_updates == {user_id: now}
+    assert missing == []
+    db.commit()
+    db.expire_all()
+    assert orm.User.find(db, "activity-race").last_activity == newer
+
+
+async def test_prune_db_session(app):
+    db = app.db
+    now = utcnow(with_tz=False)
+    idle = add_user(
+        db, app=app, name="prune-idle", last_activity=now - timedelta(hours=2)
+    )
+    active = add_user(db, app=app, name="prune-active", last_activity=now)
+    held = add_user(
+        db, app=app, name="prune-held", last_activity=now - timedelta(hours=2)
+    )
+    looked_up = add_user(
+        db, app=app, name="prune-looked-up", last_activity=now - timedelta(hours=2)
+    )
+    group = orm.Group(name="prune-group")
+    db.add(group)
+    idle.orm_user.groups.append(group)
+    db.commit()
+    assert idle.orm_user in group.users
+    idle.new_api_token()
+    idle_id = idle.id
+    idle_ref = weakref.ref(idle.orm_user)
+    # a stopped server
+    held.spawners['']
+    # not looked up since long ago
+    for user in (idle, held):
+        user._last_used = 0
+    del idle
+
+    assert app.db_session_prune_idle_seconds == 3600
+    await app.prune_db_session()
+    assert idle_id not in app.users
+    assert held.id not in app.users
+    assert active.id in app.users
+    # recently looked up, e.g. by a request in progress
+    assert looked_up.id in app.users
+    # the idle user's objects can be garbage-collected
+    gc.collect()
+    assert idle_ref() is None
+    # collections holding on to the user are expired
+    assert "users" not in inspect(group).dict
+    # the active user's objects are still loaded
+    assert "name" in inspect(active.orm_user).dict
+    assert metrics.DB_SESSION_OBJECTS.labels(table="users")._value.get() >= 1
+    # route checks don't load removed users again
+    app.proxy.mark_route_dirty(held.proxy_spec, ('user', held, ''))
+    await app.proxy.check_routes(app.users, app._service_map, incremental=True)
+    assert held.id not in app.users
+    # loaded again on demand
+    assert app.users[idle_id].name == "prune-idle"
+    # a removed user that's still in use is put back, not duplicated
+    assert app.users[held.id] is held
+    assert app.users["prune-held"] is held
+    db.delete(group)
+    db.commit()
+
+
+async def test_activity_buffer():
+    hub = MockHub(db_url="sqlite:///:memory:")
+    hub.init_db()
+    db = hub.db
+    buffer = hub.activity_buffer
+    now = utcnow(with_tz=False)
+    users = []
+    for i in range(10):
+        orm_user = orm.User(name=f"buffered-{i}")
+        db.add(orm_user)
+        orm_spawner = orm.Spawner(user=orm_user, name="")
+        db.add(orm_spawner)
+        users.append(orm_user)
+    db.commit()
+    token = users[0].new_api_token()
+    orm_token = orm.APIToken.find(db, token)
+    stale_user = users[-1]
+    stale_user.last_activity = now
+    db.commit()
+
+    for orm_user in users:
+        for seconds in (30, 10, 20):
+            dt = now - timedelta(seconds=seconds)
+            assert not buffer.record(orm_user, dt)
+            assert not buffer.record(orm_user.orm_spawners[""], dt)
+    assert not buffer.record(orm_token, now)
+    # objects in the session are up-to-date, but not modified
+    assert users[0].last_activity == now - timedelta(seconds=10)
+    assert stale_user.last_activity == now
+    assert not db.dirty
+    assert len(buffer) == 2 * len(users) + 1
+
+    executions = _count_db_executions(db)
+    assert await buffer.flush()
+    # one executemany UPDATE per table (plus connection ping)
+    assert len(executions) <= 4, executions
+    assert len(buffer) == 0
+
+    db.expire_all()
+    for orm_user in users[:-1]:
+        assert orm_user.last_activity == now - timedelta(seconds=10)
+        assert orm_user.orm_spawners[""].last_activity == now - timedelta(seconds=10)
+    # activity is never moved backward
+    assert stale_user.last_activity == now
+    assert orm_token.last_activity == now
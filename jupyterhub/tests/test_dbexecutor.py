@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from .. import orm
+from .._query_stats import current_query_stats, start_query_stats
+from ..dbexecutor import DatabaseExecutor
+
+
+@pytest.fixture
+def file_db(tmp_path):
+    db = orm.new_session_factory(f"sqlite:///{tmp_path / 'jupyterhub.sqlite'}")()
+    yield db
+    db.close()
+
+
+def _add_user(db, name):
+    db.add(orm.User(name=name))
+    return threading.current_thread().name
+
+
+def _slow_count(db):
+    time.sleep(0.5)
+    return db.query(orm.User).count()
+
+
+def _fail(db, name):
+    db.add(orm.User(name=name))
+    db.flush()
+    raise ValueError("oops")
+
+
+async def test_inline():
+    db = orm.new_session_factory("sqlite:///:memory:")()
+    executor = DatabaseExecutor(db=db)
+    assert not executor.threaded
+    thread_name = await executor.run(_add_user, "inline")
+    assert thread_name == threading.current_thread().name
+    assert orm.User.find(db, "inline") is not None
+    # the transaction of the shared session is left to the caller
+    db.rollback()
+    assert orm.User.find(db, "inline") is None
+    with pytest.raises(ValueError):
+        await executor.run(_fail, "failed")
+    assert orm.User.find(db, "failed") is not None
+    db.rollback()
+
+
+async def test_threaded(file_db):
+    executor = DatabaseExecutor(db=file_db)
+    with mock.patch.object(DatabaseExecutor, "threaded", True):
+        thread_name = await executor.run(_add_user, "threaded")
+        assert thread_name.startswith("jupyterhub-db")
+        assert orm.User.find(file_db, "threaded") is not None
+
+        # the event loop keeps running while the database is busy
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.05)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        stats = start_query_stats()
+        try:
+            count = await executor.run(_slow_count)
+        finally:
+            ticker.cancel()
+        assert count == 1
+        assert ticks >= 5
+        # queries in threads are attributed to the caller's context
+        assert current_query_stats() is stats
+        assert stats.count >= 1
+
+        # errors are raised and the work is rolled back
+        with pytest.raises(ValueError):
+            await executor.run(_fail, "failed")
+        assert orm.User.find(file_db, "failed") is None
+    executor.close()
+
+
+async def test_query_stats_stop():
+    db = orm.new_session_factory("sqlite:///:memory:")()
+    db.query(orm.User).count()
+    stats = start_query_stats()
+    db.query(orm.User).count()
+    assert stats.count == 1
+
+    async def later():
+        await asyncio.sleep(0)
+        db.query(orm.User).count()
+
+    # tasks inherit the request's context,
+    # but don't count once the request is finished
+    task = asyncio.create_task(later())
+    stats.stop()
+    await task
+    assert current_query_stats() is stats
+    assert stats.count == 1
+    db.close()
+
+
+def _count_users(db):
+    return db.query(orm.User).count()
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+async def test_read_replica(file_db, tmp_path, threaded):
+    # an empty database standing in for a replica that hasn't caught up
+    replica_url = f"sqlite:///{tmp_path / 'replica.sqlite'}"
+    orm.new_session_factory(replica_url)().close()
+    executor = DatabaseExecutor(
+        db=file_db, read_session_factory=orm.new_read_session_factory(replica_url)
+    )
+    file_db.add(orm.User(name="primary"))
+    file_db.commit()
+    with mock.patch.object(DatabaseExecutor, "threaded", threaded):
+        assert await executor.run(_count_users) == 1
+        assert await executor.run_read(_count_users) == 0
+    executor.close()
+
+    # read-your-writes
+    assert not executor.wrote_recently("user:someone")
+    executor.record_write("user:someone")
+    assert executor.wrote_recently("user:someone")
+    assert not executor.wrote_recently("user:other")
+
+
+async def test_no_read_replica():
+    db = orm.new_session_factory("sqlite:///:memory:")()
+    executor = DatabaseExecutor(db=db)
+    db.add(orm.User(name="primary"))
+    db.commit()
+    assert await executor.run_read(_count_users) == 1
+    # nothing to track without a replica
+    executor.record_write("user:someone")
+    assert not executor.wrote_recently("user:someone")
@@ -0,0 +1,179 @@
+"""Tests for the in-process proxy"""
+
+from datetime import timedelta
+
+import pytest
+from tornado import web, websocket
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+
+from ..objects import Hub
+from ..proxies.inprocess import InProcessProxy, RouteTrie, _route_key
+from ..utils import random_port, utcnow
+
+
+class EchoHandler(web.RequestHandler):
+    def get(self, *args):
+        self.set_header("X-Target", self.settings["name"])
+        self.write(
+            {
+                "name": self.settings["name"],
+                "uri": self.request.uri,
+                "forwarded_for": self.request.headers.get("X-Forwarded-For"),
+            }
+        )
+
+    def post(self, *args):
+        self.write(self.request.body)
+
+
+class ErrorHandler(web.RequestHandler):
+    def get(self, status_code):
+        self.write(f"error {status_code} {self.get_argument('url')}")
+
+
+class EchoWebSocket(websocket.WebSocketHandler):
+    def on_message(self, message):
+        self.write_message(f"{self.settings['name']}: {message}")
+
+
+def start_backend(name):
+    port = random_port()
+    app = web.Application(
+        [
+            (r"/hub/error/(\d+)", ErrorHandler),
+            (r".*/ws", EchoWebSocket),
+            (r".*", EchoHandler),
+        ],
+        name=name,
+    )
+    server = HTTPServer(app)
+    server.listen(port, "127.0.0.1")
+    return server, f"http://127.0.0.1:{port}"
+
+
+@pytest.fixture
+async def backends():
+    servers = {}
+    for name in ("hub", "alice", "bob"):
+        servers[name] = start_backend(name)
+    yield {name: url for name, (server, url) in servers.items()}
+    for server, url in servers.values():
+        server.stop()
+
+
+@pytest.fixture
+async def proxy(backends):
+    port = random_port()
+    hub_port = int(backends["hub"].rsplit(":", 1)[1])
+    proxy = InProcessProxy(
+        public_url=f"http://127.0.0.1:{port}/",
+        hub=Hub(ip="127.0.0.1", port=hub_port, base_url="/hub/"),
+    )
+    await proxy.start()
+    await proxy.add_route("/", backends["hub"], {"hub": True})
+    yield proxy
+    await proxy.stop()
+
+
+async def fetch(proxy, path, **kwargs):
+    client = AsyncHTTPClient()
+    return await client.fetch(
+        proxy.public_url.rstrip("/") + path, raise_error=False, **kwargs
+    )
+
+
+def test_route_trie():
+    trie = RouteTrie()
+    trie.add(_route_key("/"), "/")
+    trie.add(_route_key("/user/alice/"), "/user/alice/")
+    trie.add(_route_key("/user/alice/named/"), "/user/alice/named/")
+    assert trie.match(_route_key("/user/alice/tree")) == "/user/alice/"
+    assert trie.match(_route_key("/user/alice/named/tree")) == "/user/alice/named/"
+    assert trie.match(_route_key("/user/alicex/tree")) == "/"
+    trie.remove(_route_key("/user/alice/"))
+    assert trie.match(_route_key("/user/alice/tree")) == "/"
+    assert trie.match(_route_key("/user/alice/named/tree")) == "/user/alice/named/"
+    trie.remove(_route_key("/user/alice/named/"))
+    assert trie._root.children == {}
+    # removing missing routes is a no-op
+    trie.remove(_route_key("/user/bob/"))
+    assert trie.match(_route_key("/user/alice/")) == "/"
+
+
+def test_should_start_required():
+    with pytest.raises(ValueError):
+        InProcessProxy(should_start=False)
+
+
+async def test_inprocess_routing(proxy, backends):
+    await proxy.add_route("/user/alice/", backends["alice"], {"user": "alice"})
+    await proxy.add_routes(
+        [
+            ("/user/bob/", backends["bob"], {"user": "bob"}),
+            ("/user/bob/named/", backends["alice"], {"user": "bob"}),
+        ]
+    )
+    for path, name in [
+        ("/hub/home", "hub"),
+        ("/user/alice/tree?x=1", "alice"),
+        ("/user/bob/api", "bob"),
+        ("/user/bob/named/api", "alice"),
+        ("/user/alicex/", "hub"),
+    ]:
+        r = await fetch(proxy, path)
+        assert r.code == 200
+        assert r.headers["X-Target"] == name
+        model = r.body.decode("utf8")
+        assert path in model
+        assert "127.0.0.1" in model
+
+    r = await fetch(proxy, "/user/alice/post", method="POST", body="hello")
+    assert r.code == 200
+    assert r.body == b"hello"
+
+    routes = await proxy.get_all_routes()
+    assert sorted(routes) == ["/", "/user/alice/", "/user/bob/", "/user/bob/named/"]
+    assert routes["/user/alice/"]["target"] == backends["alice"]
+    assert routes["/user/alice/"]["data"]["user"] == "alice"
+    assert "last_activity" in routes["/user/alice/"]["data"]
+
+    await proxy.delete_routes(["/user/bob/", "/user/bob/named/"])
+    assert await proxy.get_route("/user/bob/") is None
+    r = await fetch(proxy, "/user/bob/api")
+    assert r.headers["X-Target"] == "hub"
+
+
+async def test_inprocess_unreachable(proxy):
+    await proxy.add_route(
+        "/user/gone/", f"http://127.0.0.1:{random_port()}", {"user": "gone"}
+    )
+    r = await fetch(proxy, "/user/gone/tree")
+    assert r.code == 503
+    assert b"error 503 /user/gone/tree" in r.body
+
+
+async def test_inprocess_websocket(proxy, backends):
+    await proxy.add_route("/user/alice/", backends["alice"], {"user": "alice"})
+    url = proxy.public_url.replace("http", "ws", 1) + "user/alice/ws"
+    ws = await websocket.websocket_connect(url)
+    try:
+        await ws.write_message("hi")
+        assert await ws.read_message() == "alice: hi"
+    finally:
+        ws.close()
+
+
+async def test_inprocess_active_routes(proxy, backends):
+    await proxy.add_route("/user/alice/", backends["alice"], {"user": "alice"})
+    await proxy.add_route("/user/bob/", backends["bob"], {"user": "bob"})
+    assert await proxy.get_active_routes() == {}
+
+    before = utcnow() - timedelta(seconds=1)
+    await fetch(proxy, "/user/alice/")
+    active = await proxy.get_active_routes(before)
+    assert sorted(active) == ["/user/alice/"]
+    assert await proxy.get_active_routes(utcnow() + timedelta(seconds=10)) == {}
+    # naive UTC timestamps are accepted
+    active = await proxy.get_active_routes(before.replace(tzinfo=None))
+    assert sorted(active) == ["/user/alice/"]
@@ -1,6 +1,16 @@
+import time
+from unittest import mock
+
 import pytest
 
-from jupyterhub._memoize import DoNotCache, FrozenDict, LRUCache, lru_cache_key
+from jupyterhub._memoize import (
+    DoNotCache,
+    FrozenDict,
+    LRUCache,
+    clear_caches,
+    lru_cache_key,
+    memoized_caches,
+)
 
 
 def test_lru_cache():
@@ -24,6 +34,40 @@ def test_lru_cache():
     assert "b" not in cache
 
 
+def test_lru_cache_ttl():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache["a"] = 1
+    assert cache["a"] == 1
+    later = time.monotonic() + 61
+    with mock.patch("time.monotonic", lambda: later):
+        assert "a" not in cache
+        assert cache.get("a") is None
+    assert len(cache) == 0
+    assert cache._deadlines == {}
+
+
+def test_lru_cache_stats():
+    cache = LRUCache(maxsize=2)
+    assert cache.get("a") is None
+    cache["a"] = 1
+    cache["b"] = 2
+    assert cache["a"] == 1
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 0)
+    cache["c"] = 3
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 1)
+    assert "b" not in cache
+
+    cache.resize(1)
+    assert cache.maxsize == 1
+    assert cache.evictions == 2
+    assert cache.items() == [("c", 3)]
+
+    # stats are kept when cleared
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 2)
+
+
 def test_lru_cache_key():
     call_count = 0
 
@@ -75,6 +119,26 @@ def test_do_not_cache():
     assert call_count == before + 1
 
 
+# don't leave the test function in the registry of memoized functions
+@mock.patch.dict("jupyterhub._memoize._memoized_caches")
+def test_lru_cache_key_registry():
+    @lru_cache_key(lambda arg: arg)
+    def double(arg):
+        return 2 * arg
+
+    name = f"{__name__}.test_lru_cache_key_registry.<locals>.double"
+    assert memoized_caches()[name] is double.cache
+    assert double(1) == 2
+    assert double(1) == 2
+    assert (double.cache.hits, double.cache.misses) == (1, 1)
+    assert "jupyterhub.scopes.expand_scopes" in memoized_caches()
+
+    clear_caches()
+    assert len(double.cache) == 0
+    double(1)
+    assert double.cache.misses == 2
+
+
 @pytest.mark.parametrize(
     "d",
     [
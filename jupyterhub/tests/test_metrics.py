@@ -22,6 +22,28 @@ def test_metric_names(metric_object, expected_names):
         assert metric.name == expected_name
 
 
+def test_memoize_metrics():
+    from jupyterhub import scopes
+
+    scopes.expand_scopes.cache_clear()
+    scopes.expand_scopes({"read:users"})
+    scopes.expand_scopes({"read:users"})
+    cache = scopes.expand_scopes.cache
+
+    samples = {}
+    for family in metrics.MEMOIZE_CACHES.collect():
+        for sample in family.samples:
+            if sample.labels["function"] == "jupyterhub.scopes.expand_scopes":
+                samples[sample.name] = sample.value
+    assert samples == {
+        "jupyterhub_memoize_cache_hits_total": cache.hits,
+        "jupyterhub_memoize_cache_misses_total": cache.misses,
+        "jupyterhub_memoize_cache_evictions_total": cache.evictions,
+        "jupyterhub_memoize_cache_size": 1,
+    }
+    assert cache.hits >= 1
+
+
 async def test_total_users(app):
     num_users = app.db.query(orm.User).count()
     sample = metrics.TOTAL_USERS.collect()[0].samples[0]
@@ -135,7 +157,7 @@ async def test_active_users(app):
         assert counts[period] == baseline[period]
 
     # collect after updates, check updated counts
-    collector.update_active_users()
+    await collector.update_active_users_async()
     counts = collect()
     assert (
         counts[metrics.ActiveUserPeriods.twenty_four_hours]
@@ -149,3 +171,40 @@ async def test_active_users(app):
         counts[metrics.ActiveUserPeriods.thirty_days]
         == baseline[metrics.ActiveUserPeriods.thirty_days] + 5
     )
+
+
+async def test_request_db_queries(app, caplog):
+    handler = "jupyterhub.apihandlers.users.UserListAPIHandler"
+
+    def collect():
+        samples = {}
+        for metric in (metrics.REQUEST_DB_QUERIES, metrics.REQUEST_DB_DURATION_SECONDS):
+            for sample in metric.collect()[0].samples:
+                if sample.labels.get("handler") == handler and not sample.labels.get(
+                    "le"
+                ):
+                    samples[sample.name] = sample.value
+        return samples
+
+    before = collect()
+    r = await api_request(app, "users")
+    r.raise_for_status()
+    after = collect()
+    assert (
+        after["jupyterhub_request_db_queries_count"]
+        == before.get("jupyterhub_request_db_queries_count", 0) + 1
+    )
+    assert after["jupyterhub_request_db_queries_sum"] > before.get(
+        "jupyterhub_request_db_queries_sum", 0
+    )
+    assert after["jupyterhub_request_db_duration_seconds_sum"] > before.get(
+        "jupyterhub_request_db_duration_seconds_sum", 0
+    )
+    assert "database queries" not in caplog.text
+
+    # log statements of requests over the threshold
+    with mock.patch.dict(app.tornado_settings, {"db_query_log_threshold": 1}):
+        r = await api_request(app, "users")
+        r.raise_for_status()
+    assert "database queries" in caplog.text
+    assert "x SELECT" in caplog.text
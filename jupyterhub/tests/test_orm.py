@@ -8,8 +8,10 @@ from datetime import timedelta
 from unittest import mock
 
 import pytest
+from sqlalchemy import text
 
 from .. import crypto, objects, orm, roles
+from .._token_cache import APITokenCache
 from ..user import User
 from ..utils import utcnow
 from .mocking import MockSpawner
@@ -148,6 +150,81 @@ def test_token_expiry(db):
     assert orm_token not in user.api_tokens
 
 
+def test_token_digest(db):
+    user = orm.User(name='zoe')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token()
+    orm_token = orm.APIToken.find(db, token)
+    assert orm_token.digest == orm.APIToken.token_digest(token)
+    # generated tokens are found by digest, without comparing hashes
+    with mock.patch.object(orm.APIToken, 'match') as match:
+        assert orm.APIToken.find(db, token) is orm_token
+        assert orm.APIToken.find(db, token, kind='user') is orm_token
+        assert orm.APIToken.find(db, token, kind='service') is None
+    match.assert_not_called()
+
+    # user-provided tokens have no digest, and are found by prefix
+    secret = 'super-secret-preload-token'
+    user.new_api_token(secret, generated=False)
+    found = orm.APIToken.find(db, secret)
+    assert found.digest is None
+    assert found.match(secret)
+    # and can't collide with generated tokens
+    with pytest.raises(ValueError):
+        user.new_api_token(token, generated=False)
+
+    # tokens created before digests are found by prefix
+    orm_token.digest = None
+    db.commit()
+    assert orm.APIToken.find(db, token) is orm_token
+
+
+def test_token_cache(db):
+    user = orm.User(name='kaylee')
+    db.add(user)
+    db.commit()
+    cache = APITokenCache(maxsize=2)
+    token = user.new_api_token()
+    orm_token = cache.find(db, token)
+    assert orm_token.user is user
+    assert len(cache) == 1
+    # hit doesn't query tokens by prefix
+    with mock.patch.object(orm.APIToken, 'find') as find:
+        assert cache.find(db, token) is orm_token
+    find.assert_not_called()
+    assert cache.find(db, 'something else') is None
+    assert len(cache) == 1
+
+    # changing scopes invalidates the entry
+    orm_token.scopes = ['read:users']
+    db.commit()
+    assert len(cache) == 0
+    assert cache.find(db, token) is orm_token
+
+    # so does deleting the token
+    db.delete(orm_token)
+    db.commit()
+    assert len(cache) == 0
+    assert cache.find(db, token) is None
+
+
+def test_token_cache_expiry(db):
+    user = orm.User(name='wash')
+    db.add(user)
+    db.commit()
+    cache = APITokenCache()
+    now = utcnow(with_tz=False)
+    token = user.new_api_token(expires_in=60)
+    assert cache.find(db, token)
+    the_future = mock.patch(
+        'jupyterhub.orm.APIToken.now', lambda: now + timedelta(seconds=70)
+    )
+    with the_future:
+        assert cache.find(db, token) is None
+    assert len(cache) == 0
+
+
 def test_service_tokens(db):
     service = orm.Service(name='secret')
     db.add(service)
@@ -638,3 +715,116 @@ def test_expiring_oauth_code(app, user):
         assert orm_code in db.query(orm.OAuthCode)
         orm.OAuthCode.purge_expired(db)
         assert orm_code not in db.query(orm.OAuthCode)
+
+
+def test_purge_expired_batches(db):
+    user = orm.User(name='river')
+    db.add(user)
+    db.commit()
+    now = utcnow(with_tz=False)
+    tokens = [user.new_api_token(expires_in=30) for i in range(5)]
+    keep = user.new_api_token()
+    cache = APITokenCache()
+    for token in tokens + [keep]:
+        assert cache.find(db, token)
+    # load the collection, to check that it is expired
+    assert len(user.api_tokens) == 6
+
+    the_future = mock.patch(
+        'jupyterhub.orm.APIToken.now', lambda: now + timedelta(seconds=60)
+    )
+    with the_future:
+        # time budget used up after the first batch
+        assert orm.APIToken.purge_expired(db, batch_size=2, max_seconds=0) == 2
+        # bulk deletes clear the token cache
+        assert len(cache) == 0
+        assert len(user.api_tokens) == 4
+        assert orm.APIToken.purge_expired(db, batch_size=2) == 3
+        assert orm.APIToken.purge_expired(db, batch_size=2) == 0
+    assert db.query(orm.APIToken).count() == 1
+    assert user.api_tokens == [orm.APIToken.find(db, keep)]
+    for token in tokens:
+        assert orm.APIToken.find(db, token) is None
+    with pytest.raises(ValueError):
+        orm.APIToken.purge_expired(db, batch_size=0)
+
+
+def test_sqlite_pragmas(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'jupyterhub.sqlite'}"
+    db = orm.new_session_factory(
+        db_url,
+        sqlite_pragmas=dict(orm.SQLITE_PERFORMANCE_PRAGMAS, busy_timeout=1234),
+    )()
+
+    def pragma(name):
+        return db.execute(text(f"PRAGMA {name}")).scalar()
+
+    assert pragma("journal_mode") == "wal"
+    # NORMAL
+    assert pragma("synchronous") == 1
+    assert pragma("cache_size") == -65536
+    assert pragma("busy_timeout") == 1234
+    # still enabled
+    assert pragma("foreign_keys") == 1
+    db.close()
+
+
+@pytest.mark.parametrize(
+    "pragmas",
+    [
+        {"journal_mode; DROP TABLE users": "WAL"},
+        {"journal_mode": "WAL; DROP TABLE users"},
+        {"cache_size": 1.5},
+    ],
+)
+def test_sqlite_pragmas_invalid(pragmas):
+    with pytest.raises(ValueError):
+        orm.new_session_factory(sqlite_pragmas=pragmas)
+
+
+def query_plan(db, query):
+    """Return the SQLite query plan for a query, as a single string"""
+    compiled = query.statement.compile(db.get_bind())
+    # parameter values don't affect the plan
+    params = (None,) * len(compiled.positiontup or ())
+    rows = db.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params)
+    return "\n".join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize(
+    "make_query, index",
+    [
+        (
+            lambda db: db.query(orm.User).filter(
+                orm.User.last_activity >= utcnow(with_tz=False)
+            ),
+            "ix_users_last_activity",
+        ),
+        (
+            # Server.spawner
+            lambda db: db.query(orm.Spawner).filter(orm.Spawner.server_id == 1),
+            "ix_spawners_server_id",
+        ),
+        (
+            lambda db: db.query(orm.APIToken)
+            .filter(orm.APIToken.expires_at != None)
+            .filter(orm.APIToken.expires_at < orm.APIToken.now()),
+            "ix_api_tokens_expires_at",
+        ),
+        (
+            lambda db: db.query(orm.OAuthCode)
+            .filter(orm.OAuthCode.expires_at != None)
+            .filter(orm.OAuthCode.expires_at < orm.OAuthCode.now()),
+            "ix_oauth_codes_expires_at",
+        ),
+        (
+            lambda db: db.query(orm.ShareCode)
+            .filter(orm.ShareCode.expires_at != None)
+            .filter(orm.ShareCode.expires_at < orm.ShareCode.now()),
+            "ix_share_codes_expires_at",
+        ),
+    ],
+)
+def test_query_plan_indexes(db, make_query, index):
+    plan = query_plan(db, make_query(db))
+    assert index in plan
@@ -10,9 +10,11 @@ import pytest
 from traitlets import TraitError
 from traitlets.config import Config
 
+from ..proxy import ConfigurableHTTPProxy, Route, _iter_json_object
 from ..utils import random_port
 from ..utils import url_path_join as ujoin
-from ..utils import wait_for_http_server
+from ..utils import utcnow, wait_for_http_server
+from .mockchp import MockCHP
 from .mocking import MockHub
 from .test_api import add_user, api_request
 
@@ -20,11 +22,18 @@ from .test_api import add_user, api_request
 @pytest.fixture
 def disable_check_routes(app):
     # disable periodic check_routes while we are testing
-    app._periodic_callbacks["last_activity"].stop()
+    callbacks = [
+        app._periodic_callbacks[name]
+        for name in ("last_activity", "check_routes")
+        if name in app._periodic_callbacks
+    ]
+    for pc in callbacks:
+        pc.stop()
     try:
         yield
     finally:
-        app._periodic_callbacks["last_activity"].start()
+        for pc in callbacks:
+            pc.start()
 
 
 async def test_external_proxy(request):
@@ -40,6 +49,7 @@ async def test_external_proxy(request):
     # disable last_activity polling to avoid check_routes being called during the test,
     # which races with some of our test conditions
     app.last_activity_interval = 0
+    app.route_check_interval = 0
 
     def fin():
         MockHub.clear_instance()
@@ -194,6 +204,44 @@ async def test_check_routes(app, username, disable_check_routes):
     assert before == after
 
 
+async def test_check_routes_incremental(app, disable_check_routes):
+    proxy = app.proxy
+    name = 'incremental'
+    test_user = add_user(app.db, app, name=name)
+    r = await api_request(app, f'users/{name}/server', method='post')
+    r.raise_for_status()
+    # full check populates the route index
+    await proxy.check_routes(app.users, app._service_map)
+    assert test_user.proxy_spec in proxy._route_index
+    assert not proxy._dirty_routes
+
+    # route removed behind the Hub's back is restored
+    await proxy.delete_route(test_user.proxy_spec)
+    await proxy.check_routes(app.users, app._service_map, incremental=True)
+    routes = await proxy.get_all_routes()
+    assert test_user.proxy_spec in routes
+
+    # stale route is removed
+    stale_spec = ujoin(app.base_url, 'user/nosuchuser/')
+    if app.subdomain_host:
+        stale_spec = urlparse(app.subdomain_host).hostname + stale_spec
+    await proxy.add_route(
+        stale_spec, 'http://127.0.0.1:1234', {'user': 'nosuchuser', 'server_name': ''}
+    )
+    await proxy.check_routes(app.users, app._service_map, incremental=True)
+    routes = await proxy.get_all_routes()
+    assert stale_spec not in routes
+
+    # stopping the server marks the route for removal
+    r = await api_request(app, f'users/{name}/server', method='delete')
+    r.raise_for_status()
+    assert test_user.proxy_spec in proxy._dirty_routes
+    await proxy.check_routes(app.users, app._service_map, incremental=True)
+    routes = await proxy.get_all_routes()
+    assert test_user.proxy_spec not in routes
+    assert test_user.proxy_spec not in proxy._route_index
+
+
 @pytest.mark.parametrize(
     "routespec",
     [
@@ -339,3 +387,235 @@ async def test_add_get_delete(app, routespec, disable_check_routes):
 async def test_proxy_patch_bad_request_data(app, test_data):
     r = await api_request(app, 'proxy', method='patch', data=test_data)
     assert r.status_code == 400
+
+
+async def test_add_delete_routes(app, disable_check_routes):
+    proxy = app.proxy
+    prefix = ujoin(app.base_url, 'bulk')
+    if app.subdomain_host:
+        prefix = urlparse(app.subdomain_host).hostname + prefix
+    routespecs = [ujoin(prefix, str(i), '/') for i in range(5)]
+    target = 'https://localhost:1234'
+    await proxy.add_routes([(spec, target, {'bulk': True}) for spec in routespecs])
+    routes = await proxy.get_all_routes()
+    for spec in routespecs:
+        assert spec in routes
+        assert routes[spec]['target'] == target
+        assert routes[spec]['data']['bulk'] is True
+
+    await proxy.delete_routes(routespecs)
+    routes = await proxy.get_all_routes()
+    for spec in routespecs:
+        assert spec not in routes
+
+
+async def test_add_user_override(app, user, monkeypatch, disable_check_routes):
+    # add_user overridden by a subclass is used instead of bulk add_routes
+    proxy = app.proxy
+    r = await api_request(app, f'users/{user.name}/server', method='post')
+    r.raise_for_status()
+    spawner = user.spawners['']
+    added = []
+
+    class AddUserProxy(type(proxy)):
+        async def add_user(self, user, server_name=''):
+            added.append((user.name, server_name))
+            await super().add_user(user, server_name)
+
+    monkeypatch.setattr(proxy, "__class__", AddUserProxy)
+
+    await proxy.delete_route(spawner.proxy_spec)
+    await proxy.check_routes(app.users, app._service_map)
+    assert (user.name, '') in added
+    routes = await proxy.get_all_routes()
+    assert spawner.proxy_spec in routes
+
+    added.clear()
+    await proxy.add_all_users(app.users)
+    assert (user.name, '') in added
+
+    # servers pending anything but spawn are never added
+    monkeypatch.setattr(spawner, "_stop_pending", True)
+    with pytest.raises(RuntimeError):
+        proxy._user_route(user, '')
+
+
+async def test_update_last_activity_active_routes(
+    app, user, monkeypatch, disable_check_routes
+):
+    proxy = app.proxy
+    r = await api_request(app, f'users/{user.name}/server', method='post')
+    r.raise_for_status()
+    spawner = user.spawners['']
+    activity = utcnow(with_tz=False).replace(microsecond=0)
+    requested = []
+
+    async def get_active_routes(since=None):
+        requested.append(since)
+        return {
+            spawner.proxy_spec: {
+                'routespec': spawner.proxy_spec,
+                'target': spawner.server.host,
+                'data': {
+                    'user': user.name,
+                    'server_name': '',
+                    'last_activity': activity.isoformat() + 'Z',
+                },
+            }
+        }
+
+    monkeypatch.setattr(proxy, "get_active_routes", get_active_routes)
+    app._last_activity_poll = None
+    await app.update_last_activity()
+    await app.update_last_activity()
+    # first poll requests all activity, the next only activity since the first poll
+    assert requested[0] is None
+    assert requested[1] is not None
+    assert requested[1] >= activity
+    assert spawner.orm_spawner.last_activity >= activity
+    assert user.last_activity >= activity
+
+
+async def test_update_last_activity_checked_routes(
+    app, user, monkeypatch, disable_check_routes
+):
+    proxy = app.proxy
+    get_all_routes = proxy.get_all_routes
+    fetched = []
+
+    async def counting_get_all_routes():
+        fetched.append(utcnow(with_tz=False))
+        return await get_all_routes()
+
+    async def get_active_routes(since=None):
+        raise NotImplementedError()
+
+    monkeypatch.setattr(proxy, "get_all_routes", counting_get_all_routes)
+    monkeypatch.setattr(proxy, "get_active_routes", get_active_routes)
+    app._last_activity_poll = None
+    app._checked_routes = None
+    await app.update_last_activity()
+    assert len(fetched) == 1
+    first_poll = app._last_activity_poll
+
+    # the activity poll after a route check reuses its routing table
+    await app.check_proxy_routes()
+    assert len(fetched) == 2
+    await app.update_last_activity()
+    assert len(fetched) == 2
+    # activity is recorded up to when the route check fetched the routes
+    assert first_poll <= app._last_activity_poll <= fetched[1]
+
+    # but only once
+    await app.update_last_activity()
+    assert len(fetched) == 3
+
+    # and only if it is recent
+    await app.check_proxy_routes()
+    assert len(fetched) == 4
+    monkeypatch.setattr(app, "_checked_routes_max_age", 0)
+    await app.update_last_activity()
+    assert len(fetched) == 5
+    assert app._last_activity_poll > fetched[3]
+
+
+async def test_chp_api_mock():
+    # exercise the REST API client against the mock CHP, with errors to retry
+    with MockCHP('secret', error_rate=0.2, seed=1) as chp:
+        proxy = ConfigurableHTTPProxy(
+            api_url=chp.api_url, auth_token='secret', should_start=False
+        )
+        routes = [
+            (f'/user/name-{i}/', f'http://127.0.0.1:{9000 + i}', {'user': f'name-{i}'})
+            for i in range(20)
+        ]
+        await proxy.add_routes(routes)
+        assert chp.error_count
+        all_routes = await proxy.get_all_routes()
+        assert sorted(all_routes) == sorted(route[0] for route in routes)
+        route = all_routes['/user/name-1/']
+        assert route['target'] == 'http://127.0.0.1:9001'
+        assert route['data']['user'] == 'name-1'
+        assert 'last_activity' in route['data']
+        streamed = [item async for item in proxy.iter_routes()]
+        assert dict(streamed) == all_routes
+
+        await proxy.delete_routes([spec for spec, target, data in routes[:10]])
+        all_routes = await proxy.get_all_routes()
+        assert sorted(all_routes) == sorted(route[0] for route in routes[10:])
+        assert chp.request_count['DELETE'] >= 10
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1024])
+async def test_iter_json_object(chunk_size):
+    doc = {
+        "/": {"target": "http://127.0.0.1:8081", "jupyterhub": True, "hub": True},
+        "/user/ü/": {"target": "http://127.0.0.1:9000", "n": 12345, "ok": False},
+        "/empty": {},
+        "/number": 1.5e10,
+        "/null": None,
+    }
+    raw = json.dumps(doc, indent=1, ensure_ascii=False).encode("utf8")
+
+    async def chunks():
+        for i in range(0, len(raw), chunk_size):
+            yield raw[i : i + chunk_size]
+
+    parsed = [item async for item in _iter_json_object(chunks())]
+    assert parsed == list(doc.items())
+
+
+@pytest.mark.parametrize("raw", [b"", b"[]", b'{"a": 1', b'{"a" 1}', b'{"a": 1}x'])
+async def test_iter_json_object_invalid(raw):
+    async def chunks():
+        yield raw
+
+    with pytest.raises(ValueError):
+        [item async for item in _iter_json_object(chunks())]
+
+
+def test_route_mapping():
+    route = Route('/user/x/', 'http://127.0.0.1:9000', {'user': 'x'})
+    assert route == {
+        'routespec': '/user/x/',
+        'target': 'http://127.0.0.1:9000',
+        'data': {'user': 'x'},
+    }
+    assert route['target'] == route.target
+    with pytest.raises(KeyError):
+        route['nope']
+    assert not hasattr(route, '__dict__')
+
+
+@pytest.mark.parametrize(
+    "interval, changed, duration, loop_lag, expected",
+    [
+        # steady state
+        (300, 0, 0.1, 0, 300),
+        # drift: speed up, down to the minimum
+        (300, 2, 0.1, 0, 150),
+        (40, 1, 0.1, 0, 30),
+        # expensive checks or busy loop: back off, up to the maximum
+        (300, 0, 30, 0, 600),
+        (300, 0, 0.1, 1, 600),
+        (3000, 0, 300, 0, 3600),
+        # recover towards the base interval
+        (75, 0, 0.1, 0, 150),
+        (1200, 0, 1, 0, 600),
+        # but not while it would be too expensive at the shorter interval
+        (1200, 0, 20, 0, 1200),
+    ],
+)
+def test_next_route_check_interval(interval, changed, duration, loop_lag, expected):
+    app = MockHub(
+        route_check_min_interval=30,
+        route_check_max_interval=3600,
+        route_check_max_load=0.05,
+        route_check_max_loop_lag=0.1,
+    )
+    # not a trait on MockHub, which hardcodes a short interval
+    app.route_check_interval = 300
+    assert (
+        app._next_route_check_interval(interval, changed, duration, loop_lag)
+        == expected
+    )
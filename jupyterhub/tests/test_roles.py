@@ -5,13 +5,15 @@
 import json
 import logging
 import os
+import warnings
+from unittest import mock
 
 import pytest
 from pytest import mark
 from tornado.log import app_log
 
 from .. import orm, roles
-from ..scopes import get_scopes_for, scope_definitions
+from ..scopes import expand_scopes, get_scopes_for, scope_definitions
 from ..utils import utcnow
 from .mocking import MockHub
 from .utils import add_user, api_request
@@ -250,6 +252,73 @@ def test_get_expanded_scopes(db, scopes, expected_scopes):
     db.delete(role)
 
 
+@mark.role
+@mark.parametrize(
+    "role_scopes",
+    [
+        [["self"]],
+        [["self"], ["read:users", "read:servers!user"]],
+        [["admin-ui", "users:activity!user"], ["access:services!service"]],
+        [["tokens!user", "read:groups!group=x"], ["tokens"]],
+    ],
+)
+@mark.parametrize("owner_kind", ["user", "service"])
+def test_roles_to_expanded_scopes(db, role_scopes, owner_kind):
+    role_list = []
+    for i, scopes in enumerate(role_scopes):
+        role_list.append(
+            roles.create_role(db, {"name": f"expand-{i}", "scopes": scopes})
+        )
+    if owner_kind == "user":
+        owner = orm.User(name="expander")
+    else:
+        owner = orm.Service(name="expander")
+    raw_scopes = roles.roles_to_scopes(role_list)
+    with warnings.catch_warnings():
+        # e.g. 'self' for services
+        warnings.simplefilter("ignore")
+        expected = expand_scopes(raw_scopes, owner=owner)
+        assert roles.roles_to_expanded_scopes(role_list, owner=owner) == expected
+    for role in role_list:
+        roles.delete_role(db, role.name)
+
+
+@mark.role
+def test_expanded_role_scopes_stored(db):
+    role = roles.create_role(db, {"name": "stored", "scopes": ["read:users!user"]})
+    user = orm.User(name="stored-user")
+    assert role.id in roles._role_scopes
+    expanded = roles.roles_to_expanded_scopes([role], owner=user)
+    assert "read:users!user=stored-user" in expanded
+    assert expanded == expand_scopes(["read:users!user"], owner=user)
+
+    # expansion is reused
+    with mock.patch.object(
+        roles.scopes,
+        "expand_scopes_without_owner",
+        wraps=roles.scopes.expand_scopes_without_owner,
+    ) as expand:
+        roles.roles_to_expanded_scopes([role], owner=user)
+        assert expand.call_count == 0
+
+        # and refreshed when the role changes
+        roles.create_role(db, {"name": "stored", "scopes": ["tokens!user"]})
+        assert expand.call_count == 1
+        expanded = roles.roles_to_expanded_scopes([role], owner=user)
+        assert "tokens!user=stored-user" in expanded
+        assert expanded == expand_scopes(["tokens!user"], owner=user)
+        assert expand.call_count == 1
+
+        # even if it's changed directly
+        role.scopes = ["read:groups"]
+        expanded = roles.roles_to_expanded_scopes([role], owner=user)
+        assert expanded == expand_scopes(["read:groups"], owner=user)
+        assert expand.call_count == 2
+
+    roles.delete_role(db, "stored")
+    assert role.id not in roles._role_scopes
+
+
 @mark.role
 async def test_load_default_roles(tmpdir, request):
     """Test loading default roles in app.py"""
@@ -9,6 +9,7 @@ from pytest import mark
 from tornado import web
 
 from .. import orm, roles, scopes
+from .._authz_cache import group_membership
 from .._memoize import FrozenDict
 from ..apihandlers import APIHandler
 from ..scopes import (
@@ -16,6 +17,7 @@ from ..scopes import (
     _expand_self_scope,
     _intersect_expanded_scopes,
     _resolve_requested_scopes,
+    check_scope_filter,
     expand_scopes,
     get_scopes_for,
     has_scope,
@@ -23,6 +25,7 @@ from ..scopes import (
     needs_scope,
     parse_scopes,
 )
+from ..utils import utcnow
 from .utils import add_user, api_request, auth_header
 
 
@@ -300,6 +303,7 @@ async def test_exceeding_user_permissions(
     orm_api_token = orm.APIToken.find(app.db, token=api_token)
     # store scopes user does not have
     orm_api_token.scopes = list(orm_api_token.scopes) + ['list:users', 'read:users']
+    app.db.commit()
     headers = {'Authorization': f'token {api_token}'}
     r = await api_request(app, 'users', headers=headers)
     assert r.status_code == 200
@@ -996,13 +1000,58 @@ def test_intersect_groups(request, db, left, right, expected, groups):
         assert intersection == set(expected)
 
 
+def test_intersect_groups_cached(db):
+    group = orm.Group(name="gcached")
+    user = orm.User(name="ucached")
+    db.add(group)
+    db.add(user)
+    db.commit()
+    left = {"read:users!group=gcached"}
+    right = {"read:users!user=ucached"}
+
+    def intersect():
+        with mock.patch.object(
+            group_membership,
+            "groups_for_user",
+            wraps=group_membership.groups_for_user,
+        ) as groups_for_user:
+            intersection = _intersect_expanded_scopes(left, right, db)
+        return intersection, groups_for_user.called
+
+    assert intersect() == (set(), True)
+    # group-filtered intersections are cached
+    assert intersect() == (set(), False)
+    # membership is indexed, no need to ask the db
+    assert group_membership.groups_for_user(None, "ucached") == set()
+
+    # membership changes take effect immediately
+    user.groups.append(group)
+    assert group_membership.groups_for_user(None, "ucached") == {"gcached"}
+    assert intersect() == (right, True)
+    db.commit()
+    assert intersect() == (right, False)
+
+    group.users.remove(user)
+    db.commit()
+    assert intersect() == (set(), True)
+
+    # rolled back changes are discarded
+    user.groups.append(group)
+    assert intersect()[0] == right
+    db.rollback()
+    assert intersect() == (set(), True)
+
+
 @mark.user
 @mark.parametrize(
     "scopes, expected",
     [
         ("list:users", ['in-1', 'in-2', 'out-1', 'out-2', 'admin', 'user']),
         ("read:users", 403),
-        ("list:users!server=irrelevant", 403),
+        ("list:users!server=irrelevant", []),
+        # server filters don't select users, like read:users:name!server
+        ("list:users!server=out-1/", []),
+        (["list:users!server=out-1/", "list:users!user=out-2"], ['out-2']),
         ("list:users!user=nosuchuser", []),
         ("list:users!group=nosuchgroup", []),
         ("list:users!user=out-2", ['out-2']),
@@ -1020,7 +1069,9 @@ async def test_list_users_filter(
     for i in (1, 2):
         user = add_user(app.db, app, name=f'in-{i}')
         group.users.append(user.orm_user)
-        add_user(app.db, app, name=f'out-{i}')
+        user = add_user(app.db, app, name=f'out-{i}')
+        # a server for server filters
+        user.spawners['']
     app.db.commit()
 
     if isinstance(scopes, str):
@@ -1050,6 +1101,48 @@ async def test_list_users_filter(
     assert sorted(r.json(), key=itemgetter('name')) == expected_models
 
 
+@mark.user
+@mark.parametrize(
+    "server_scopes, expected",
+    [
+        (["read:servers"], {"srv-1": ["", "x"], "srv-2": [""]}),
+        (["read:servers!server=srv-1/x"], {"srv-1": ["x"], "srv-2": None}),
+        (["read:servers!user=srv-2"], {"srv-1": None, "srv-2": [""]}),
+        (
+            ["read:servers!group=GROUP", "read:servers!server=srv-1/"],
+            {"srv-1": [""], "srv-2": [""]},
+        ),
+        ([], {"srv-1": None, "srv-2": None}),
+    ],
+)
+async def test_list_users_read_servers(
+    app, group, create_service_with_scopes, server_scopes, expected
+):
+    users = [add_user(app.db, app, name=name) for name in ("srv-1", "srv-2")]
+    group.users.append(users[1].orm_user)
+    users[0].spawners[""]
+    users[0]._new_orm_spawner("x", "x")
+    users[1].spawners[""]
+    app.db.commit()
+
+    server_scopes = [s.replace("GROUP", group.name) for s in server_scopes]
+    orm_service = create_service_with_scopes(
+        "list:users!user=srv-1", "list:users!user=srv-2", *server_scopes
+    )
+    token = orm_service.new_api_token()
+    r = await api_request(
+        app,
+        'users?include_stopped_servers=1',
+        headers={"Authorization": f"token {token}"},
+    )
+    r.raise_for_status()
+    servers = {
+        model['name']: sorted(model['servers']) if 'servers' in model else None
+        for model in r.json()
+    }
+    assert servers == expected
+
+
 @mark.group
 @mark.parametrize(
     "scopes, expected",
@@ -1399,3 +1492,115 @@ def test_has_scope_post_filter(scope, have_scopes, ok):
             has_scope(scope, have_scopes, post_filter=True)
     else:
         assert has_scope(scope, have_scopes, post_filter=True) == ok
+
+
+async def test_scopes_for_cached(
+    app, user, create_user_with_scopes, create_temp_role, group
+):
+    db = app.db
+    owner = user
+    orm_user = create_user_with_scopes("read:users:name").orm_user
+    orm_token = orm_user.new_api_token()
+    orm_token = orm.APIToken.find(db, orm_token)
+    role = create_temp_role(["read:groups:name"])
+
+    with mock.patch.object(
+        scopes, "_resolve_scopes_for", wraps=scopes._resolve_scopes_for
+    ) as resolve:
+
+        def resolved(obj):
+            """get scopes for obj, and whether they had to be resolved"""
+            calls = resolve.call_count
+            return get_scopes_for(obj), resolve.call_count > calls
+
+        user_scopes, was_resolved = resolved(orm_user)
+        assert "read:groups:name" not in user_scopes
+        assert resolved(orm_user) == (user_scopes, False)
+        assert resolved(orm_token)[1]
+        assert resolved(orm_token)[1] is False
+
+        # unrelated changes don't invalidate
+        owner.orm_user.last_activity = utcnow(with_tz=False)
+        db.commit()
+        assert resolved(orm_user) == (user_scopes, False)
+
+        # role assignment
+        roles.grant_role(db, orm_user, role)
+        user_scopes, was_resolved = resolved(orm_user)
+        assert was_resolved
+        assert "read:groups:name" in user_scopes
+        assert "read:groups:name" in resolved(orm_token)[0]
+        roles.strip_role(db, orm_user, role)
+        assert "read:groups:name" not in resolved(orm_user)[0]
+
+        # group membership, before it's committed
+        roles.grant_role(db, group, role)
+        orm_user.groups.append(group)
+        assert "read:groups:name" in resolved(orm_user)[0]
+        db.commit()
+        orm_user.groups.remove(group)
+        db.commit()
+        assert "read:groups:name" not in resolved(orm_user)[0]
+
+        # shares
+        spawner = owner.spawner.orm_spawner
+        share_scope = f"access:servers!server={owner.name}/"
+        assert share_scope not in resolved(orm_user)[0]
+        orm.Share.grant(db, spawner, orm_user)
+        assert share_scope in resolved(orm_user)[0]
+        orm.Share.revoke(db, spawner, orm_user)
+        assert share_scope not in resolved(orm_user)[0]
+
+        # token scopes
+        assert "read:users:name" in resolved(orm_token)[0]
+        orm_token.scopes = ["read:users:activity"]
+        db.commit()
+        token_scopes, was_resolved = resolved(orm_token)
+        assert was_resolved
+        assert "read:users:name" not in token_scopes
+
+
+@pytest.mark.parametrize(
+    "have_scopes",
+    [
+        "read:users!user=ualice",
+        "read:users!group=gsql",
+        "read:users!user=ualice,read:users!group=gsql",
+        "read:users!server=ualice/",
+        "read:users!server=ualice/x,read:users!server=ubob/",
+        "read:users!server=ubob/x,read:users!user=ualice",
+        "read:users!group=gsql,read:users!server=ualice/x",
+        "read:users!server=x",
+        "read:users!service=ssql",
+        "read:users!group=nosuchgroup",
+        "read:users",
+    ],
+)
+def test_scope_filter_clause(db, have_scopes):
+    group = orm.Group(name="gsql")
+    db.add(group)
+    users = []
+    for name in ("ualice", "ubob", "ucarol"):
+        user = orm.User(name=name)
+        db.add(user)
+        users.append(user)
+    users[1].groups.append(group)
+    for user, server_name in [(users[0], ""), (users[0], "x"), (users[1], "")]:
+        db.add(orm.Spawner(user=user, name=server_name))
+    db.commit()
+
+    sub_scope = parse_scopes(have_scopes.split(","))["read:users"]
+    for kind, cls in [
+        ("user", orm.User),
+        ("group", orm.Group),
+        ("server", orm.Spawner),
+    ]:
+        clause = scopes.scope_filter_clause(sub_scope, kind)
+        query = db.query(cls)
+        if clause is not None:
+            query = query.filter(clause)
+        selected = set(query)
+        expected = {
+            obj for obj in db.query(cls) if check_scope_filter(sub_scope, obj, kind)
+        }
+        assert selected == expected, kind
@@ -0,0 +1,137 @@
+"""Tests for the sharded proxy"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from ..objects import Hub
+from ..proxies.sharded import ShardedProxy
+from ..proxy import Proxy
+
+
+class MemoryProxy(Proxy):
+    """Proxy storing routes in a dict, for testing"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.routes = {}
+
+    async def add_route(self, routespec, target, data):
+        routespec = self.validate_routespec(routespec)
+        self.routes[routespec] = {
+            'routespec': routespec,
+            'target': target,
+            'data': data,
+        }
+
+    async def delete_route(self, routespec):
+        self.routes.pop(self.validate_routespec(routespec), None)
+
+    async def get_all_routes(self):
+        return {routespec: dict(route) for routespec, route in self.routes.items()}
+
+
+def user_route(name):
+    return (
+        f'/user/{name}/',
+        f'http://127.0.0.1:9000/{name}',
+        {'user': name, 'server_name': ''},
+    )
+
+
+@pytest.fixture
+def hub():
+    return Hub(ip='127.0.0.1', port=8081, base_url='/hub/', routespec='/')
+
+
+def sharded_proxy(hub, n=3, **kwargs):
+    app = SimpleNamespace(base_url='/', hub=hub)
+    return ShardedProxy(
+        app=app,
+        hub=hub,
+        shard_class=MemoryProxy,
+        shards=[{'name': f'shard-{i}'} for i in range(n)],
+        **kwargs,
+    )
+
+
+async def test_sharded_routes(hub):
+    proxy = sharded_proxy(hub)
+    users = [user_route(f'user-{i}') for i in range(300)]
+    service = ('/services/svc/', 'http://127.0.0.1:9999', {'service': 'svc'})
+    await proxy.add_routes(users + [service])
+    await proxy.add_route('/', hub.host, {'hub': True})
+
+    for shard in proxy.proxies:
+        # replicated routes are on every shard
+        assert shard.routes['/']['target'] == hub.host
+        assert '/services/svc/' in shard.routes
+        # user routes are spread across shards
+        assert 50 < len(shard.routes) - 2 < 150
+    # each user route is on exactly one shard
+    for routespec, target, data in users:
+        holders = [shard for shard in proxy.proxies if routespec in shard.routes]
+        assert holders == [proxy.shard_for(routespec)]
+
+    routes = await proxy.get_all_routes()
+    assert len(routes) == len(users) + 2
+    assert routes['/user/user-0/']['data'] == {'user': 'user-0', 'server_name': ''}
+    assert await proxy.get_route('/user/user-1/') == routes['/user/user-1/']
+
+    await proxy.delete_routes(['/user/user-0/', '/services/svc/'])
+    routes = await proxy.get_all_routes()
+    assert '/user/user-0/' not in routes
+    assert '/services/svc/' not in routes
+    for shard in proxy.proxies:
+        assert '/services/svc/' not in shard.routes
+
+
+def test_consistent_hashing(hub):
+    proxy = sharded_proxy(hub, n=4)
+    bigger = sharded_proxy(hub, n=5)
+    routespecs = [f'/user/user-{i}/' for i in range(2000)]
+    moved = [
+        routespec
+        for routespec in routespecs
+        if proxy._shard_index(routespec) != bigger._shard_index(routespec)
+    ]
+    # only routes taken by the new shard move
+    assert {bigger._shard_index(routespec) for routespec in moved} == {4}
+    assert len(moved) < len(routespecs) / 3
+    # replicated routes aren't assigned to a shard
+    assert proxy._shard_index('/') is None
+    assert proxy._shard_index('/services/svc/') is None
+
+
+async def test_sharded_check_routes(hub):
+    proxy = sharded_proxy(hub)
+    spawner = SimpleNamespace(
+        ready=True,
+        pending=None,
+        proxy_spec='/user/alice/',
+        server=SimpleNamespace(host='http://127.0.0.1:9000'),
+    )
+    alice = SimpleNamespace(id=1, name='alice', spawners={'': spawner})
+    owner = proxy.shard_for('/user/alice/')
+    other = next(shard for shard in proxy.proxies if shard is not owner)
+    # alice on the wrong shard
+    await other.add_route(
+        '/user/alice/', 'http://127.0.0.1:9000', {'user': 'alice', 'server_name': ''}
+    )
+    # hub route only on one shard
+    await other.add_route('/', hub.host, {'hub': True})
+    # stale route
+    await owner.add_route('/user/bob/', 'http://127.0.0.1:9001', {'user': 'bob'})
+
+    await proxy.check_routes({alice.id: alice}, {})
+    for shard in proxy.proxies:
+        assert shard.routes['/']['target'] == hub.host
+        assert '/user/bob/' not in shard.routes
+    assert '/user/alice/' in owner.routes
+    assert '/user/alice/' not in other.routes
+
+
+def test_shards_required(hub):
+    proxy = ShardedProxy(hub=hub, shard_class=MemoryProxy)
+    with pytest.raises(ValueError):
+        proxy.proxies
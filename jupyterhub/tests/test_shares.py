@@ -989,6 +989,32 @@ async def test_shares_api_list_user(
     assert found_shares == expected_shares
 
 
+async def test_shares_api_list_cursor(app, user, create_user_with_scopes):
+    db = app.db
+    spawner = user.spawner.orm_spawner
+    expected_shares = []
+    for i in range(3):
+        u = create_user_with_scopes().orm_user
+        orm.Share.grant(db, spawner, u)
+        expected_shares.append(u.name)
+
+    found_shares = []
+    params = {"limit": 2, "include_count": "false"}
+    pages = 0
+    while True:
+        r = await api_request(app, f"/shares/{user.name}/", params=params)
+        assert r.status_code == 200
+        page = r.json()
+        pages += 1
+        assert page["_pagination"]["total"] is None
+        found_shares.extend(share["user"]["name"] for share in page["items"])
+        if page["_pagination"]["next"] is None:
+            break
+        params["after"] = page["_pagination"]["next"]["after"]
+    assert pages == 2
+    assert found_shares == expected_shares
+
+
 async def test_shares_api_list_no_such_owner(app):
     r = await api_request(app, "/shares/nosuchuser")
     assert r.status_code == 404
@@ -2,8 +2,11 @@
 # Distributed under the terms of the Modified BSD License.
 import asyncio
 import json
+import time
 import warnings
+import weakref
 from collections import defaultdict
+from datetime import timedelta
 from urllib.parse import quote, urlparse, urlunparse
 
 from sqlalchemy import inspect
@@ -84,6 +87,8 @@ class UserDict(dict):
     def __init__(self, db_factory, settings):
         self.db_factory = db_factory
         self.settings = settings
+        # users removed by evict_idle, as long as something still uses them
+        self._evicted = weakref.WeakValueDictionary()
         super().__init__()
 
     @property
@@ -95,9 +100,31 @@ class UserDict(dict):
 
     def add(self, orm_user):
         """Add a user to the UserDict"""
-        if orm_user.id not in self:
-            self[orm_user.id] = self.from_orm(orm_user)
-        return self[orm_user.id]
+        user = self._get_cached(orm_user.id)
+        if user is None:
+            user = self[orm_user.id] = self.from_orm(orm_user)
+        return user
+
+    def _get_cached(self, id):
+        """Get the User wrapper for a user id from the cache, if there is one
+
+        A user removed by :meth:`evict_idle` that is still in use somewhere
+        (e.g. by a request in progress) is put back,
+        so there is never more than one wrapper for a user.
+        Records the lookup, so users in use aren't evicted.
+        """
+        user = super().get(id)
+        if user is None:
+            user = self._evicted.pop(id, None)
+            if user is None:
+                return None
+            super().__setitem__(id, user)
+        user._last_used = time.monotonic()
+        return user
+
+    def __setitem__(self, key, user):
+        user._last_used = time.monotonic()
+        super().__setitem__(key, user)
 
     def __contains__(self, key):
         """key in userdict checks presence in the cache
@@ -133,21 +160,20 @@ class UserDict(dict):
         if isinstance(key, orm.User):
             # users[orm_user] returns User(orm_user)
             orm_user = key
-            if orm_user.id not in self:
+            user = self._get_cached(orm_user.id)
+            if user is None:
                 user = self[orm_user.id] = User(orm_user, self.settings)
                 return user
-            user = super().__getitem__(orm_user.id)
             user.db = self.db
             return user
         elif isinstance(key, int):
             id = key
-            if id not in self:
+            user = self._get_cached(id)
+            if user is None:
                 orm_user = self.db.query(orm.User).filter(orm.User.id == id).first()
                 if orm_user is None:
                     raise KeyError(f"No such user: {id}")
                 user = self.add(orm_user)
-            else:
-                user = super().__getitem__(id)
             return user
         else:
             raise KeyError(repr(key))
@@ -175,6 +201,36 @@ class UserDict(dict):
             self.db.expunge(user.orm_user)
         super().__delitem__(user.id)
 
+    def evict_idle(self, idle_seconds):
+        """Remove idle users from the cache
+
+        Users are removed if they have not been active or looked up
+        in the last `idle_seconds` and have no active or pending servers,
+        so they (and the database objects they hold on to) can be garbage-collected.
+        They are loaded from the database again the next time they are accessed.
+
+        Returns the list of removed users.
+        """
+        now = time.monotonic()
+        cutoff = utcnow(with_tz=False) - timedelta(seconds=idle_seconds)
+        evicted = []
+        for user_id, user in list(super().items()):
+            if now - user._last_used < idle_seconds:
+                # looked up recently, e.g. by a request in progress
+                continue
+            last_activity = user.orm_user.last_activity
+            if last_activity and last_activity >= cutoff:
+                continue
+            if any(
+                spawner.active or spawner._proxy_pending
+                for spawner in user.spawners.values()
+            ):
+                continue
+            super().__delitem__(user_id)
+            self._evicted[user_id] = user
+            evicted.append(user)
+        return evicted
+
     def delete(self, key):
         """Delete a user from the cache and the database"""
         user = self[key]
@@ -224,6 +280,8 @@ class User:
     log = app_log
     settings = None
     _auth_refreshed = None
+    # time.monotonic() of the last lookup in the UserDict
+    _last_used = 0
 
     def __init__(self, orm_user, settings=None, db=None):
         self.db = db or inspect(orm_user).session
@@ -1209,6 +1267,10 @@ class User:
                     "Error in Authenticator.post_spawn_stop for %s", self
                 )
             spawner._stop_pending = False
+            proxy = self.settings.get('proxy')
+            if proxy is not None:
+                # make sure the route is checked on the next incremental route check
+                proxy.mark_route_dirty(spawner.proxy_spec, ('user', self, server_name))
             if not (
                 spawner._spawn_future
                 and (
@@ -37,3 +37,21 @@ def docs(session):
         session.run(*cmd)
     else:
         session.run("sphinx-build", *doc_build_default_args)
+
+
+@nox.session(default=False)
+def benchmark(session):
+    """
+    Run the proxy benchmarks, passing any arguments to the benchmark script.
+    """
+    session.install("--editable", ".[test]")
+    session.run("python", "benchmarks/bench_proxy.py", *session.posargs)
+
+
+@nox.session(name="benchmark-sqlite", default=False)
+def benchmark_sqlite(session):
+    """
+    Run the SQLite benchmarks, passing any arguments to the benchmark script.
+    """
+    session.install("--editable", ".[test]")
+    session.run("python", "benchmarks/bench_sqlite.py", *session.posargs)